@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Builds synthetic therm.db, weather.db and forecast.db files covering several years
+
+The outdoor temperature follows a seasonal and a daily cycle with slowly wandering noise.
+The room temperature comes from simulating a house with the thermostat's thermal model and a
+heater switched around a day/night target, read at the thermometer's resolution. Weather
+observations are hourly with all the columns the weather collector records, and a forecast
+run of the next forecast_hours hours is made every forecast_interval seconds.
+
+The databases are written with the collectors' own setup and insert functions, so they have
+the same layout as the real ones. The manifest records the collectors' schema versions, so a
+data directory is generated again after a layout change rather than reused.
+
+Usage: generate_data.py [data_dir [years]]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import datetime
+import logging
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ["common", "control", "thermometer", "weather", "forecast"]:
+	sys.path.insert(0, os.path.join(root, directory))
+import query_temp
+import weather
+import query_forecast
+from model import ThermalModel
+
+_logger = logging.getLogger(__name__)
+
+# the settings and schema versions a data directory was generated with, to tell whether it
+# can be reused
+manifest_name = "manifest.json"
+
+defaults = {
+	'years': 3,
+	# the first day of the data, local time
+	'start': "2014-01-01",
+	'room_interval': 60,
+	'weather_interval': 60 * 60,
+	'forecast_interval': 3 * 60 * 60,
+	'forecast_hours': 36,
+	'seed': 0,
+}
+
+
+def schema_versions():
+	"""The layout of each database, so data written by an older collector is regenerated"""
+	return {
+		'therm.db': query_temp.schema_version,
+		'forecast.db': query_forecast.schema_version,
+		# weather.db has no version of its own
+		'weather.db': weather.reading_columns,
+	}
+
+
+def outdoor_temperatures(times, seed=0):
+	"""The outdoor temperature at each of times, seconds since the epoch in time order"""
+	rng = random.Random(seed)
+	temperatures = []
+	noise = 0.0
+	last_time = None
+	for t in times:
+		local = datetime.datetime.fromtimestamp(t)
+		day_of_year = local.timetuple().tm_yday
+		hour = local.hour + local.minute / 60.0
+		# coldest in mid January, warmest mid afternoon
+		seasonal = 60 - 20 * math.cos(2 * math.pi * (day_of_year - 15) / 365.0)
+		daily = -8 * math.cos(2 * math.pi * (hour - 3) / 24.0)
+		# noise that drifts over a day or so
+		if last_time is not None:
+			decay = math.exp(-(t - last_time) / 86400.0)
+			noise = noise * decay + rng.gauss(0, 6) * math.sqrt(1 - decay ** 2)
+		last_time = t
+		temperatures.append(seasonal + daily + noise)
+	return temperatures
+
+
+def target_temperature(t):
+	"""68 from 6am to 10pm and 62 overnight"""
+	hour = datetime.datetime.fromtimestamp(t).hour
+	return 68 if 6 <= hour < 22 else 62
+
+
+def room_temperatures(times, outdoor, seed=0):
+	"""The room temperature at each of times, with the heater keeping it within a degree of
+	target_temperature(), as the thermometer reads it"""
+	rng = random.Random(seed + 1)
+	model = ThermalModel(1 / (6 * 60 * 60.), 5 / (60 * 60.))
+	temperature = 65.0
+	heater_on = False
+	readings = []
+	for i, t in enumerate(times):
+		if i:
+			temperature = model.predict(temperature, outdoor[i - 1], heater_on, t - times[i - 1])
+		target = target_temperature(t)
+		if temperature < target - 1:
+			heater_on = True
+		elif temperature > target + 1:
+			heater_on = False
+		# the thermometer reads to 1/16 of a degree
+		readings.append(round((temperature + rng.gauss(0, 0.05)) * 16) / 16)
+	return readings
+
+
+def weather_rows(times, outdoor, seed=0):
+	"""Rows of weather.reading_columns for each of times"""
+	rng = random.Random(seed + 2)
+	rows = []
+	for t, temperature in zip(times, outdoor):
+		wind = rng.choice([0, 0, 3, 5, 7, 10, 15])
+		dewpoint = temperature - rng.uniform(2, 20)
+		rows.append((
+			datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"),
+			"Calm" if wind == 0 else "S {}".format(wind),
+			10.0,
+			rng.choice(["Fair", "Overcast", "Light Rain", "Mostly Cloudy"]),
+			rng.choice(["CLR", "OVC070", "BKN050 OVC080", "FEW250"]),
+			round(temperature),
+			round(dewpoint),
+			int(100 * math.exp(0.06 * (dewpoint - temperature))),
+			round(temperature - wind / 2.0) if temperature < 50 and wind else None,
+			None,
+			30.0 + round(rng.gauss(0, 0.2), 2),
+			1016.0 + round(rng.gauss(0, 7), 1),
+			None))
+	return rows
+
+
+def generate(data_dir, **settings):
+	"""Writes therm.db, weather.db and forecast.db to data_dir, replacing any that are there
+
+	Takes the keys of defaults as keyword arguments. Returns the settings used.
+	"""
+	unknown = set(settings) - set(defaults)
+	if unknown:
+		raise ValueError("Unknown settings: {}".format(", ".join(sorted(unknown))))
+	settings = dict(defaults, **settings)
+	if not os.path.exists(data_dir):
+		os.makedirs(data_dir)
+	start = int(time.mktime(time.strptime(settings['start'], "%Y-%m-%d")))
+	end = start + int(settings['years'] * 365 * 86400)
+
+	# the room and outdoor temperatures, one per room reading
+	times = range(start, end, settings['room_interval'])
+	outdoor = outdoor_temperatures(times, settings['seed'])
+	room = room_temperatures(times, outdoor, settings['seed'])
+	_logger.info("Simulated {} room readings".format(len(times)))
+
+	db = query_temp.database_setup(os.path.join(data_dir, "therm.db"))
+	with db:
+		db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)", zip(times, room))
+	db.close()
+
+	# weather observations and forecasts take the outdoor temperature nearest their time
+	def outdoor_at(t):
+		return outdoor[min(len(outdoor) - 1, max(0, (t - start) // settings['room_interval']))]
+
+	weather_times = range(start, end, settings['weather_interval'])
+	db = sqlite3.connect(os.path.join(data_dir, "weather.db"))
+	weather.setup_table(db)
+	weather.append_rows(db, weather_rows(weather_times, [outdoor_at(t) for t in weather_times], settings['seed']))
+	db.close()
+	_logger.info("Wrote {} weather readings".format(len(weather_times)))
+
+	rng = random.Random(settings['seed'] + 3)
+	db = sqlite3.connect(os.path.join(data_dir, "forecast.db"))
+	query_forecast.setup_database(db)
+	runs = 0
+	for created in range(start, end, settings['forecast_interval']):
+		first_hour = created - created % 3600 + 3600
+		forecast_tuples = []
+		for hour in range(settings['forecast_hours']):
+			t = first_hour + hour * 3600
+			# forecasts get worse further ahead
+			error = rng.gauss(0, 1 + hour / 6.0)
+			forecast_tuples.append((datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"),
+			                        int(round(outdoor_at(t) + error))))
+		query_forecast.append_records(db, forecast_tuples,
+		                              datetime.datetime.utcfromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S"))
+		runs += 1
+	db.close()
+	_logger.info("Wrote {} forecast runs".format(runs))
+
+	with open(os.path.join(data_dir, manifest_name), "w") as f:
+		json.dump(dict(settings, schema_versions=schema_versions()), f, indent=2, sort_keys=True)
+	return settings
+
+
+def is_generated(data_dir, **settings):
+	"""Whether data_dir has databases generated with these settings, by the current collectors"""
+	try:
+		with open(os.path.join(data_dir, manifest_name)) as f:
+			return json.load(f) == dict(defaults, schema_versions=schema_versions(), **settings)
+	except (IOError, ValueError):
+		return False
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	data_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+	settings = {}
+	if len(sys.argv) > 2:
+		settings['years'] = float(sys.argv[2])
+	generate(data_dir, **settings)
+	print "Generated data in {}".format(data_dir)
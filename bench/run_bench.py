@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""Times the hot paths of the thermostat against synthetic multi-year data
+
+Each benchmark runs in its own python process, so its peak memory is its own and one
+benchmark's garbage doesn't slow the next. The results are written as json, and compared
+against a baseline file from an earlier run: rates (the *_per_sec metrics) should not drop and
+everything else (seconds, peak_rss_kb) should not rise by more than the tolerance.
+
+Usage:
+
+run_bench.py                          run everything, compare with baseline.json
+run_bench.py thermostat_iterate ...   run only some of the benchmarks
+run_bench.py --save-baseline          run everything and make the results the new baseline
+
+The data is generated with generate_data.py in bench/data the first time, and again whenever
+the settings change. The exit status is 1 if anything regressed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import sqlite3
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+for directory in ["common", "control", "thermometer", "weather", "forecast", "web"]:
+	sys.path.insert(0, os.path.join(root, directory))
+
+import generate_data
+
+default_data_dir = os.path.join(here, "data")
+default_results_path = os.path.join(here, "results.json")
+default_baseline_path = os.path.join(here, "baseline.json")
+
+# a result is a regression if it is this much worse than the baseline
+default_tolerance = 0.2
+
+# timed loops are repeated this many times and the best kept, to see past other load on the machine
+repeats = 3
+
+
+class FakeClock(object):
+	"""A clock set by the benchmark, as the tests use"""
+	the_time = 0
+
+	def time(self):
+		return self.the_time
+
+
+class FakeThermometer(object):
+	temperature = None
+
+
+class Timer(object):
+	"""Times a block: with Timer() as t: ...; t.seconds"""
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.seconds = time.time() - self._start
+
+
+def best_rate(count, function):
+	"""The best of repeats runs of function(), as count per second"""
+	best = None
+	for _ in range(repeats):
+		with Timer() as timer:
+			function()
+		best = timer.seconds if best is None else min(best, timer.seconds)
+	return count / best
+
+
+def room_readings(data_dir, count):
+	"""The first count temperatures of the generated therm.db"""
+	db = sqlite3.connect(os.path.join(data_dir, "therm.db"))
+	try:
+		return [row[0] for row in db.execute("SELECT temperature FROM temp ORDER BY read_time LIMIT ?", (count,))]
+	finally:
+		db.close()
+
+
+def copy_database(data_dir, name, directory):
+	path = os.path.join(directory, name)
+	shutil.copy(os.path.join(data_dir, name), path)
+	return path
+
+
+# #########################
+# the benchmarks. each takes the data directory and a scratch directory and returns a
+# dictionary of metrics.
+
+def bench_thermostat_iterate(data_dir, scratch, ticks=100000):
+	"""Thermostat.iterate() once a minute, on the generated room temperatures"""
+	from thermostat import Thermostat
+	from heater import AbstractHeater, HeaterCycleProtection
+
+	temperatures = room_readings(data_dir, ticks)
+
+	def run():
+		clock = FakeClock()
+		thermometer = FakeThermometer()
+		thermometer.temperature = temperatures[0]
+		thermostat = Thermostat(HeaterCycleProtection(AbstractHeater(), clock), thermometer, clock)
+		thermostat.set_target_temperature(66)
+		thermostat.set_mode('target')
+		for i, temperature in enumerate(temperatures):
+			clock.the_time = i * 60
+			thermometer.temperature = temperature
+			thermostat.iterate()
+
+	return {'ticks_per_sec': best_rate(len(temperatures), run)}
+
+
+def bench_heater_iterate(data_dir, scratch, ticks=200000):
+	"""HeaterCycleProtection.iterate() once a minute, asked to switch every ten minutes"""
+	from heater import AbstractHeater, HeaterCycleProtection
+
+	def run():
+		clock = FakeClock()
+		heater = HeaterCycleProtection(AbstractHeater(), clock)
+		for i in range(ticks):
+			clock.the_time = i * 60
+			if i % 10 == 0:
+				heater.set_to_on(i % 20 == 0)
+			heater.iterate()
+
+	return {'ticks_per_sec': best_rate(ticks, run)}
+
+
+def bench_simulation(data_dir, scratch, days=180):
+	"""Simulation.run() of a heating season in a modelled house, as the simulator tests do"""
+	import math
+	from model import ThermalModel
+	from simulator import Simulation, HouseSensor
+
+	def outdoor(t):
+		return 40 - 15 * math.cos(2 * math.pi * t / (365 * 86400.)) - 8 * math.cos(2 * math.pi * t / 86400.)
+
+	def run():
+		sensor = HouseSensor(ThermalModel(1 / (6 * 60 * 60.), 5 / (60 * 60.)), outdoor)
+		Simulation.for_target(sensor, 68).run(days * 86400)
+
+	# the heater logs every cycle
+	logging.disable(logging.INFO)
+	return {'simulated_days_per_sec': best_rate(days, run)}
+
+
+def bench_database_insert(data_dir, scratch, rows=2000):
+	"""query_temp.database_insert() into a copy of the multi-year therm.db, a commit per row"""
+	import query_temp
+	db = query_temp.database_connect(copy_database(data_dir, "therm.db", scratch))
+	read_time = db.execute("SELECT max(read_time) FROM temp").fetchone()[0]
+
+	def run():
+		for i in range(rows):
+			query_temp.database_insert(db, 68.0, read_time + i)
+
+	result = {'rows_per_sec': best_rate(rows, run)}
+	db.close()
+	return result
+
+
+def bench_weather_append(data_dir, scratch, calls=200, page_rows=72):
+	"""weather.append_records() as the collector calls it: a page of observations an hour,
+	all but one of them already recorded"""
+	import pandas as pd
+	import weather
+	db = sqlite3.connect(copy_database(data_dir, "weather.db", scratch))
+	rows = db.execute("SELECT {} FROM readings ORDER BY datetime DESC LIMIT ?".format(
+	    ", ".join(weather.reading_columns)), (page_rows,)).fetchall()
+	page = pd.DataFrame(list(reversed(rows)), columns=weather.reading_columns)
+	page['datetime'] = pd.to_datetime(page['datetime'])
+	pages = []
+	for i in range(calls * repeats):
+		pages.append(page.assign(datetime=page['datetime'] + pd.Timedelta(hours=i + 1)))
+	pages.reverse()
+
+	def run():
+		for _ in range(calls):
+			weather.append_records(db, pages.pop())
+
+	result = {'rows_per_sec': best_rate(calls * page_rows, run)}
+	db.close()
+	return result
+
+
+def bench_forecast_append(data_dir, scratch, runs=500):
+	"""query_forecast.append_records() of new runs into a copy of the multi-year forecast.db"""
+	import query_forecast
+	db = sqlite3.connect(copy_database(data_dir, "forecast.db", scratch))
+	run_id = db.execute("SELECT max(run_id) FROM forecast_runs").fetchone()[0]
+	forecast_tuples = list(db.execute("SELECT forecast_datetime, temperature FROM forecasts WHERE run_id=?", (run_id,)))
+	create_datetime = db.execute("SELECT create_datetime FROM forecast_runs WHERE run_id=?", (run_id,)).fetchone()[0]
+
+	def run():
+		for _ in range(runs):
+			query_forecast.append_records(db, forecast_tuples, create_datetime)
+
+	result = {'runs_per_sec': best_rate(runs, run),
+	          'rows_per_run': len(forecast_tuples)}
+	db.close()
+	return result
+
+
+def bench_prep_web_data(data_dir, scratch):
+	"""prep_web_data.py end to end: load the three databases and write data.tsv"""
+	import prep_web_data
+	with Timer() as timer:
+		room = prep_web_data.load_room(sqlite3.connect(os.path.join(data_dir, "therm.db")))
+		weather = prep_web_data.load_weather(sqlite3.connect(os.path.join(data_dir, "weather.db")))
+		forecast = prep_web_data.load_forecast(sqlite3.connect(os.path.join(data_dir, "forecast.db")))
+		# export() reports the file it writes
+		stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+		try:
+			prep_web_data.export([room, weather, forecast], scratch)
+		finally:
+			sys.stdout = stdout
+	return {'seconds': timer.seconds}
+
+
+benchmarks = OrderedDict((name[len("bench_"):], function) for name, function in sorted(globals().items())
+                         if name.startswith("bench_"))
+
+
+def run_child(name, data_dir):
+	"""Runs one benchmark in this process and returns its metrics, with the peak memory use"""
+	scratch = tempfile.mkdtemp()
+	try:
+		result = benchmarks[name](data_dir, scratch)
+	finally:
+		shutil.rmtree(scratch)
+	result['peak_rss_kb'] = peak_rss_kb()
+	return result
+
+
+def peak_rss_kb():
+	"""The peak memory use of this process in kilobytes"""
+	# ru_maxrss carries over from the parent process on linux, so it is only used where
+	# /proc isn't available. it is in kilobytes on linux but bytes on mac.
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])
+	except IOError:
+		pass
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+def run(names, data_dir):
+	"""Runs each of the named benchmarks in a new process. Returns the results document."""
+	results = OrderedDict()
+	for name in names:
+		output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name,
+		                                  "--data-dir", data_dir])
+		results[name] = json.loads(output)
+		print "{:20} {}".format(name, format_metrics(results[name]))
+	with open(os.path.join(data_dir, generate_data.manifest_name)) as f:
+		data = json.load(f)
+	return OrderedDict([
+		('time', time.strftime("%Y-%m-%d %H:%M:%S")),
+		('python', platform.python_version()),
+		('machine', platform.node()),
+		('data', data),
+		('results', results),
+	])
+
+
+def format_metrics(metrics):
+	return ", ".join("{} {:.4g}".format(key, value) for key, value in sorted(metrics.items()))
+
+
+def higher_is_better(metric):
+	return metric.endswith("_per_sec")
+
+
+def compare(results, baseline, tolerance=default_tolerance):
+	"""Compares two results documents
+
+	Returns a list of (benchmark, metric, baseline value, value, change, regressed), where
+	change is the fractional change and regressed whether it is worse than the tolerance.
+	Metrics missing from either document are skipped.
+	"""
+	comparison = []
+	for name, metrics in results['results'].items():
+		for metric, value in sorted(metrics.items()):
+			base = baseline['results'].get(name, {}).get(metric)
+			if not base:
+				continue
+			change = (value - base) / float(base)
+			worse = -change if higher_is_better(metric) else change
+			comparison.append((name, metric, base, value, change, worse > tolerance))
+	return comparison
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Times the thermostat's hot paths")
+	parser.add_argument("names", nargs="*", metavar="benchmark", help="one of: " + ", ".join(benchmarks))
+	parser.add_argument("--data-dir", default=default_data_dir)
+	parser.add_argument("--years", type=float, default=generate_data.defaults['years'],
+	                    help="years of data to generate")
+	parser.add_argument("--output", default=default_results_path)
+	parser.add_argument("--baseline", default=default_baseline_path)
+	parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file")
+	parser.add_argument("--tolerance", type=float, default=default_tolerance)
+	parser.add_argument("--child", help=argparse.SUPPRESS)
+	args = parser.parse_args(argv[1:])
+
+	if args.child:
+		# the benchmarks provoke warnings, e.g. from the heater's cycle protection
+		logging.basicConfig(level=logging.ERROR)
+		print json.dumps(run_child(args.child, args.data_dir))
+		return 0
+
+	unknown = [name for name in args.names if name not in benchmarks]
+	if unknown:
+		parser.error("Unknown benchmark: {}".format(", ".join(unknown)))
+	if not generate_data.is_generated(args.data_dir, years=args.years):
+		print "Generating {} years of data in {}".format(args.years, args.data_dir)
+		generate_data.generate(args.data_dir, years=args.years)
+
+	results = run(args.names or list(benchmarks), args.data_dir)
+	with open(args.output, "w") as f:
+		json.dump(results, f, indent=2)
+	print "Wrote {}".format(args.output)
+
+	if args.save_baseline:
+		shutil.copy(args.output, args.baseline)
+		print "Saved as the baseline in {}".format(args.baseline)
+		return 0
+	if not os.path.exists(args.baseline):
+		print "No baseline to compare with at {}".format(args.baseline)
+		return 0
+	with open(args.baseline) as f:
+		baseline = json.load(f)
+	if baseline.get('data') != results['data']:
+		print "Warning: the baseline was run on different data: {}".format(baseline.get('data'))
+	regressions = 0
+	for name, metric, base, value, change, regressed in compare(results, baseline, args.tolerance):
+		print "{:20} {:14} {:12.4g} -> {:<12.4g} {:+6.1%}{}".format(name, metric, base, value, change,
+		                                                            "  REGRESSION" if regressed else "")
+		regressions += regressed
+	return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,68 @@
+import os
+import math
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import generate_data
+import run_bench
+
+
+class TestGenerateData(TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.data_dir = tempfile.mkdtemp()
+		generate_data.generate(cls.data_dir, years=0.02)
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.data_dir)
+
+	def count(self, name, table):
+		db = sqlite3.connect(os.path.join(self.data_dir, name))
+		try:
+			return db.execute("SELECT count(*) FROM {}".format(table)).fetchone()[0]
+		finally:
+			db.close()
+
+	def test_databases(self):
+		seconds = int(0.02 * 365 * 86400)
+		self.assertEquals(self.count("therm.db", "temp"), math.ceil(seconds / 60.))
+		self.assertEquals(self.count("weather.db", "readings"), math.ceil(seconds / 3600.))
+		self.assertEquals(self.count("forecast.db", "forecast_runs"), math.ceil(seconds / (3 * 3600.)))
+		self.assertEquals(self.count("forecast.db", "forecasts"), math.ceil(seconds / (3 * 3600.)) * 36)
+
+	def test_room_held_near_target(self):
+		temperatures = run_bench.room_readings(self.data_dir, 10000)
+		# the heater can't keep up on the coldest nights, but never overshoots
+		self.assertGreater(min(temperatures), 50)
+		self.assertLess(max(temperatures), 70)
+
+	def test_is_generated(self):
+		self.assertTrue(generate_data.is_generated(self.data_dir, years=0.02))
+		self.assertFalse(generate_data.is_generated(self.data_dir, years=3))
+		# data from before a schema change is regenerated
+		schema_versions = generate_data.schema_versions
+		generate_data.schema_versions = lambda: dict(schema_versions(), **{'therm.db': 1})
+		try:
+			self.assertFalse(generate_data.is_generated(self.data_dir, years=0.02))
+		finally:
+			generate_data.schema_versions = schema_versions
+
+	def test_benchmark(self):
+		result = run_bench.run_child('heater_iterate', self.data_dir)
+		self.assertGreater(result['ticks_per_sec'], 0)
+		self.assertGreater(result['peak_rss_kb'], 0)
+
+
+class TestCompare(TestCase):
+
+	def test_compare(self):
+		baseline = {'results': {'a': {'ticks_per_sec': 1000, 'seconds': 2.0}, 'b': {'seconds': 1.0}}}
+		results = {'results': {'a': {'ticks_per_sec': 700, 'seconds': 2.1}, 'c': {'seconds': 5.0}}}
+		comparison = run_bench.compare(results, baseline, tolerance=0.2)
+		self.assertEquals([(name, metric, regressed) for name, metric, _, _, _, regressed in comparison],
+		                  [('a', 'seconds', False), ('a', 'ticks_per_sec', True)])
+		self.assertAlmostEqual(comparison[1][4], -0.3)
@@ -0,0 +1,191 @@
+"""Conditional, cached HTTP fetching for the collectors
+
+The weather and forecast collectors run hourly, and the pages they read often haven't
+changed. CachedFetcher keeps the last response for each url on disk and asks the server
+whether it has changed (If-None-Match/If-Modified-Since), so an unchanged page costs a 304
+and the collector can skip parsing and writing to the database.
+
+A new response is only cached once the caller commits it, after it has been written to the
+database. A run that fails in between fetches the page as changed again next time, rather
+than skipping it as already seen. A page that comes back the same under a new ETag or
+Last-Modified is cached with them at once, as there is nothing to commit.
+
+Example use:
+
+import fetch
+
+fetcher = fetch.CachedFetcher()
+response = fetcher.fetch("http://w1.weather.gov/obhistory/KCLT.html")
+if response.changed:
+	save(parse(response.body))
+	fetcher.commit("http://w1.weather.gov/obhistory/KCLT.html")
+"""
+import os
+import time
+import zlib
+import json
+import socket
+import hashlib
+import httplib
+import logging
+import urlparse
+from collections import namedtuple
+
+default_cache_dir = os.path.expanduser("~/.cache/thermostat")
+
+# body is the page, from the cache if the server said it hadn't changed. changed is False if
+# the body is the same as the last time the url was fetched.
+Response = namedtuple('Response', ['body', 'changed', 'status'])
+
+
+class FetchError(IOError):
+	pass
+
+
+class CachedFetcher(object):
+	"""Fetches urls, keeping connections open and the last response for each url on disk"""
+
+	# seconds to wait for the server to connect or respond
+	timeout = 30
+	# attempts for each fetch, on connection errors and 5xx responses
+	attempts = 3
+	# seconds to wait after the first failed attempt, doubled after each one after that
+	retry_delay = 5
+	# redirects to follow for each fetch
+	max_redirects = 5
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, cache_dir=default_cache_dir, clock=time):
+		"""
+
+		:param cache_dir: the directory for the cached responses, created if needed
+		:param clock: provides .sleep(). This is only here to facilitate testing.
+		"""
+		self.cache_dir = cache_dir
+		self._clock = clock
+		self._connections = {}
+		# {url: (cache entry, body)} fetched but not yet committed
+		self._pending = {}
+
+	def fetch(self, url):
+		"""Returns a Response for the url. Call commit() once it has been handled to cache it.
+
+		Raises FetchError if the server can't be reached or doesn't answer with the page
+		within the attempts.
+		"""
+		cached = self._read_cache(url)
+		headers = {'Accept-Encoding': 'gzip'}
+		if cached.get('etag'):
+			headers['If-None-Match'] = cached['etag']
+		if cached.get('last_modified'):
+			headers['If-Modified-Since'] = cached['last_modified']
+
+		status, response_headers, body = self._request(url, headers)
+		if status == 304 and 'body' in cached:
+			self._logger.debug("Not modified: {}".format(url))
+			return Response(cached['body'], False, status)
+		if status != 200:
+			raise FetchError("HTTP {} for {}".format(status, url))
+
+		body_hash = hashlib.sha1(body).hexdigest()
+		entry = {'etag': response_headers.get('etag'),
+		         'last_modified': response_headers.get('last-modified'),
+		         'body_hash': body_hash}
+		if body_hash == cached.get('body_hash'):
+			# the page was already handled, and callers skip an unchanged one without
+			# committing, so cache the server's new validators now or it never sends a 304 again
+			self._pending.pop(url, None)
+			if entry != dict((key, cached.get(key)) for key in entry):
+				self._write_cache(url, entry, body)
+			return Response(body, False, status)
+		self._pending[url] = (entry, body)
+		return Response(body, True, status)
+
+	def commit(self, url):
+		"""Caches the response last fetched for the url, so the next fetch asks the server
+		whether it has changed since. Does nothing if there isn't a new one."""
+		pending = self._pending.pop(url, None)
+		if pending is not None:
+			self._write_cache(url, *pending)
+
+	def close(self):
+		for connection in self._connections.values():
+			connection.close()
+		self._connections = {}
+
+	def _request(self, url, headers):
+		"""Returns (status, headers, body), following redirects and retrying failures"""
+		for _ in range(self.max_redirects + 1):
+			status, response_headers, body = self._request_with_retries(url, headers)
+			if status not in (301, 302, 303, 307, 308) or 'location' not in response_headers:
+				return status, response_headers, body
+			url = urlparse.urljoin(url, response_headers['location'])
+		raise FetchError("Too many redirects for {}".format(url))
+
+	def _request_with_retries(self, url, headers):
+		delay = self.retry_delay
+		for attempt in range(1, self.attempts + 1):
+			try:
+				status, response_headers, body = self._request_once(url, headers)
+				if status < 500:
+					return status, response_headers, body
+				error = "HTTP {}".format(status)
+			except (socket.error, httplib.HTTPException, zlib.error) as e:
+				error = repr(e)
+			self._logger.warning("Attempt {} of {} for {} failed: {}".format(attempt, self.attempts, url, error))
+			if attempt < self.attempts:
+				self._clock.sleep(delay)
+				delay *= 2
+		raise FetchError("Failed to fetch {}: {}".format(url, error))
+
+	def _request_once(self, url, headers):
+		parts = urlparse.urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		connection = self._connections.get(key)
+		if connection is None:
+			connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+			connection = self._connections[key] = connection_class(parts.netloc, timeout=self.timeout)
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+		try:
+			connection.request("GET", path, headers=headers)
+			response = connection.getresponse()
+			body = response.read()
+		except Exception:
+			# the server may have closed a kept-alive connection, start over with a new one
+			connection.close()
+			del self._connections[key]
+			raise
+		response_headers = dict(response.getheaders())
+		if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+			connection.close()
+			del self._connections[key]
+		if response_headers.get('content-encoding') == 'gzip':
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		return response.status, response_headers, body
+
+	def _cache_path(self, url):
+		return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+	def _read_cache(self, url):
+		path = self._cache_path(url)
+		try:
+			with open(path + ".json") as f:
+				cached = json.load(f)
+			with open(path + ".body", "rb") as f:
+				cached['body'] = f.read()
+		except (IOError, ValueError):
+			return {}
+		return cached
+
+	def _write_cache(self, url, cached, body):
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		path = self._cache_path(url)
+		# write then rename, so an interrupted run never leaves a partial body
+		for suffix, data in [(".body", body), (".json", json.dumps(dict(cached, url=url)))]:
+			with open(path + suffix + ".tmp", "wb") as f:
+				f.write(data)
+			os.rename(path + suffix + ".tmp", path + suffix)
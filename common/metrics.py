@@ -0,0 +1,282 @@
+"""Counters, gauges and latency histograms for the thermostat's processes
+
+Each process records into the module's registry, and exposes it in the Prometheus text format
+over http with start_http_server(), or as a json snapshot file with write_snapshot().
+
+Recording is meant to be left on in the control loop: a counter increment is an attribute
+addition and a histogram observation a bisect into a short list of bucket bounds. There are
+no locks, so each metric should only be updated from one thread, which is how the processes
+use them. Readers only ever see a slightly stale value.
+
+Example use:
+
+import metrics
+
+reads = metrics.counter("thermometer_reads_total", "Thermometer reads")
+read_seconds = metrics.histogram("thermometer_read_seconds", "Thermometer read latency")
+
+start = time.time()
+...
+read_seconds.observe(time.time() - start)
+reads.inc()
+
+metrics.start_http_server(9102)
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+from collections import OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+# bucket upper bounds in seconds, from a fast sqlite commit to a slow web fetch
+default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter(object):
+	"""A count that only goes up"""
+	kind = "counter"
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def samples(self, name, labels):
+		yield name, labels, self.value
+
+
+class Gauge(object):
+	"""A value that is set, e.g. the latest temperature"""
+	kind = "gauge"
+
+	def __init__(self):
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def samples(self, name, labels):
+		yield name, labels, self.value
+
+
+class Histogram(object):
+	"""Counts of observations in fixed buckets, with their sum, for latencies"""
+	kind = "histogram"
+
+	def __init__(self, buckets=default_buckets):
+		self.buckets = tuple(sorted(buckets))
+		# one count per bucket, plus one for above the last
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def time(self):
+		"""A context manager that observes the seconds its block takes"""
+		return _Timer(self)
+
+	def samples(self, name, labels):
+		# the exposition format's buckets are cumulative
+		cumulative = 0
+		for bound, count in zip(self.buckets, self.counts):
+			cumulative += count
+			yield name + "_bucket", labels + (("le", _format_value(bound)),), cumulative
+		yield name + "_bucket", labels + (("le", "+Inf"),), self.count
+		yield name + "_sum", labels, self.sum
+		yield name + "_count", labels, self.count
+
+
+class _Timer(object):
+
+	def __init__(self, histogram):
+		self._histogram = histogram
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self._histogram.observe(time.time() - self._start)
+
+
+class Registry(object):
+	"""The metrics of a process, by name and labels"""
+
+	def __init__(self):
+		# name -> (kind, help, OrderedDict of labels -> metric)
+		self._families = OrderedDict()
+		self._lock = threading.Lock()
+
+	def counter(self, name, help, **labels):
+		return self._get(Counter, name, help, labels)
+
+	def gauge(self, name, help, **labels):
+		return self._get(Gauge, name, help, labels)
+
+	def histogram(self, name, help, buckets=default_buckets, **labels):
+		return self._get(lambda: Histogram(buckets), name, help, labels, Histogram.kind)
+
+	def _get(self, factory, name, help, labels, kind=None):
+		"""The metric of name with labels, created on first use. Call once and keep the
+		metric rather than calling this in a loop."""
+		kind = kind or factory.kind
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			if name not in self._families:
+				self._families[name] = (kind, help, OrderedDict())
+			family_kind, _, metrics = self._families[name]
+			if family_kind != kind:
+				raise ValueError("{} is a {}, not a {}".format(name, family_kind, kind))
+			if key not in metrics:
+				metrics[key] = factory()
+			return metrics[key]
+
+	def text(self):
+		"""All the metrics in the Prometheus text exposition format"""
+		lines = []
+		for name, kind, help, metrics in self._collect():
+			lines.append("# HELP {} {}".format(name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+			lines.append("# TYPE {} {}".format(name, kind))
+			for labels, metric in metrics:
+				for sample_name, sample_labels, value in metric.samples(name, labels):
+					lines.append("{}{} {}".format(sample_name, _format_labels(sample_labels), _format_value(value)))
+		return "\n".join(lines) + "\n"
+
+	def snapshot(self):
+		"""All the metrics as a dictionary that can be saved as json
+
+		Each name maps to its kind, help and a list of its samples as (sample name, labels, value).
+		"""
+		result = OrderedDict()
+		for name, kind, help, metrics in self._collect():
+			samples = []
+			for labels, metric in metrics:
+				for sample_name, sample_labels, value in metric.samples(name, labels):
+					samples.append((sample_name, OrderedDict(sample_labels), value))
+			result[name] = OrderedDict([('kind', kind), ('help', help), ('samples', samples)])
+		return result
+
+	def write_snapshot(self, path):
+		"""Writes snapshot() to path as json, replacing it in one step so readers never see half a file"""
+		document = OrderedDict([('time', time.time()), ('pid', os.getpid()), ('metrics', self.snapshot())])
+		tmp_path = "{}.tmp{}".format(path, os.getpid())
+		with open(tmp_path, "w") as f:
+			json.dump(document, f, indent=1)
+		os.rename(tmp_path, path)
+
+	def _collect(self):
+		with self._lock:
+			families = [(name, kind, help, list(metrics.items()))
+			            for name, (kind, help, metrics) in self._families.items()]
+		return families
+
+
+def _format_labels(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+	                                       .replace("\n", "\\n"))
+	                      for key, value in labels) + "}"
+
+
+def _format_value(value):
+	if isinstance(value, bool):
+		return "1" if value else "0"
+	if isinstance(value, float):
+		if value != value:
+			return "NaN"
+		if value in (float("inf"), float("-inf")):
+			return "+Inf" if value > 0 else "-Inf"
+		return repr(value)
+	return str(value)
+
+
+# the registry of this process
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+write_snapshot = registry.write_snapshot
+
+
+def database_metrics(db):
+	"""The (commit latency histogram, rows written counter) of one of the databases, e.g. 'therm'"""
+	return (histogram("db_commit_seconds", "Time to write and commit a batch of rows", db=db),
+	        counter("db_rows_written_total", "Rows written and committed", db=db))
+
+
+def collector_metrics(collector):
+	"""The (fetch latency histogram, bytes fetched counter, parse latency histogram) of a collector"""
+	return (histogram("collector_fetch_seconds", "Time to fetch the source", collector=collector),
+	        counter("collector_fetch_bytes_total", "Bytes fetched from the source", collector=collector),
+	        histogram("collector_parse_seconds", "Time to parse what was fetched", collector=collector))
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves the server's registry at /metrics"""
+
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/metrics", "/"):
+			self.send_error(404)
+			return
+		body = self.server.registry.text()
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		_logger.debug(format % args)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+
+	def __init__(self, address, registry=registry):
+		BaseHTTPServer.HTTPServer.__init__(self, address, MetricsRequestHandler)
+		self.registry = registry
+
+
+def start_http_server(port, address="", registry=registry):
+	"""Serves the metrics from a background thread. Returns the server."""
+	server = MetricsServer((address, port), registry)
+	thread = threading.Thread(target=server.serve_forever, name="metrics")
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def start_snapshots(path, interval=60, registry=registry):
+	"""Writes a snapshot to path every interval seconds from a background thread
+
+	Returns an Event that stops the snapshots when set.
+	"""
+	stopped = threading.Event()
+
+	def run():
+		while not stopped.is_set():
+			try:
+				registry.write_snapshot(path)
+			except Exception:
+				_logger.exception("Failed to write metrics snapshot")
+			stopped.wait(interval)
+
+	thread = threading.Thread(target=run, name="metrics snapshots")
+	thread.daemon = True
+	thread.start()
+	return stopped
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Copy the room, weather and forecast databases into a store
+
+Reads therm.db, weather.db and forecast.db (any that exist) from data_dir and adds their
+rows to the store, converting the times to seconds since the epoch. Rows already in the store
+are left alone, so it is safe to run again, e.g. to pick up rows added since the last run.
+
+Usage: migrate_store.py data_dir [store_path]
+
+The store defaults to thermostat.db in data_dir.
+"""
+import os
+import sys
+import sqlite3
+import logging
+
+import store
+
+_logger = logging.getLogger(__name__)
+
+# the fields of a weather reading other than the time and temperature, kept as attrs
+weather_attrs = ['wind_mph', 'vis_mi', 'weather', 'sky', 'dewpoint_f', 'humidity', 'wind_chill_f', 'heat_index_f',
+                 'pressure_in', 'pressure_mb', 'precipitation']
+
+
+def migrate(s, therm_path=None, weather_path=None, forecast_path=None):
+	"""Adds the rows of each of the databases given to the Store s
+
+	Returns a dictionary of the number of rows added for each source.
+	"""
+	added = {}
+	if therm_path is not None:
+		added['room'] = migrate_room(s, therm_path)
+	if weather_path is not None:
+		added['weather'] = migrate_weather(s, weather_path)
+	if forecast_path is not None:
+		added['forecast'] = migrate_forecast(s, forecast_path)
+	return added
+
+
+def migrate_room(s, therm_path):
+	"""Copies the temp table, in a single statement"""
+	db = s.db
+	db.execute("ATTACH DATABASE ? AS therm", (therm_path,))
+	try:
+		version = db.execute("PRAGMA therm.user_version").fetchone()[0]
+		# version 2 stores seconds since the epoch, version 1 local time text
+		ts = "read_time" if version >= 2 else "CAST(strftime('%s', read_time, 'utc') AS INTEGER)"
+		changes = db.total_changes
+		with db:
+			db.execute("""
+			INSERT OR IGNORE INTO series(source, run_id, ts, value)
+			SELECT 'room', 0, {}, temperature FROM therm.temp
+			""".format(ts))
+		added = db.total_changes - changes
+	finally:
+		db.execute("DETACH DATABASE therm")
+	_logger.info("Added {} room readings".format(added))
+	return added
+
+
+def migrate_weather(s, weather_path):
+	"""Copies the readings table, with the fields other than the temperature as attrs"""
+	weather = sqlite3.connect(weather_path)
+	weather.row_factory = sqlite3.Row
+	rows = weather.execute("""
+	SELECT CAST(strftime('%s', datetime, 'utc') AS INTEGER) AS ts, temperature_f, {} FROM readings
+	""".format(", ".join(weather_attrs))).fetchall()
+	weather.close()
+	added = s.add('weather', [(row['ts'], row['temperature_f'],
+	                           dict((name, row[name]) for name in weather_attrs if row[name] is not None))
+	                          for row in rows])
+	_logger.info("Added {} weather readings".format(added))
+	return added
+
+
+def migrate_forecast(s, forecast_path):
+	"""Copies each forecast run. Forecast times are local time, run times UTC."""
+	forecast = sqlite3.connect(forecast_path)
+	if forecast.execute("PRAGMA user_version").fetchone()[0] >= 2:
+		rows = forecast.execute("""
+		SELECT CAST(strftime('%s', create_datetime) AS INTEGER), CAST(strftime('%s', forecast_datetime, 'utc') AS INTEGER),
+		  temperature
+		FROM forecast_runs JOIN forecasts USING (run_id) ORDER BY run_id
+		""").fetchall()
+	else:
+		rows = forecast.execute("""
+		SELECT CAST(strftime('%s', create_datetime) AS INTEGER), CAST(strftime('%s', forecast_datetime, 'utc') AS INTEGER),
+		  temperature
+		FROM forecasts ORDER BY create_datetime
+		""").fetchall()
+	forecast.close()
+	runs = {}
+	for created_ts, ts, temperature in rows:
+		runs.setdefault(created_ts, []).append((ts, temperature))
+	count = "SELECT count(*) FROM series WHERE source='forecast'"
+	before = s.db.execute(count).fetchone()[0]
+	for created_ts in sorted(runs):
+		s.add_run('forecast', runs[created_ts], created_ts)
+	added = s.db.execute(count).fetchone()[0] - before
+	_logger.info("Added {} forecast runs".format(len(runs)))
+	return added
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	if len(sys.argv) < 2:
+		sys.exit(__doc__)
+	data_dir = sys.argv[1]
+	s = store.connect(sys.argv[2] if len(sys.argv) > 2 else os.path.join(data_dir, "thermostat.db"))
+	paths = {}
+	for name, file_name in [('therm_path', "therm.db"), ('weather_path', "weather.db"), ('forecast_path', "forecast.db")]:
+		path = os.path.join(data_dir, file_name)
+		if os.path.exists(path):
+			paths[name] = path
+	for source, count in sorted(migrate(s, **paths).items()):
+		print "{}: {} rows added".format(source, count)
@@ -0,0 +1,198 @@
+"""The latest thermometer reading, shared through a small memory-mapped file
+
+The sampler writes each reading into the file and the control loop reads it back, without
+a database query, a socket round trip or a lock that the writer could hold. The file is one
+fixed-layout record:
+
+	header: magic, layout version
+	record: sequence number, time, temperature, status, crc32 of time, temperature and status
+
+Writes follow a seqlock protocol: the sequence number is made odd, the fields are written and
+the sequence number is made even again. A reader copies the record and retries if the
+sequence number was odd or changed while it copied. The checksum catches a torn copy on
+processors that may reorder the writer's stores, where python has no memory barrier to
+offer.
+
+Example use:
+
+# in the sampler
+writer = ReadingWriter("/tmp/thermometer.reading")
+writer.write(68.5)
+
+# in the control loop
+thermometer = MappedThermometer("/tmp/thermometer.reading")
+thermostat = Thermostat(heater, thermometer)
+"""
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+
+default_path = "/tmp/thermometer.reading"
+
+header_format = struct.Struct('<8sI4x')
+record_format = struct.Struct('<QddII4x')
+checked_format = struct.Struct('<ddI')
+file_magic = 'THRMREAD'
+file_version = 1
+file_size = header_format.size + record_format.size
+
+# status of a reading
+OK, READ_ERROR, STOPPED = range(3)
+statuses = ['ok', 'read error', 'stopped']
+
+
+class ReadingError(IOError):
+	"""The file isn't a reading channel, or a consistent record couldn't be read"""
+	pass
+
+
+def _checksum(the_time, temperature, status):
+	return zlib.crc32(checked_format.pack(the_time, temperature, status)) & 0xffffffff
+
+
+class ReadingWriter(object):
+	"""Writes readings into the channel file, creating it if needed. Only one process should write."""
+
+	def __init__(self, path=default_path, clock=time):
+		self._clock = clock
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			if os.fstat(fd).st_size != file_size:
+				os.ftruncate(fd, file_size)
+			self._map = mmap.mmap(fd, file_size)
+		finally:
+			os.close(fd)
+		magic, version = header_format.unpack_from(self._map, 0)
+		if magic != file_magic or version != file_version:
+			header_format.pack_into(self._map, 0, file_magic, file_version)
+			record_format.pack_into(self._map, header_format.size, 0, 0.0, float('nan'), STOPPED,
+			                        _checksum(0.0, float('nan'), STOPPED))
+		self._sequence = record_format.unpack_from(self._map, header_format.size)[0]
+		# a writer that died mid-write leaves the sequence number odd
+		self._sequence += self._sequence % 2
+
+	def write(self, temperature, status=OK, the_time=None):
+		"""Publishes a reading. A failed read is written with status READ_ERROR and the last
+		good temperature, or NaN."""
+		if the_time is None:
+			the_time = self._clock.time()
+		temperature = float('nan') if temperature is None else float(temperature)
+		offset = header_format.size
+		self._sequence += 1
+		struct.pack_into('<Q', self._map, offset, self._sequence)
+		record_format.pack_into(self._map, offset, self._sequence, the_time, temperature, status,
+		                        _checksum(the_time, temperature, status))
+		self._sequence += 1
+		struct.pack_into('<Q', self._map, offset, self._sequence)
+
+	def close(self):
+		"""Marks the channel stopped, so readers stop trusting the last reading at once"""
+		self.write(None, STOPPED)
+		self._map.close()
+
+
+class ReadingReader(object):
+	"""Reads the latest record from the channel file"""
+
+	# copies to try before giving up, if the writer keeps getting in the way
+	max_attempts = 100
+
+	def __init__(self, path=default_path):
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			if os.fstat(fd).st_size < file_size:
+				raise ReadingError("{} is too small to be a reading channel".format(path))
+			# to notice when the file is replaced, e.g. /tmp was cleared and the sampler restarted
+			self.inode = os.fstat(fd).st_ino
+			self._map = mmap.mmap(fd, file_size, access=mmap.ACCESS_READ)
+		finally:
+			os.close(fd)
+		magic, version = header_format.unpack_from(self._map, 0)
+		if magic != file_magic or version != file_version:
+			raise ReadingError("{} is not a version {} reading channel".format(path, file_version))
+
+	def read(self):
+		"""The latest record as (sequence number, time, temperature, status)"""
+		offset = header_format.size
+		for _ in range(self.max_attempts):
+			sequence, the_time, temperature, status, checksum = record_format.unpack_from(self._map, offset)
+			if sequence % 2 or struct.unpack_from('<Q', self._map, offset)[0] != sequence:
+				continue
+			if checksum != _checksum(the_time, temperature, status):
+				continue
+			return sequence, the_time, temperature, status
+		raise ReadingError("No consistent reading after {} attempts".format(self.max_attempts))
+
+	def close(self):
+		self._map.close()
+
+
+class MappedThermometer(object):
+	"""A thermometer for Thermostat that reads the channel
+
+	.temperature is None, rather than the last value, when the reading can't be trusted: the
+	sampler reported a failed read or stopped, or the reading is more than max_age seconds
+	old. The thermostat turns the heater off when it has no temperature.
+
+	The file is mapped again if it is replaced, and after a read that couldn't be trusted, so a
+	restarted sampler is picked up. It is safe to read from more than one thread.
+	"""
+
+	# seconds after which a reading is too old to act on
+	max_age = 3 * 60
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, path=default_path, clock=time, max_age=None):
+		self._path = path
+		self._clock = clock
+		self._reader = None
+		self._lock = threading.Lock()
+		if max_age is not None:
+			self.max_age = max_age
+		# why the last read gave no temperature, to warn once rather than every iteration
+		self.fault = None
+
+	@property
+	def temperature(self):
+		with self._lock:
+			try:
+				if self._reader is not None and self._replaced():
+					self._close_reader()
+				if self._reader is None:
+					self._reader = ReadingReader(self._path)
+				_, the_time, temperature, status = self._reader.read()
+			except (IOError, OSError) as e:
+				return self._fail("unreadable", "no reading: {}".format(e))
+			if status != OK:
+				return self._fail(status, "sensor {}".format(statuses[status] if status < len(statuses) else status))
+			age = self._clock.time() - the_time
+			if age > self.max_age:
+				return self._fail("stale", "the reading is {:.0f} seconds old".format(age))
+			if self.fault is not None:
+				self._logger.info("Thermometer readings are back")
+				self.fault = None
+			return temperature
+
+	def _replaced(self):
+		try:
+			return os.stat(self._path).st_ino != self._reader.inode
+		except OSError:
+			return True
+
+	def _close_reader(self):
+		if self._reader is not None:
+			self._reader.close()
+			self._reader = None
+
+	def _fail(self, fault, message):
+		if fault != self.fault:
+			self._logger.warn("Not trusting the thermometer, {}".format(message))
+		self.fault = fault
+		# map the file afresh next time, in case the sampler has started over with a new one
+		self._close_reader()
+		return None
@@ -0,0 +1,177 @@
+"""One time-series store for the room, weather and forecast temperatures
+
+Every reading is a row of the series table: the source ('room', 'weather', 'forecast', or
+'heater' for the daemon's heater changes), the time as seconds since the epoch (UTC), the
+value and optionally a json object of the other fields that came with it. Forecasts also have a run_id, one per query of the forecast API,
+and latest_run points at the most recent run of each source. Everything else has run_id 0.
+
+The table is clustered on (source, run_id, ts), so a time range of one source is a single
+index scan, and select() gets a range of several sources in one query.
+
+Example use:
+
+import store
+
+s = store.connect("thermostat.db")
+s.add('room', [(time.time(), 68.5)])
+s.add_run('forecast', [(time.time() + 3600, 40)])
+for ts, source, value in s.select(['room', 'forecast'], start=time.time() - 86400):
+	...
+"""
+import json
+import time
+import sqlite3
+
+import metrics
+
+schema_version = 1
+
+_commit_seconds, _rows_written = metrics.database_metrics("store")
+
+
+def connect(db_path):
+	"""Opens the store at db_path, creating the tables if needed. Returns a Store."""
+	db = sqlite3.connect(db_path)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
+	setup(db)
+	return Store(db)
+
+
+def setup(db):
+	"""Creates the store's tables in a database, if they don't exist"""
+	db.execute("""
+	CREATE TABLE IF NOT EXISTS series(
+	  source TEXT NOT NULL,
+	  run_id INTEGER NOT NULL DEFAULT 0,
+	  ts INTEGER NOT NULL,
+	  value REAL,
+	  attrs TEXT,
+	  PRIMARY KEY (source, run_id, ts)) WITHOUT ROWID
+	""")
+	db.execute("""
+	CREATE TABLE IF NOT EXISTS runs(
+	  run_id INTEGER PRIMARY KEY,
+	  source TEXT NOT NULL,
+	  created_ts INTEGER NOT NULL,
+	  UNIQUE (source, created_ts))
+	""")
+	db.execute("""
+	CREATE TABLE IF NOT EXISTS latest_run(
+	  source TEXT PRIMARY KEY,
+	  run_id INTEGER NOT NULL REFERENCES runs(run_id))
+	""")
+	db.execute("PRAGMA user_version={}".format(schema_version))
+	db.commit()
+
+
+def local_epoch(dt):
+	"""Seconds since the epoch of a naive local datetime, as the weather and forecast collectors parse"""
+	return int(time.mktime(dt.timetuple()))
+
+
+class Store(object):
+
+	def __init__(self, db):
+		self.db = db
+
+	def add(self, source, rows):
+		"""Adds rows of (ts, value) or (ts, value, attrs) in one transaction
+
+		attrs is a dictionary of other fields, stored as json. Rows already in the store for
+		the same source and time are left as they are. Returns the number of rows added.
+		"""
+		return self._insert(source, 0, rows)
+
+	def add_run(self, source, rows, created_ts=None):
+		"""Adds rows as a new run of source, and makes it the latest. Returns the run_id.
+
+		Adding a run with the same created_ts as an existing one adds to that run.
+		"""
+		if created_ts is None:
+			created_ts = int(time.time())
+		started = time.time()
+		with self.db:
+			self.db.execute("INSERT OR IGNORE INTO runs(source, created_ts) VALUES(?, ?)", (source, created_ts))
+			run_id = self.db.execute("SELECT run_id FROM runs WHERE source=? AND created_ts=?",
+			                         (source, created_ts)).fetchone()[0]
+			self._insert(source, run_id, rows, commit=False)
+			self.db.execute("""
+			INSERT OR REPLACE INTO latest_run(source, run_id)
+			SELECT ?, max(run_id) FROM runs WHERE source=? AND created_ts=(SELECT max(created_ts) FROM runs WHERE source=?)
+			""", (source, source, source))
+		_commit_seconds.observe(time.time() - started)
+		return run_id
+
+	def _insert(self, source, run_id, rows, commit=True):
+		values = [(source, run_id, int(row[0]), row[1],
+		           json.dumps(row[2], sort_keys=True) if len(row) > 2 and row[2] is not None else None)
+		          for row in rows]
+		started = time.time()
+		changes = self.db.total_changes
+		self.db.executemany("INSERT OR IGNORE INTO series(source, run_id, ts, value, attrs) VALUES(?, ?, ?, ?, ?)",
+		                    values)
+		if commit:
+			self.db.commit()
+			_commit_seconds.observe(time.time() - started)
+		added = self.db.total_changes - changes
+		_rows_written.inc(added)
+		return added
+
+	def latest_run(self, source):
+		"""The run_id of the latest run of source, or None"""
+		row = self.db.execute("SELECT run_id FROM latest_run WHERE source=?", (source,)).fetchone()
+		return row[0] if row else None
+
+	def latest_ts(self, source):
+		"""The time of the newest row of source, of its latest run if it has runs, or None"""
+		return self.db.execute("SELECT max(ts) FROM series WHERE source=? AND "
+		                       "run_id=coalesce((SELECT run_id FROM latest_run WHERE source=?), 0)",
+		                       (source, source)).fetchone()[0]
+
+	def run_as_of(self, source, ts):
+		"""The run_id of the last run of source created at or before ts, or None"""
+		row = self.db.execute("SELECT max(run_id) FROM runs WHERE source=? AND created_ts <= ?", (source, ts)).fetchone()
+		return row[0]
+
+	def select(self, sources, start=None, end=None, runs=None):
+		"""Returns (ts, source, value) of the sources between start and end, in time order
+
+		Sources with runs give their latest run, or the run in the runs dictionary. All the
+		sources are read in one query, one index range scan each.
+		"""
+		if not sources:
+			return []
+		sql, params = self._range_query(sources, start, end, runs)
+		return self.db.execute(sql + " ORDER BY ts", params).fetchall()
+
+	def aligned(self, sources, start, end, step, runs=None):
+		"""The sources averaged over step second intervals from start to end, in one query
+
+		Returns a list of (ts, value of each source) with a row for every interval, and None
+		for a source with no value in an interval.
+		"""
+		start = int(start)
+		step = int(step)
+		count = int((end - start) // step) + 1
+		columns = dict((source, i) for i, source in enumerate(sources))
+		table = [[start + i * step] + [None] * len(sources) for i in range(count)]
+		if not sources:
+			return [tuple(row) for row in table]
+		sql, params = self._range_query(sources, start, start + count * step - 1, runs)
+		sql = "SELECT (ts - ?) / ?, source, avg(value) FROM ({}) GROUP BY 1, 2".format(sql)
+		for i, source, value in self.db.execute(sql, [start, step] + params):
+			table[i][columns[source] + 1] = value
+		return [tuple(row) for row in table]
+
+	def _range_query(self, sources, start, end, runs):
+		parts = []
+		params = []
+		for source in sources:
+			parts.append("""
+			SELECT ts, source, value FROM series
+			WHERE source = ? AND run_id = coalesce(?, (SELECT run_id FROM latest_run WHERE source = ?), 0)
+			AND ts BETWEEN ? AND ?""")
+			params.extend([source, (runs or {}).get(source), source,
+			               -2 ** 62 if start is None else int(start), 2 ** 62 if end is None else int(end)])
+		return " UNION ALL ".join(parts), params
@@ -0,0 +1,150 @@
+import gzip
+import shutil
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+from unittest import TestCase
+
+import fetch
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.slept = []
+
+	def sleep(self, seconds):
+		self.slept.append(seconds)
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves server.page with an ETag, gzipped when asked, after server.failures 500s"""
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		server = self.server
+		server.requests.append((self.path, dict(self.headers), self.client_address))
+		if server.failures > 0:
+			server.failures -= 1
+			return self.reply(500, "")
+		if self.path == "/moved":
+			return self.reply(302, "", {'Location': "/page"})
+		if self.path != "/page":
+			return self.reply(404, "")
+		etag = '"{}"'.format(server.version)
+		if self.headers.get('If-None-Match') == etag:
+			return self.reply(304, "", {'ETag': etag})
+		body = server.page
+		headers = {'ETag': etag}
+		if 'gzip' in self.headers.get('Accept-Encoding', ''):
+			compressed = StringIO()
+			with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+				f.write(body)
+			body = compressed.getvalue()
+			headers['Content-Encoding'] = 'gzip'
+		self.reply(200, body, headers)
+
+	def reply(self, status, body, headers=None):
+		self.send_response(status)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class TestCachedFetcher(TestCase):
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		self.server = PageServer(('localhost', 0), PageHandler)
+		self.server.page = "<html>" + "temperature " * 100 + "</html>"
+		self.server.version = 1
+		self.server.failures = 0
+		self.server.requests = []
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.start()
+		self.url = "http://localhost:{}/page".format(self.server.server_address[1])
+		self.clock = FakeClock()
+		self.fetcher = fetch.CachedFetcher(self.cache_dir, self.clock)
+
+	def tearDown(self):
+		self.fetcher.close()
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+		shutil.rmtree(self.cache_dir)
+
+	def test_not_modified(self):
+		response = self.fetcher.fetch(self.url)
+		self.assertEquals(response, (self.server.page, True, 200))
+		self.assertEquals(self.server.requests[0][1]['accept-encoding'], 'gzip')
+		self.fetcher.commit(self.url)
+		response = self.fetcher.fetch(self.url)
+		self.assertEquals(response, (self.server.page, False, 304))
+		self.assertEquals(self.server.requests[1][1]['if-none-match'], '"1"')
+		# one connection for both
+		self.assertEquals(self.server.requests[0][2], self.server.requests[1][2])
+
+	def test_changed(self):
+		self.fetcher.fetch(self.url)
+		self.fetcher.commit(self.url)
+		self.server.page = "<html>colder</html>"
+		self.server.version = 2
+		self.assertEquals(self.fetcher.fetch(self.url), ("<html>colder</html>", True, 200))
+
+	def test_same_body_new_etag(self):
+		self.fetcher.fetch(self.url)
+		self.fetcher.commit(self.url)
+		self.server.version = 2
+		self.assertEquals(self.fetcher.fetch(self.url), (self.server.page, False, 200))
+		# without a commit, as the collectors skip an unchanged page, the new ETag is cached
+		self.assertEquals(self.fetcher.fetch(self.url), (self.server.page, False, 304))
+		self.assertEquals(self.server.requests[2][1]['if-none-match'], '"2"')
+
+	def test_cache_on_disk(self):
+		self.fetcher.fetch(self.url)
+		self.fetcher.commit(self.url)
+		fetcher = fetch.CachedFetcher(self.cache_dir, self.clock)
+		self.assertEquals(fetcher.fetch(self.url).changed, False)
+		fetcher.close()
+
+	def test_not_committed(self):
+		# the caller failed to save the page, so it is still new on the next fetch
+		self.fetcher.fetch(self.url)
+		self.assertEquals(self.fetcher.fetch(self.url), (self.server.page, True, 200))
+		self.assertNotIn('if-none-match', self.server.requests[1][1])
+		self.fetcher.commit(self.url)
+		self.assertEquals(self.fetcher.fetch(self.url).changed, False)
+
+	def test_retries(self):
+		self.server.failures = 2
+		self.assertEquals(self.fetcher.fetch(self.url).status, 200)
+		self.assertEquals(self.clock.slept, [5, 10])
+
+	def test_gives_up(self):
+		self.server.failures = 3
+		with self.assertRaises(fetch.FetchError):
+			self.fetcher.fetch(self.url)
+		self.assertEquals(len(self.server.requests), 3)
+
+	def test_not_found(self):
+		with self.assertRaises(fetch.FetchError):
+			self.fetcher.fetch(self.url.replace("/page", "/missing"))
+		self.assertEquals(len(self.server.requests), 1)
+
+	def test_redirect(self):
+		self.assertEquals(self.fetcher.fetch(self.url.replace("/page", "/moved")).body, self.server.page)
+
+	def test_connection_refused(self):
+		self.fetcher.attempts = 2
+		with self.assertRaises(fetch.FetchError):
+			self.fetcher.fetch("http://localhost:1/page")
+		self.assertEquals(self.clock.slept, [5])
@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import urllib2
+import tempfile
+import threading
+from unittest import TestCase
+
+import metrics
+
+
+class TestRegistry(TestCase):
+
+	def setUp(self):
+		self.registry = metrics.Registry()
+
+	def test_counter_and_labels(self):
+		on = self.registry.counter("decisions_total", "Decisions", decision="on")
+		off = self.registry.counter("decisions_total", "Decisions", decision="off")
+		on.inc()
+		on.inc(2)
+		self.assertIs(self.registry.counter("decisions_total", "Decisions", decision="on"), on)
+		self.assertEquals(self.registry.text(),
+		                  '# HELP decisions_total Decisions\n'
+		                  '# TYPE decisions_total counter\n'
+		                  'decisions_total{decision="on"} 3\n'
+		                  'decisions_total{decision="off"} 0\n')
+		self.assertEquals(off.value, 0)
+
+	def test_kind_mismatch(self):
+		self.registry.counter("reads", "Reads")
+		with self.assertRaises(ValueError):
+			self.registry.gauge("reads", "Reads")
+
+	def test_histogram(self):
+		histogram = self.registry.histogram("read_seconds", "Reads", buckets=(0.1, 1))
+		for value in [0.05, 0.1, 0.5, 2]:
+			histogram.observe(value)
+		lines = self.registry.text().splitlines()
+		self.assertEquals(lines[2:], ['read_seconds_bucket{le="0.1"} 2',
+		                              'read_seconds_bucket{le="1"} 3',
+		                              'read_seconds_bucket{le="+Inf"} 4',
+		                              'read_seconds_sum 2.65',
+		                              'read_seconds_count 4'])
+
+	def test_timer(self):
+		histogram = self.registry.histogram("seconds", "Time")
+		with self.assertRaises(KeyError):
+			with histogram.time():
+				raise KeyError()
+		self.assertEquals(histogram.count, 1)
+
+	def test_label_escaping(self):
+		self.registry.gauge("temperature", "Temperature", room='the "den"\n').set(68.5)
+		self.assertIn('temperature{room="the \\"den\\"\\n"} 68.5', self.registry.text())
+
+	def test_snapshot(self):
+		self.registry.counter("reads_total", "Reads").inc()
+		directory = tempfile.mkdtemp()
+		try:
+			path = os.path.join(directory, "metrics.json")
+			self.registry.write_snapshot(path)
+			with open(path) as f:
+				snapshot = json.load(f)
+			self.assertEquals(os.listdir(directory), ["metrics.json"])
+		finally:
+			shutil.rmtree(directory)
+		self.assertEquals(snapshot['metrics']['reads_total'],
+		                  {'kind': "counter", 'help': "Reads", 'samples': [["reads_total", {}, 1]]})
+
+
+class TestMetricsServer(TestCase):
+
+	def test_endpoint(self):
+		registry = metrics.Registry()
+		registry.counter("reads_total", "Reads").inc(5)
+		server = metrics.MetricsServer(('localhost', 0), registry)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.start()
+		try:
+			response = urllib2.urlopen("http://localhost:{}/metrics".format(server.server_address[1]))
+			self.assertEquals(response.info()['Content-Type'], metrics.content_type)
+			self.assertIn("reads_total 5\n", response.read())
+			with self.assertRaises(urllib2.HTTPError):
+				urllib2.urlopen("http://localhost:{}/other".format(server.server_address[1]))
+		finally:
+			server.shutdown()
+			server.server_close()
+			thread.join()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+import reading_channel
+from reading_channel import ReadingWriter, ReadingReader, MappedThermometer, ReadingError
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.the_time = 1000
+
+	def time(self):
+		return self.the_time
+
+
+class TestReadingChannel(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "thermometer.reading")
+		self.clock = FakeClock()
+		self.writer = ReadingWriter(self.path, self.clock)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_write_and_read(self):
+		reader = ReadingReader(self.path)
+		self.assertEquals(reader.read()[3], reading_channel.STOPPED)
+		self.writer.write(68.5)
+		self.assertEquals(reader.read(), (2, 1000, 68.5, reading_channel.OK))
+		self.clock.the_time = 1005
+		self.writer.write(68.25)
+		self.assertEquals(reader.read(), (4, 1005, 68.25, reading_channel.OK))
+		reader.close()
+
+	def test_reopen_keeps_sequence(self):
+		self.writer.write(68.5)
+		self.writer.close()
+		writer = ReadingWriter(self.path, self.clock)
+		writer.write(69.0)
+		self.assertEquals(ReadingReader(self.path).read()[0], 6)
+
+	def test_write_in_progress(self):
+		self.writer.write(68.5)
+		reader = ReadingReader(self.path)
+		reader.max_attempts = 3
+		offset = reading_channel.header_format.size
+		# an odd sequence number, as if the writer stopped part way through
+		struct.pack_into('<Q', self.writer._map, offset, 3)
+		with self.assertRaises(ReadingError):
+			reader.read()
+		# fields changed under an even sequence number fail the checksum
+		struct.pack_into('<Q', self.writer._map, offset, 4)
+		struct.pack_into('<d', self.writer._map, offset + 16, 75.0)
+		with self.assertRaises(ReadingError):
+			reader.read()
+		self.writer.write(68.0)
+		self.assertEquals(reader.read()[2], 68.0)
+
+	def test_not_a_channel(self):
+		path = os.path.join(self.directory, "other")
+		with open(path, "w") as f:
+			f.write("x" * reading_channel.file_size)
+		with self.assertRaises(ReadingError):
+			ReadingReader(path)
+
+
+class TestMappedThermometer(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "thermometer.reading")
+		self.clock = FakeClock()
+		self.thermometer = MappedThermometer(self.path, self.clock, max_age=60)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_missing_file(self):
+		self.assertIsNone(self.thermometer.temperature)
+		writer = ReadingWriter(self.path, self.clock)
+		writer.write(68.5)
+		self.assertEquals(self.thermometer.temperature, 68.5)
+		self.assertIsNone(self.thermometer.fault)
+
+	def test_stale_and_failed_readings(self):
+		writer = ReadingWriter(self.path, self.clock)
+		writer.write(68.5)
+		self.clock.the_time = 1060
+		self.assertEquals(self.thermometer.temperature, 68.5)
+		self.clock.the_time = 1061
+		self.assertIsNone(self.thermometer.temperature)
+		self.assertEquals(self.thermometer.fault, "stale")
+		writer.write(68.5, reading_channel.READ_ERROR)
+		self.assertIsNone(self.thermometer.temperature)
+		writer.write(68.75)
+		self.assertEquals(self.thermometer.temperature, 68.75)
+		writer.close()
+		self.assertIsNone(self.thermometer.temperature)
+		self.assertEquals(self.thermometer.fault, reading_channel.STOPPED)
+
+	def test_file_replaced(self):
+		writer = ReadingWriter(self.path, self.clock)
+		writer.write(68.5)
+		self.assertEquals(self.thermometer.temperature, 68.5)
+		# the sampler is restarted after the file was deleted, and writes to a new one
+		os.remove(self.path)
+		writer = ReadingWriter(self.path, self.clock)
+		writer.write(70.0)
+		self.assertEquals(self.thermometer.temperature, 70.0)
+		os.remove(self.path)
+		self.assertIsNone(self.thermometer.temperature)
+		self.assertEquals(self.thermometer.fault, "unreadable")
@@ -0,0 +1,116 @@
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import store
+import migrate_store
+
+
+class TestStore(TestCase):
+
+	def setUp(self):
+		self.store = store.connect(":memory:")
+
+	def test_add(self):
+		self.assertEquals(self.store.add('room', [(100, 68.0), (160, 68.5)]), 2)
+		self.assertEquals(self.store.add('room', [(160, 99.0), (220, 69.0)]), 1)
+		self.assertEquals(self.store.select(['room']), [(100, 'room', 68.0), (160, 'room', 68.5), (220, 'room', 69.0)])
+
+	def test_attrs(self):
+		self.store.add('weather', [(100, 40, {'sky': "Clear", 'humidity': 55}), (200, 41)])
+		rows = self.store.db.execute("SELECT attrs FROM series ORDER BY ts").fetchall()
+		self.assertEquals(json.loads(rows[0][0]), {'sky': "Clear", 'humidity': 55})
+		self.assertIsNone(rows[1][0])
+
+	def test_select_range_and_sources(self):
+		self.store.add('room', [(100, 68), (200, 69), (300, 70)])
+		self.store.add('weather', [(150, 40), (250, 41)])
+		self.assertEquals(self.store.select(['room', 'weather'], start=150, end=250),
+		                  [(150, 'weather', 40), (200, 'room', 69), (250, 'weather', 41)])
+		self.assertEquals(self.store.select(['forecast']), [])
+		self.assertEquals(self.store.latest_ts('room'), 300)
+		self.assertIsNone(self.store.latest_ts('forecast'))
+
+	def test_runs(self):
+		first = self.store.add_run('forecast', [(1000, 40), (2000, 42)], created_ts=100)
+		second = self.store.add_run('forecast', [(2000, 45), (3000, 47)], created_ts=200)
+		self.assertEquals(self.store.latest_run('forecast'), second)
+		self.assertEquals([row[2] for row in self.store.select(['forecast'])], [45, 47])
+		self.assertEquals([row[2] for row in self.store.select(['forecast'], runs={'forecast': first})], [40, 42])
+		self.assertEquals(self.store.run_as_of('forecast', 150), first)
+		self.assertIsNone(self.store.run_as_of('forecast', 50))
+
+		# an older run added later doesn't replace the latest
+		self.store.add_run('forecast', [(1000, 30)], created_ts=50)
+		self.assertEquals(self.store.latest_run('forecast'), second)
+		self.assertEquals(self.store.latest_ts('forecast'), 3000)
+
+	def test_aligned(self):
+		self.store.add('room', [(0, 68), (30, 70), (60, 71), (180, 72)])
+		self.store.add('weather', [(60, 40)])
+		self.store.add_run('forecast', [(120, 45)])
+		self.assertEquals(self.store.aligned(['room', 'weather', 'forecast'], 0, 180, 60),
+		                  [(0, 69, None, None), (60, 71, 40, None), (120, None, None, 45), (180, 72, None, None)])
+
+	def test_one_index_scan_per_source(self):
+		sql, params = self.store._range_query(['room', 'weather'], 0, 100, None)
+		plan = " ".join(row[-1] for row in self.store.db.execute("EXPLAIN QUERY PLAN " + sql, params))
+		self.assertEqual(plan.count("USING PRIMARY KEY"), 2)
+		self.assertNotIn("SCAN TABLE series", plan.replace("SCAN TABLE series USING", ""))
+
+
+class TestMigrateStore(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.therm_path = os.path.join(self.directory, "therm.db")
+		therm = sqlite3.connect(self.therm_path)
+		therm.execute("CREATE TABLE temp(id INTEGER PRIMARY KEY, read_time INTEGER, temperature FLOAT)")
+		therm.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)", [(1000, 68.0), (1060, 68.5)])
+		therm.execute("PRAGMA user_version=2")
+		therm.commit()
+		therm.close()
+
+		self.weather_path = os.path.join(self.directory, "weather.db")
+		weather = sqlite3.connect(self.weather_path)
+		weather.execute("CREATE TABLE readings(datetime TIMESTAMP PRIMARY KEY, {}, temperature_f NUMERIC)".format(
+		    ", ".join(migrate_store.weather_attrs)))
+		weather.execute("INSERT INTO readings(datetime, sky, temperature_f) VALUES('2016-02-15 10:00:00', 'Clear', 40)")
+		weather.commit()
+		weather.close()
+
+		self.forecast_path = os.path.join(self.directory, "forecast.db")
+		forecast = sqlite3.connect(self.forecast_path)
+		forecast.execute("CREATE TABLE forecasts(create_datetime DATETIME, forecast_datetime DATETIME, temperature NUMERIC)")
+		forecast.executemany("INSERT INTO forecasts VALUES(?, ?, ?)", [
+		    ("2016-02-15 09:00:00", "2016-02-15 12:00:00", 45), ("2016-02-15 09:00:00", "2016-02-15 13:00:00", 46),
+		    ("2016-02-15 10:00:00", "2016-02-15 13:00:00", 47)])
+		forecast.commit()
+		forecast.close()
+
+		self.store = store.connect(os.path.join(self.directory, "thermostat.db"))
+
+	def tearDown(self):
+		self.store.db.close()
+		shutil.rmtree(self.directory)
+
+	def migrate(self):
+		return migrate_store.migrate(self.store, self.therm_path, self.weather_path, self.forecast_path)
+
+	def test_migrate(self):
+		self.assertEquals(self.migrate(), {'room': 2, 'weather': 1, 'forecast': 3})
+		self.assertEquals(self.store.select(['room']), [(1000, 'room', 68.0), (1060, 'room', 68.5)])
+		local = self.store.db.execute("SELECT CAST(strftime('%s', '2016-02-15 10:00:00', 'utc') AS INTEGER)").fetchone()[0]
+		self.assertEquals(self.store.select(['weather']), [(local, 'weather', 40)])
+		attrs = self.store.db.execute("SELECT attrs FROM series WHERE source='weather'").fetchone()[0]
+		self.assertEquals(json.loads(attrs), {'sky': "Clear"})
+		self.assertEquals([row[2] for row in self.store.select(['forecast'])], [47])
+		first = self.store.run_as_of('forecast', local - 3600)
+		self.assertEquals([row[2] for row in self.store.select(['forecast'], runs={'forecast': first})], [45, 46])
+
+	def test_migrate_again(self):
+		self.migrate()
+		self.assertEquals(self.migrate(), {'room': 0, 'weather': 0, 'forecast': 0})
@@ -0,0 +1,12 @@
+"""Puts the shared module directories on the path for the tests
+
+The programs in each directory find the modules they share when they are run as scripts. The
+modules that are imported as libraries leave the path to whatever imports them, which for the
+tests is this file.
+"""
+import os
+import sys
+
+root = os.path.dirname(os.path.abspath(__file__))
+for directory in ["common", "thermometer"]:
+	sys.path.insert(0, os.path.join(root, directory))
@@ -1,10 +1,20 @@
 from helpers import ThermostatException
 from heater import HeaterCycleProtection
 from thermostat import Thermostat
+from scheduler import DeadlineScheduler
+from decision_trace import DecisionTrace
+from model import ThermalModel
+from simulator import Simulation
+from journal import StateJournal
 
 __all__ = ['ThermostatException',
            'HeaterCycleProtection',
            'Thermostat',
+           'DeadlineScheduler',
+           'DecisionTrace',
+           'ThermalModel',
+           'Simulation',
+           'StateJournal',
            ]
 
 
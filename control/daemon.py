@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""Long-running thermostat daemon
+
+Usage: daemon.py target_temp [store_path]
+
+Reads the latest temperature that the sampler (thermometer/sampler.py) publishes in
+/tmp/thermometer.reading, and switches the heater relay through the relay service (pi/relay.py).
+Both must be running. The sampler records the readings. Heater changes are logged, and with a
+store_path recorded in the time-series store (common/store.py) as the 'heater' source, 1 for
+on and 0 for off.
+
+The thermostat's state, including when the heater last switched, is kept in thermostat.journal,
+so a restart doesn't lose the cycle protection.
+
+Send the process SIGUSR1 to write the recent thermostat decisions to decisions.trace, which can
+be read with decision_trace.py.
+
+Metrics are served in the Prometheus text format at http://localhost:9102/metrics and written to
+metrics.json every minute.
+"""
+import os
+import sys
+import Queue
+import signal
+import logging
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+if __name__ == '__main__':
+    # the shared modules and the relay client live next to this package
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.join(root, "common"))
+    sys.path.insert(0, os.path.join(root, "pi"))
+
+from helpers import Clock
+from heater import HeaterCycleProtection
+from thermostat import Thermostat
+from scheduler import DeadlineScheduler
+from decision_trace import DecisionTrace
+from journal import StateJournal
+import metrics
+
+metrics_port = 9102
+metrics_snapshot_path = "metrics.json"
+journal_path = "thermostat.journal"
+
+
+class LatestReading(object):
+    """A thermometer that reports the last temperature the daemon sampled, for a daemon given a
+    read_temperature function"""
+
+    def __init__(self):
+        self.temperature = None
+
+
+class ThermostatDaemon(object):
+    """Runs a Thermostat with sensor sampling, control decisions and persistence kept independent
+
+    Each of these runs in its own thread:
+     - sampling reads the thermometer every sample_interval seconds
+     - control iterates the thermostat when a new reading arrives or a deadline comes up
+     - persistence records readings and heater changes
+
+    Blocking calls (the thermometer read and the record calls) are handed to small, bounded
+    pools of worker threads. The control thread only ever touches in-memory state and the
+    heater, so a slow USB read or a locked database never delays a heater decision.
+
+    :param thermostat: the thermostat to run
+    :param read_temperature: a blocking function that returns the current temperature, which is
+    set as the thermostat's thermometer's .temperature, e.g. of a LatestReading. None if the
+    thermometer reads the temperature itself, like reading_channel.MappedThermometer. Sampling
+    then only wakes the control loop, and records nothing, as the sampler process does that.
+    :param record: an optional blocking function called as record(kind, the_time, value), where
+    kind is 'temperature' or 'heater'. It is always called from the same worker thread.
+    :param journal: an optional journal.StateJournal that the thermostat's state is recorded in
+    after every iteration. The control thread only appends to it, and the persistence thread
+    syncs it, so set its sync_interval to None.
+    """
+
+    # seconds between thermometer reads
+    sample_interval = 60
+    # seconds to wait for a thermometer read before giving up on that sample
+    sample_timeout = 10
+    # records waiting to be saved. if storage falls this far behind, new records are dropped
+    max_queued_records = 1000
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, thermostat, read_temperature=None, record=None, journal=None):
+        self.thermostat = thermostat
+        self._read_temperature = read_temperature
+        self._record = record
+        self.journal = journal
+        self._clock = thermostat.clock
+        self.scheduler = DeadlineScheduler(self._clock)
+        self._control = _RecordingController(self)
+
+        # a single worker each, so a hung device can't starve storage and the record function
+        # can keep a sqlite connection, which is tied to the thread that created it
+        self._device_pool = ThreadPool(1)
+        self._storage_pool = ThreadPool(1)
+        self._pending_read = None
+        self._records = Queue.Queue(self.max_queued_records)
+
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Starts the sampling, control and persistence threads"""
+        for name, target in [("sampling", self._run_sampling),
+                             ("control", self.scheduler.run),
+                             ("persistence", self._run_persistence)]:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stops the threads and saves any records still queued"""
+        self._stopped.set()
+        self.scheduler.stop()
+        for thread in self._threads:
+            thread.join(timeout)
+        self.persist_pending()
+        if self.journal is not None:
+            self.journal.close()
+        self._device_pool.terminate()
+        self._storage_pool.close()
+        self._storage_pool.join()
+
+    def sample_once(self):
+        """Reads the thermometer and passes the reading on to control and persistence
+
+        Returns the temperature, or None if the read failed or took too long. A read that
+        times out keeps running in the background, and no new read is started until it finishes.
+        """
+        if self._pending_read is None:
+            read = self._read_temperature or (lambda: self.thermostat.thermometer.temperature)
+            self._pending_read = self._device_pool.apply_async(read)
+        try:
+            temperature = self._pending_read.get(self.sample_timeout)
+        except TimeoutError:
+            self._logger.warn("Thermometer read took longer than {} seconds".format(self.sample_timeout))
+            return None
+        except Exception:
+            self._pending_read = None
+            self._logger.exception("Thermometer read failed")
+            return None
+        self._pending_read = None
+
+        if self._read_temperature is not None:
+            self.thermostat.thermometer.temperature = temperature
+        # don't run the thermostat until there is a first reading to act on. after that, a
+        # missing reading is acted on too, by turning the heater off.
+        if self._control in self.scheduler:
+            self.scheduler.notify_reading(self._control)
+        elif temperature is not None:
+            self.scheduler.add(self._control)
+        if self._read_temperature is not None:
+            self._queue_record("temperature", temperature)
+        return temperature
+
+    def persist_pending(self):
+        """Saves every queued record. Returns the number of records saved."""
+        saved = 0
+        while True:
+            try:
+                item = self._records.get_nowait()
+            except Queue.Empty:
+                return saved
+            self._persist(item)
+            saved += 1
+
+    def _run_sampling(self):
+        while not self._stopped.is_set():
+            self.sample_once()
+            self._stopped.wait(self.sample_interval)
+
+    def _run_persistence(self):
+        while not self._stopped.is_set():
+            if self.journal is not None:
+                self._sync_journal()
+            try:
+                # time out once in a while to notice when the daemon is stopped
+                item = self._records.get(timeout=1)
+            except Queue.Empty:
+                continue
+            self._persist(item)
+
+    def _sync_journal(self):
+        try:
+            self.journal.sync()
+        except Exception:
+            self._logger.exception("Failed to sync the state journal")
+
+    def _persist(self, item):
+        if self._record is None:
+            return
+        try:
+            self._storage_pool.apply(self._record, item)
+        except Exception:
+            self._logger.exception("Failed to record {}".format(item))
+
+    def _queue_record(self, kind, value):
+        try:
+            self._records.put_nowait((kind, self._clock.time(), value))
+        except Queue.Full:
+            self._logger.warn("Storage is behind, dropping {} record".format(kind))
+
+
+class _RecordingController(object):
+    """Iterates the daemon's thermostat and queues a record whenever the heater actually changes"""
+
+    def __init__(self, daemon):
+        self._daemon = daemon
+        self._heater_was_on = None
+
+    def iterate(self):
+        thermostat = self._daemon.thermostat
+        thermostat.iterate()
+        if hasattr(thermostat.heater, "is_actually_on"):
+            heater_is_on = thermostat.heater.is_actually_on()
+        else:
+            heater_is_on = thermostat.get_heater_is_on()
+        if heater_is_on != self._heater_was_on:
+            self._heater_was_on = heater_is_on
+            self._daemon._queue_record("heater", heater_is_on)
+        if self._daemon.journal is not None:
+            try:
+                self._daemon.journal.record(thermostat.get_state())
+            except Exception:
+                self._daemon._logger.exception("Failed to record the thermostat's state")
+
+    def next_deadline(self):
+        return self._daemon.thermostat.next_deadline()
+
+
+def main(argv):
+    if len(argv) < 2:
+        sys.exit(__doc__)
+    target_temp = float(argv[1])
+    store_path = argv[2] if len(argv) > 2 else None
+
+    import relay
+    import reading_channel
+    import store
+
+    clock = Clock()
+    # the relay service owns the heater's GPIO pin
+    remote_heater = relay.RemoteHeater()
+    try:
+        remote_heater.state()
+    except relay.RelayNotRunning as e:
+        sys.exit(str(e))
+    heater = HeaterCycleProtection(remote_heater, clock)
+    # the sampler publishes each reading, and the thermostat reads the latest when it iterates
+    thermostat = Thermostat(heater, reading_channel.MappedThermometer(clock=clock), clock)
+    # pick up the cycle protection and threshold timing from before a restart
+    journal = StateJournal(journal_path)
+    journal.sync_interval = None
+    state = journal.load()
+    if state is not None:
+        thermostat.set_state(state)
+    thermostat.set_target_temperature(target_temp)
+    # not set_mode(), which would iterate before there is a reading. the daemon starts iterating
+    # once the first reading arrives.
+    thermostat.current_mode = "target"
+    thermostat.trace = DecisionTrace()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: thermostat.trace.dump("decisions.trace"))
+    metrics.start_http_server(metrics_port)
+    metrics.start_snapshots(metrics_snapshot_path)
+
+    connection = {}
+
+    def record(kind, the_time, value):
+        logging.getLogger(__name__).info("Heater {}".format("on" if value else "off"))
+        if store_path is None:
+            return
+        # connect in the storage worker thread, which is the only thread that uses it
+        if "store" not in connection:
+            connection["store"] = store.connect(store_path)
+        connection["store"].add('heater', [(the_time, 1 if value else 0)])
+
+    daemon = ThermostatDaemon(thermostat, record=record, journal=journal)
+    daemon.start()
+    try:
+        while True:
+            # sleep in short steps so ctrl-c is noticed in python 2
+            threading.Event().wait(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop(timeout=5)
+        try:
+            remote_heater.set_to_on(False)
+        except IOError:
+            logging.getLogger(__name__).exception("Couldn't turn the heater off, the relay service is down")
+        remote_heater.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Fixed-size binary trace of thermostat decisions
+
+Every Thermostat.iterate() can record one entry in a DecisionTrace: the time, temperature,
+mode, thresholds, heater state and the decision taken. The trace is a preallocated ring
+buffer, so recording doesn't allocate or format anything, and only the most recent entries
+are kept. Dump it to a file when needed and read it back with this script:
+
+Usage: decision_trace.py dump_file
+"""
+import sys
+import struct
+
+
+# decisions a thermostat can take on an iteration
+decisions = ['none', 'turn on', 'turn off']
+NO_DECISION, TURN_ON, TURN_OFF = range(len(decisions))
+
+NAN = float('nan')
+
+
+class DecisionTrace(object):
+    """A ring buffer of the most recent thermostat decisions"""
+
+    # little-endian: time, temperature, threshold low, threshold high, mode, intended, actual, decision
+    record_format = struct.Struct('<ddddBBBB')
+    file_header = struct.Struct('<8sHHI')
+    file_magic = 'THRMTRCE'
+    file_version = 1
+
+    # same as Thermostat.available_modes
+    modes = ['off', 'on', 'target']
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity * self.record_format.size)
+        # total number of records ever written. the next record goes in slot _count % capacity
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def record(self, the_time, temperature, mode, threshold_low, threshold_high, intended_on, actually_on,
+               decision=NO_DECISION):
+        """Records one iteration. None values are stored as NaN."""
+        self.record_format.pack_into(
+            self._buffer, (self._count % self.capacity) * self.record_format.size,
+            the_time,
+            NAN if temperature is None else temperature,
+            NAN if threshold_low is None else threshold_low,
+            NAN if threshold_high is None else threshold_high,
+            self.modes.index(mode),
+            intended_on,
+            actually_on,
+            decision)
+        self._count += 1
+
+    def _ordered_bytes(self):
+        """The records from oldest to newest"""
+        buf = bytes(self._buffer)
+        if self._count <= self.capacity:
+            return buf[:self._count * self.record_format.size]
+        split = (self._count % self.capacity) * self.record_format.size
+        return buf[split:] + buf[:split]
+
+    def entries(self):
+        """Returns the records from oldest to newest as dictionaries"""
+        return list(_parse(self._ordered_bytes(), self.record_format, self.modes))
+
+    def dump(self, path):
+        """Writes the records from oldest to newest to a file. Read it back with read_trace()."""
+        data = self._ordered_bytes()
+        with open(path, 'wb') as f:
+            f.write(self.file_header.pack(self.file_magic, self.file_version, self.record_format.size,
+                                          len(data) // self.record_format.size))
+            f.write(data)
+
+
+def read_trace(path):
+    """Returns the records of a file written by DecisionTrace.dump() as dictionaries"""
+    with open(path, 'rb') as f:
+        header = f.read(DecisionTrace.file_header.size)
+        magic, version, record_size, count = DecisionTrace.file_header.unpack(header)
+        if magic != DecisionTrace.file_magic or version != DecisionTrace.file_version or \
+                record_size != DecisionTrace.record_format.size:
+            raise ValueError("Not a decision trace file: {}".format(path))
+        data = f.read(count * record_size)
+    return list(_parse(data, DecisionTrace.record_format, DecisionTrace.modes))
+
+
+def _parse(data, record_format, modes):
+    for offset in range(0, len(data), record_format.size):
+        the_time, temperature, low, high, mode, intended, actual, decision = \
+            record_format.unpack_from(data, offset)
+        yield {'time': the_time,
+               'temperature': _none_if_nan(temperature),
+               'threshold_low': _none_if_nan(low),
+               'threshold_high': _none_if_nan(high),
+               'mode': modes[mode],
+               'intended_on': bool(intended),
+               'actually_on': bool(actual),
+               'decision': decisions[decision],
+               }
+
+
+def _none_if_nan(value):
+    return None if value != value else value
+
+
+def format_entry(entry):
+    return "{time:.1f} mode={mode} temp={temperature} thresholds={threshold_low}/{threshold_high} " \
+           "heater={intended}/{actual} decision={decision}".format(
+            intended="on" if entry['intended_on'] else "off",
+            actual="on" if entry['actually_on'] else "off",
+            **entry)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    for entry in read_trace(sys.argv[1]):
+        print format_entry(entry)
@@ -1,6 +1,20 @@
 import logging
 
-from helpers import Clock, ThermostatException
+from helpers import Clock, ThermostatException, metrics
+
+# requests that cycle protection put off until later
+_deferrals = {
+    True: metrics.counter("heater_cycle_protection_deferrals_total",
+                          "Heater changes delayed by cycle protection", action="on"),
+    False: metrics.counter("heater_cycle_protection_deferrals_total",
+                           "Heater changes delayed by cycle protection", action="off"),
+}
+_switch_failures = metrics.counter("heater_switch_failures_total",
+                                  "Heater switches that failed, e.g. the relay service was down")
+_switches = {
+    True: metrics.counter("heater_switches_total", "Times the heater was actually switched", action="on"),
+    False: metrics.counter("heater_switches_total", "Times the heater was actually switched", action="off"),
+}
 
 
 class AbstractHeater(object):
@@ -24,6 +38,9 @@ class HeaterCycleProtection(object):
     minimum_on_time = 5 * 60  # 5 minutes
     minimum_off_time = 5 * 60  # 5 minutes
 
+    # a duration in seconds. if switching the heater fails, try again after this long
+    switch_retry_interval = 10
+
     # a time in the future. do not turn the heater on or off before reaching these times
     # None means it is safe to turn on/off at any time
     _no_turn_on_before = None
@@ -95,7 +112,13 @@ class HeaterCycleProtection(object):
             if not self._actually_on:
                 self._turn_on_time = max(self._no_turn_on_before, self._clock.time())
                 self._turn_off_time = None
-                self._logger.debug("Set to turn on at: {}".format(self._turn_on_time))
+                if self._turn_on_time > self._clock.time():
+                    _deferrals[True].inc()
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug("Set to turn on at: {}".format(self._turn_on_time))
+            # already running, cancel any pending shutdown
+            else:
+                self._turn_off_time = None
 
         # turning off
         else:
@@ -104,7 +127,59 @@ class HeaterCycleProtection(object):
             if self._actually_on:
                 self._turn_on_time = None
                 self._turn_off_time = max(self._no_turn_off_before, self._clock.time())
-                self._logger.debug("Set to turn off at: {}".format(self._turn_off_time))
+                if self._turn_off_time > self._clock.time():
+                    _deferrals[False].inc()
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug("Set to turn off at: {}".format(self._turn_off_time))
+            # already off, cancel any pending start
+            else:
+                self._turn_on_time = None
+
+    # the attributes that get_state() saves, without their leading underscore
+    _state_fields = ['intended_on', 'actually_on', 'on_since', 'off_since', 'no_turn_on_before',
+                     'no_turn_off_before', 'turn_on_time', 'turn_off_time']
+
+    def get_state(self):
+        """The cycle protection state as a dictionary, for saving and restoring with set_state()"""
+        return dict((name, getattr(self, "_" + name)) for name in self._state_fields)
+
+    def set_state(self, state):
+        """Restores a state from get_state(), e.g. after a restart
+
+        If the heater isn't in the state that was saved, it may have switched while nothing
+        was watching it, e.g. the relay lost power. It is then switched off and treated as
+        having just turned off, and the intended state is asked for again.
+        """
+        for name in self._state_fields:
+            setattr(self, "_" + name, state[name])
+        if self._heater.is_on() != self._actually_on:
+            self._logger.warn("Heater is {} but was saved as {}. Turning off.".format(
+                "on" if self._heater.is_on() else "off", "on" if self._actually_on else "off"))
+            self._turn_on_time = None
+            self._turn_off_time = None
+            self._no_turn_off_before = None
+            if not self._switch(False):
+                # it may still be on. _switch() has scheduled another try at turning it off.
+                self._actually_on = True
+                self._on_since = self._clock.time()
+                self._off_since = None
+                return
+            self._actually_on = False
+            self._on_since = None
+            self._off_since = self._clock.time()
+            self._no_turn_on_before = self._clock.time() + self.minimum_off_time
+            self.set_to_on(self._intended_on)
+
+    def next_deadline(self):
+        """The next time at which .iterate() has something to do, or None if nothing is scheduled.
+
+        The returned time may already have passed, in which case .iterate() should be called now.
+        """
+        deadlines = [self._turn_on_time, self._turn_off_time]
+        if self._on_since is not None and self._turn_off_time is None:
+            deadlines.append(self._on_since + self.maximum_on_time)
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
 
     def iterate(self):
 
@@ -120,7 +195,10 @@ class HeaterCycleProtection(object):
 
             # otherwise turn off
             self._logger.info("Reached turn off time. Turning off.")
-            self._heater.set_to_on(False)
+            if not self._switch(False):
+                return
+            _switches[False].inc()
+            self._actually_on = False
             self._turn_off_time = None
             self._turn_on_time = None
             self._on_since = None
@@ -142,7 +220,10 @@ class HeaterCycleProtection(object):
 
             # otherwise turn on
             self._logger.info("Reached turn on time. Turning on.")
-            self._heater.set_to_on(True)
+            if not self._switch(True):
+                return
+            _switches[True].inc()
+            self._actually_on = True
             self._turn_off_time = None
             self._turn_on_time = None
             self._on_since = self._clock.time()
@@ -152,10 +233,33 @@ class HeaterCycleProtection(object):
 
             already_handled = True
 
-        # if we passed the maximum on time
-        if self._on_since is not None and (self._clock.time() - self._on_since) >= self.maximum_on_time:
+        # if we passed the maximum on time and a shutdown isn't already scheduled
+        if self._on_since is not None and self._turn_off_time is None and \
+                (self._clock.time() - self._on_since) >= self.maximum_on_time:
             if already_handled:
                 raise ThermostatException("Already handled, this probably shouldn't be happening")
             self._logger.warn("Reached maximum consecutive on time. Scheduling for shutdown.")
-            self._heater.set_to_on(False)
+            self.set_to_on(False)
             self.iterate()
+
+    def _switch(self, on):
+        """Switches the underlying heater. Returns whether that worked.
+
+        If it failed, e.g. because the relay service is down, the heater's state is unknown.
+        The state it was last known to be in is kept, and the switch is tried again after
+        switch_retry_interval, so a turn off, including the one for the maximum on time, is
+        retried until it gets through.
+        """
+        try:
+            self._heater.set_to_on(on)
+            return True
+        except Exception:
+            _switch_failures.inc()
+            self._logger.exception("Failed to turn the heater {}. Will try again in {} seconds.".format(
+                "on" if on else "off", self.switch_retry_interval))
+            retry_time = self._clock.time() + self.switch_retry_interval
+            if on:
+                self._turn_on_time = retry_time
+            else:
+                self._turn_off_time = retry_time
+            return False
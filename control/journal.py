@@ -0,0 +1,184 @@
+"""Keeps the thermostat's state on disk, so a restarted daemon carries on where it left off
+
+Without it, a restart forgets when the heater last switched, and the only safe thing to do is
+wait out a whole cycle protection window. The state is kept in two files:
+
+ - the journal, path, which has a line appended for each change of state. Each line holds only
+   the top level keys that changed, with a sequence number and a checksum.
+ - the snapshot, path + ".snapshot", the whole state as of a sequence number. It is rewritten
+   every snapshot_every records, and the journal is emptied, so neither file grows.
+
+Appending a line is a write to the page cache, which survives the process crashing. Making it
+survive a power cut takes an fsync, which is slow on an SD card, so the journal is synced at
+most once every sync_interval seconds, or whenever sync() is called.
+
+load() rebuilds the state from the snapshot and the journal lines after it. A line cut short
+by a crash fails its checksum, and it and anything after it are dropped.
+
+Example use:
+
+journal = StateJournal("thermostat.journal")
+state = journal.load()
+if state is not None:
+    thermostat.set_state(state)
+...
+journal.record(thermostat.get_state())
+"""
+import os
+import json
+import time
+import zlib
+import logging
+import threading
+
+
+class StateJournal(object):
+    """An append-only journal of a json-able dictionary, with snapshots"""
+
+    # seconds between fsyncs of the journal. None to only sync when sync() is called.
+    sync_interval = 1.0
+    # journal records between snapshots
+    snapshot_every = 1000
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, path, clock=time):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self._clock = clock
+        # the state as of the latest record, and that record's sequence number
+        self._state = {}
+        self._sequence = 0
+        self._snapshot_sequence = 0
+        self._fd = None
+        self._dirty = False
+        self._last_sync = None
+        # held while writing the journal, not while syncing it
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Reads the state back from the files. Returns the state, or None if there isn't one.
+
+        record() calls this first if it hasn't been called.
+        """
+        state, sequence = {}, 0
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            state, sequence = snapshot['state'], snapshot['sequence']
+        except IOError:
+            pass
+        except (ValueError, KeyError):
+            self._logger.warn("Ignoring unreadable snapshot {}".format(self.snapshot_path))
+        self._snapshot_sequence = sequence
+
+        good_length = 0
+        replayed = 0
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    record = self._parse(line)
+                    if record is None:
+                        self._logger.warn("Dropping journal from byte {}, it was cut short".format(good_length))
+                        break
+                    good_length += len(line)
+                    if record['sequence'] <= sequence:
+                        # already in the snapshot
+                        continue
+                    state.update(record['changes'])
+                    sequence = record['sequence']
+                    replayed += 1
+        except IOError:
+            pass
+
+        self._open(good_length)
+        self._state, self._sequence = state, sequence
+        self._logger.info("Loaded state at record {}, {} from the journal".format(sequence, replayed))
+        return state or None
+
+    def record(self, state):
+        """Appends the changes since the last record. Does nothing if the state is unchanged."""
+        if self._fd is None:
+            self.load()
+        changes = dict((key, value) for key, value in state.items() if self._state.get(key, _missing) != value)
+        if not changes:
+            return
+        with self._lock:
+            self._sequence += 1
+            self._write_line(self._sequence, changes)
+            self._state = dict(self._state, **changes)
+            self._dirty = True
+        if self.sync_interval is not None and \
+                (self._last_sync is None or self._clock.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Makes the records durable, and writes a snapshot if one is due"""
+        if self._fd is None:
+            return
+        if self._dirty:
+            self._dirty = False
+            os.fsync(self._fd)
+        self._last_sync = self._clock.time()
+        if self._sequence - self._snapshot_sequence >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """Writes the whole state to the snapshot file and empties the journal"""
+        with self._lock:
+            state, sequence = dict(self._state), self._sequence
+        tmp_path = "{}.tmp{}".format(self.snapshot_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({'sequence': sequence, 'time': self._clock.time(), 'state': state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        _fsync_directory(self.snapshot_path)
+        self._snapshot_sequence = sequence
+        with self._lock:
+            # records made while the snapshot was written stay in the journal until the next one
+            if self._sequence == sequence:
+                os.ftruncate(self._fd, 0)
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def _open(self, length):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        # drop a line cut short by a crash, so new lines don't follow it
+        if os.fstat(self._fd).st_size > length:
+            os.ftruncate(self._fd, length)
+
+    def _write_line(self, sequence, changes):
+        body = json.dumps({'sequence': sequence, 'changes': changes}, sort_keys=True)
+        os.write(self._fd, "{:08x} {}\n".format(zlib.crc32(body) & 0xffffffff, body))
+
+    @staticmethod
+    def _parse(line):
+        """A journal line as a dictionary, or None if it is damaged or incomplete"""
+        if not line.endswith("\n"):
+            return None
+        checksum, _, body = line[:-1].partition(" ")
+        try:
+            if int(checksum, 16) != zlib.crc32(body) & 0xffffffff:
+                return None
+            return json.loads(body)
+        except ValueError:
+            return None
+
+
+_missing = object()
+
+
+def _fsync_directory(path):
+    """Makes a rename in path's directory durable"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,194 @@
+"""First-order thermal model of the house, fitted as readings arrive
+
+The room temperature T is modelled as
+
+    dT/dt = loss_rate * (outdoor - T) + heating_rate * heater_on
+
+loss_rate (per second) is how fast the house leaks heat to the outdoors and heating_rate
+(degrees per second) is how fast the heater warms it. Both are fitted with recursive least
+squares, so each reading updates the fit in constant time, and recent behaviour counts more
+than old through the forgetting factor. bulk_fit() fits the same model to a history of
+readings in one go, to start from the existing databases rather than from scratch.
+
+With a fitted model, heater_start_time() says when the heater must come on to reach a
+target temperature by a given time.
+"""
+import math
+import logging
+
+
+class ThermalModel(object):
+    # initial estimates, used until the fit has data: the house loses half its temperature
+    # difference to the outdoors in a few hours, and the heater adds a few degrees an hour
+    loss_rate = 1 / (4 * 60 * 60.)
+    heating_rate = 4 / (60 * 60.)
+    # weight of each update relative to the one before. 0.999 forgets with a time constant of
+    # about 1000 updates, about a week of 10 minute steps
+    forgetting_factor = 0.999
+    # initial uncertainty of the estimates, for steps of a few degrees over several minutes.
+    # larger values let the first updates move them further
+    initial_covariance = 1e-4
+    # readings are combined into steps of at least this many seconds, as the thermometer's
+    # resolution swamps the change over a minute
+    min_step = 10 * 60
+    # steps longer than this (after a gap in the readings) are not used
+    max_step = 60 * 60
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, loss_rate=None, heating_rate=None):
+        if loss_rate is not None:
+            self.loss_rate = loss_rate
+        if heating_rate is not None:
+            self.heating_rate = heating_rate
+        self.updates = 0
+        self._covariance = [[self.initial_covariance, 0.0], [0.0, self.initial_covariance]]
+        # the start of the current step: time, room and outdoor temperature
+        self._step_start = None
+        # seconds the heater has been on since the start of the step
+        self._heater_seconds = 0.0
+        self._last_time = None
+        self._last_heater_on = False
+
+    def update(self, the_time, temperature, outdoor_temperature, heater_on):
+        """Adds a reading. heater_on is whether the heater is on from now until the next reading."""
+        if self._last_time is not None:
+            self._heater_seconds += (the_time - self._last_time) * self._last_heater_on
+        self._last_time = the_time
+        self._last_heater_on = bool(heater_on)
+
+        if self._step_start is None:
+            self._start_step(the_time, temperature, outdoor_temperature)
+            return
+        start_time, start_temperature, start_outdoor = self._step_start
+        elapsed = the_time - start_time
+        if elapsed < self.min_step:
+            return
+        if elapsed <= self.max_step:
+            outdoor = (start_outdoor + outdoor_temperature) / 2.0
+            self._fit_step((outdoor - start_temperature) * elapsed, self._heater_seconds,
+                           temperature - start_temperature)
+        self._start_step(the_time, temperature, outdoor_temperature)
+
+    def _start_step(self, the_time, temperature, outdoor_temperature):
+        self._step_start = (the_time, temperature, outdoor_temperature)
+        self._heater_seconds = 0.0
+
+    def _fit_step(self, x0, x1, change):
+        """One recursive least squares update for change = loss_rate * x0 + heating_rate * x1"""
+        p = self._covariance
+        px0 = p[0][0] * x0 + p[0][1] * x1
+        px1 = p[1][0] * x0 + p[1][1] * x1
+        denominator = self.forgetting_factor + x0 * px0 + x1 * px1
+        k0 = px0 / denominator
+        k1 = px1 / denominator
+        error = change - (self.loss_rate * x0 + self.heating_rate * x1)
+        self.loss_rate += k0 * error
+        self.heating_rate += k1 * error
+        # P = (P - k x'P) / forgetting_factor. P is symmetric, so x'P is (px0, px1)
+        self._covariance = [[(p[0][0] - k0 * px0) / self.forgetting_factor,
+                             (p[0][1] - k0 * px1) / self.forgetting_factor],
+                            [(p[1][0] - k1 * px0) / self.forgetting_factor,
+                             (p[1][1] - k1 * px1) / self.forgetting_factor]]
+        self.updates += 1
+
+    def bulk_fit(self, times, temperatures, outdoor_temperatures, heater_on):
+        """Fits the model to a history of readings, replacing the current estimates
+
+        Takes sequences of equal length, in time order, with heater_on as for update(). The
+        readings are grouped into steps as update() does, and the result is the least squares
+        fit of all the steps, so later calls to update() carry on from it.
+        """
+        import numpy as np
+        times = np.asarray(times, dtype=float)
+        temperatures = np.asarray(temperatures, dtype=float)
+        outdoor_temperatures = np.asarray(outdoor_temperatures, dtype=float)
+        heater_on = np.asarray(heater_on, dtype=float)
+        if len(times) < 2:
+            return
+
+        # the steps start at the first reading in each min_step interval. heater seconds
+        # between any two readings are a difference of the running total.
+        heater_total = np.concatenate([[0], np.cumsum(heater_on[:-1] * np.diff(times))])
+        _, starts = np.unique(np.floor((times - times[0]) / self.min_step), return_index=True)
+        begin, end = starts[:-1], starts[1:]
+        elapsed = times[end] - times[begin]
+        use = (elapsed >= self.min_step) & (elapsed <= self.max_step)
+        begin, end, elapsed = begin[use], end[use], elapsed[use]
+        outdoor = (outdoor_temperatures[begin] + outdoor_temperatures[end]) / 2.0
+        x = np.column_stack([(outdoor - temperatures[begin]) * elapsed, heater_total[end] - heater_total[begin]])
+        change = temperatures[end] - temperatures[begin]
+        if len(change) < 2:
+            return
+
+        (self.loss_rate, self.heating_rate), _, rank, _ = np.linalg.lstsq(x, change, rcond=None)
+        if rank == 2:
+            self._covariance = np.linalg.inv(x.T.dot(x)).tolist()
+        self.updates = len(change)
+        self._logger.info("Fitted {} steps: loss rate {:.3g}/hour, heating rate {:.3g} degrees/hour".format(
+            len(change), self.loss_rate * 3600, self.heating_rate * 3600))
+        # carry on from the last reading
+        self._start_step(times[-1], temperatures[-1], outdoor_temperatures[-1])
+        self._last_time = times[-1]
+        self._last_heater_on = bool(heater_on[-1])
+
+    def predict(self, temperature, outdoor_temperature, heater_on, duration):
+        """The temperature after duration seconds, from temperature, with constant outdoor and heater"""
+        rate = self.heating_rate * bool(heater_on)
+        if self.loss_rate <= 0:
+            return temperature + rate * duration
+        equilibrium = outdoor_temperature + rate / self.loss_rate
+        return equilibrium + (temperature - equilibrium) * math.exp(-self.loss_rate * duration)
+
+    def heating_time(self, temperature, target, outdoor_temperature):
+        """Seconds of heating to go from temperature to target, or None if the heater can't reach it"""
+        if temperature >= target:
+            return 0.0
+        if self.heating_rate <= 0:
+            return None
+        if self.loss_rate <= 0:
+            return (target - temperature) / self.heating_rate
+        equilibrium = outdoor_temperature + self.heating_rate / self.loss_rate
+        if target >= equilibrium:
+            return None
+        return math.log((equilibrium - temperature) / (equilibrium - target)) / self.loss_rate
+
+    def heater_start_time(self, target, target_time, temperature, outdoor_temperature):
+        """When the heater must come on to reach target at target_time, starting from temperature
+
+        Returns None if the heater can't reach the target at this outdoor temperature, in
+        which case it should come on now.
+        """
+        seconds = self.heating_time(temperature, target, outdoor_temperature)
+        if seconds is None:
+            return None
+        return target_time - seconds
+
+
+def load_outdoor_temperatures(db, times):
+    """The outdoor temperature at each of times, interpolated from the readings table of weather.db
+
+    times are seconds since the epoch, as in therm.db. Returns an array of NaN if there are
+    no weather readings.
+    """
+    import numpy as np
+    # the readings are local time text
+    rows = db.execute("""
+        SELECT CAST(strftime('%s', datetime, 'utc') AS INTEGER), temperature_f FROM readings
+        WHERE temperature_f IS NOT NULL ORDER BY datetime""").fetchall()
+    if not rows:
+        return np.full(len(times), np.nan)
+    weather_times, temperatures = zip(*rows)
+    return np.interp(times, weather_times, temperatures)
+
+
+def heater_states(times, trace_entries):
+    """Whether the heater was actually on at each of times, from DecisionTrace entries
+
+    Times before the first entry are taken as off.
+    """
+    import numpy as np
+    trace_times = np.array([entry['time'] for entry in trace_entries], dtype=float)
+    actually_on = np.array([False] + [entry['actually_on'] for entry in trace_entries], dtype=bool)
+    # index 0 is before the first entry
+    return actually_on[np.searchsorted(trace_times, times, side='right')]
@@ -0,0 +1,169 @@
+import heapq
+import logging
+import threading
+import itertools
+
+from helpers import Clock
+
+
+class DeadlineScheduler(object):
+    """Calls .iterate() on controllers only when they have something to do
+
+    Instead of polling every controller at a fixed interval, the scheduler asks each one for
+    its .next_deadline() and keeps the deadlines in a min-heap. It sleeps until the earliest
+    deadline, or until .notify_reading() reports a new sensor reading, whichever comes first.
+
+    A controller is anything with .iterate() and .next_deadline(), e.g. Thermostat,
+    HeaterCycleProtection or ZoneBank.
+
+    Example:
+
+    scheduler = DeadlineScheduler()
+    scheduler.add(thermostat)
+    threading.Thread(target=scheduler.run).start()
+    ...
+    # in the code that reads the thermometer
+    thermometer.temperature = new_reading
+    scheduler.notify_reading(thermostat)
+    """
+
+    # seconds before a controller whose .iterate() raised is iterated again
+    retry_interval = 10
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, clock=None):
+        """
+
+        :param clock: the instance used to determine time. This is only here to facilitate
+        testing. In production, the default should be used.
+        """
+        if clock:
+            self._clock = clock
+        else:
+            self._clock = Clock()
+
+        # heap of (deadline, sequence, controller id). entries are never removed when a deadline
+        # changes. instead, an entry is skipped when it doesn't match _deadlines.
+        self._heap = []
+        self._deadlines = {}
+        self._controllers = {}
+        self._sequence = itertools.count()
+
+        # controllers with a new reading that haven't been iterated yet
+        self._readings = set()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def add(self, controller):
+        """Starts scheduling a controller. It is iterated on the next pass."""
+        with self._lock:
+            self._controllers[id(controller)] = controller
+            self._readings.add(id(controller))
+        self._wakeup.set()
+
+    def remove(self, controller):
+        with self._lock:
+            self._controllers.pop(id(controller), None)
+            self._deadlines.pop(id(controller), None)
+            self._readings.discard(id(controller))
+
+    def __contains__(self, controller):
+        return id(controller) in self._controllers
+
+    def notify_reading(self, controller=None):
+        """Reports a new sensor reading so the controller is iterated right away.
+
+        This can be called from any thread. Without a controller, every controller is iterated.
+        """
+        with self._lock:
+            if controller is None:
+                self._readings.update(self._controllers)
+            else:
+                self._readings.add(id(controller))
+        self._wakeup.set()
+
+    def next_deadline(self):
+        """The earliest deadline of all controllers, or None if nothing is scheduled"""
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self):
+        """Iterates every controller that has a new reading or a deadline that has passed.
+
+        Each controller is iterated at most once per call. Returns the next deadline, or None.
+        """
+        # clear before collecting the work, so a reading that arrives from now on wakes up .run()
+        self._wakeup.clear()
+        now = self._clock.time()
+        with self._lock:
+            due = self._readings
+            self._readings = set()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    due.add(key)
+            controllers = [self._controllers[key] for key in due if key in self._controllers]
+
+        for controller in controllers:
+            try:
+                controller.iterate()
+            except Exception:
+                # one failing controller mustn't stop the others, or stop it being retried
+                self._logger.exception("{} failed, will retry in {} seconds".format(controller, self.retry_interval))
+                self._set_deadline(controller, now + self.retry_interval)
+                continue
+            self._reschedule(controller)
+
+        return self.next_deadline()
+
+    def run(self):
+        """Runs controllers as their deadlines come up until .stop() is called"""
+        while not self._stopped:
+            deadline = self.run_pending()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - self._clock.time())
+            self._wait(timeout)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _wait(self, timeout):
+        """Sleeps until the timeout or until woken up by a reading"""
+        if timeout is None:
+            # an Event.wait() without a timeout can't be interrupted with ctrl-c in python 2
+            while not self._wakeup.wait(60 * 60):
+                pass
+        elif timeout > 0:
+            self._wakeup.wait(timeout)
+
+    def _reschedule(self, controller):
+        try:
+            deadline = controller.next_deadline()
+        except Exception:
+            self._logger.exception("{} failed, will retry in {} seconds".format(controller, self.retry_interval))
+            deadline = self._clock.time() + self.retry_interval
+        self._set_deadline(controller, deadline)
+
+    def _set_deadline(self, controller, deadline):
+        key = id(controller)
+        with self._lock:
+            if key not in self._controllers:
+                return
+            if deadline is None:
+                self._deadlines.pop(key, None)
+                return
+            if self._deadlines.get(key) != deadline:
+                self._deadlines[key] = deadline
+                heapq.heappush(self._heap, (deadline, next(self._sequence), key))
+
+    def _discard_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
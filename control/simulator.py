@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""Discrete-event simulation of a Thermostat and its HeaterCycleProtection
+
+Instead of advancing a clock a minute at a time and iterating at every step, the simulation
+jumps straight to the next time something can happen: the next thermometer sample, or the
+thermostat's next_deadline(), which covers the threshold delay, the cycle protection and the
+maximum on time. Deadlines are hit exactly, rather than at the next step after them.
+
+The samples come from a sensor, either a recorded trace (TraceSensor) or a model of the house
+(HouseSensor) that warms when the simulated heater runs. Samples that can't change anything,
+because the reading stays on the same side of both thresholds, are skipped too, so a heating
+season is a few thousand events rather than a quarter of a million minutes.
+
+Every change of heater state and target is written to an event log, which is plain text so
+runs of two versions of the code can be compared with diff.
+
+Usage: simulator.py db_path target_temp [start [end]]
+
+Replays the readings in a therm.db through a thermostat holding target_temp, from start to end
+(YYYY-MM-DD, local time), and prints the event log.
+"""
+import os
+import sys
+import time
+import math
+import logging
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+
+from helpers import ThermostatException
+from heater import AbstractHeater, HeaterCycleProtection
+from thermostat import Thermostat
+
+
+class SimulationClock(object):
+    """The simulation's virtual time"""
+
+    def __init__(self, the_time=0):
+        self._time = the_time
+
+    def time(self):
+        return self._time
+
+    def set_clock(self, the_time):
+        self._time = the_time
+
+
+class SimulatedThermometer(object):
+    """Holds the last sample the simulation took"""
+
+    def __init__(self):
+        self.temperature = None
+
+
+def _side(reading, levels):
+    """Which side of the thresholds a reading is on: below low, between, or above high"""
+    low, high = levels
+    if low is not None and reading < low:
+        return -1
+    if high is not None and reading > high:
+        return 1
+    return 0
+
+
+class TraceSensor(object):
+    """Samples from recorded readings, which don't depend on the simulated heater"""
+
+    def __init__(self, times, temperatures):
+        import numpy as np
+        self.times = np.asarray(times, dtype=float)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        if len(self.times) != len(self.temperatures):
+            raise ThermostatException("Got {} times but {} temperatures".format(len(self.times),
+                                                                                len(self.temperatures)))
+        if (np.diff(self.times) < 0).any():
+            raise ThermostatException("Sample times must be increasing")
+        # index of the next sample to take, and the last reading taken
+        self._next = 0
+        self._last_reading = None
+        # for each threshold pair, the side of every sample and the indexes of the samples on a
+        # different side to the one before
+        self._sides = {}
+
+    @classmethod
+    def from_database(cls, db, start=None, end=None):
+        """The readings of a therm.db between start and end, seconds since the epoch"""
+        rows = db.execute("SELECT read_time, temperature FROM temp WHERE read_time >= ? AND read_time < ? "
+                          "AND temperature IS NOT NULL ORDER BY read_time",
+                          (start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1))
+        rows = rows.fetchall()
+        return cls([row[0] for row in rows], [row[1] for row in rows])
+
+    def start_time(self):
+        return self.times[0].item() if len(self.times) else None
+
+    def next_sample_time(self, levels, heater_on, until, skip_quiet=True):
+        """The time of the next sample to take, or None if there are no more
+
+        With skip_quiet, samples on the same side of levels as the last one taken are passed over.
+        """
+        import numpy as np
+        if self._next >= len(self.times):
+            return None
+        if not skip_quiet or self._last_reading is None:
+            return self.times[self._next].item()
+        if levels not in self._sides:
+            sides = np.zeros(len(self.temperatures), dtype=int)
+            if levels[0] is not None:
+                sides[self.temperatures < levels[0]] = -1
+            if levels[1] is not None:
+                sides[self.temperatures > levels[1]] = 1
+            self._sides[levels] = (sides, np.flatnonzero(np.diff(sides)) + 1)
+        sides, changes = self._sides[levels]
+        if sides[self._next] == _side(self._last_reading, levels):
+            # skip to the first sample on another side
+            i = np.searchsorted(changes, self._next, side='right')
+            self._next = changes[i] if i < len(changes) else len(self.times)
+            if self._next == len(self.times):
+                return None
+        return self.times[self._next].item()
+
+    def advance(self, the_time, heater_on):
+        pass
+
+    def sample(self, the_time):
+        """Takes the sample at the_time, which next_sample_time() returned"""
+        self._last_reading = self.temperatures[self._next].item()
+        self._next += 1
+        return self._last_reading
+
+
+class HouseSensor(object):
+    """Samples a house following a ThermalModel, warmed by the simulated heater
+
+    The outdoor temperature is a constant or a function of time, and is held for outdoor_step
+    seconds at a time. Samples are every sample_interval seconds from start, rounded to the
+    thermometer's resolution. Between changes of heater or outdoor temperature the room
+    temperature follows the model's exponential exactly, so skipping ahead to when the reading
+    next crosses a threshold is a closed-form calculation.
+    """
+
+    sample_interval = 60
+    outdoor_step = 60 * 60
+    # the thermometer reads to 1/16 of a degree
+    resolution = 1 / 16.
+
+    def __init__(self, model, outdoor, start=0, temperature=65.0):
+        self.model = model
+        self._outdoor = outdoor if callable(outdoor) else (lambda the_time: outdoor)
+        self.start = start
+        self.time = start
+        self.temperature = float(temperature)
+        self._next_sample = start
+        self._last_reading = None
+
+    def start_time(self):
+        return self.start
+
+    def outdoor_temperature(self, the_time):
+        """The outdoor temperature, held constant over each outdoor_step"""
+        return self._outdoor(the_time - (the_time - self.start) % self.outdoor_step)
+
+    def reading(self, temperature):
+        return round(temperature / self.resolution) * self.resolution
+
+    def _integrate(self, from_time, temperature, to_time, heater_on):
+        """The room temperature at to_time, from temperature at from_time"""
+        while from_time < to_time:
+            segment_end = min(to_time, self._segment_end(from_time))
+            temperature = self.model.predict(temperature, self.outdoor_temperature(from_time), heater_on,
+                                             segment_end - from_time)
+            from_time = segment_end
+        return temperature
+
+    def _segment_end(self, the_time):
+        return the_time - (the_time - self.start) % self.outdoor_step + self.outdoor_step
+
+    def _next_grid_time(self, the_time):
+        """The first sample time at or after the_time"""
+        steps = math.ceil((the_time - self.start) / float(self.sample_interval))
+        return self.start + int(steps) * self.sample_interval
+
+    def _crossing_time(self, from_time, temperature, heater_on, levels):
+        """When the temperature next crosses the boundary of a reading on another side of levels,
+        within the outdoor step of from_time, or None"""
+        outdoor = self.outdoor_temperature(from_time)
+        rate = self.model.heating_rate * bool(heater_on)
+        boundaries = [level + sign * self.resolution / 2 for level, sign in zip(levels, (-1, 1))
+                      if level is not None]
+        if self.model.loss_rate <= 0:
+            if rate == 0:
+                return None
+            ahead = [b for b in boundaries if b > temperature]
+            return from_time + (min(ahead) - temperature) / rate if ahead else None
+        equilibrium = outdoor + rate / self.model.loss_rate
+        if equilibrium > temperature:
+            ahead = [b for b in boundaries if temperature < b < equilibrium]
+            target = min(ahead) if ahead else None
+        else:
+            ahead = [b for b in boundaries if equilibrium < b < temperature]
+            target = max(ahead) if ahead else None
+        if target is None:
+            return None
+        seconds = math.log((equilibrium - temperature) / (equilibrium - target)) / self.model.loss_rate
+        crossing = from_time + seconds
+        return crossing if crossing < self._segment_end(from_time) else None
+
+    def next_sample_time(self, levels, heater_on, until, skip_quiet=True):
+        """The time of the next sample to take, assuming the heater stays as it is
+
+        With skip_quiet, samples whose reading is on the same side of levels as the last one
+        taken are passed over.
+        """
+        # samples passed over while the simulation moved on to other events are gone
+        the_time = max(self._next_sample, self._next_grid_time(self.time))
+        if not skip_quiet or self._last_reading is None:
+            return the_time
+        side = _side(self._last_reading, levels)
+        temperature = self._integrate(self.time, self.temperature, the_time, heater_on)
+        while the_time <= until:
+            if _side(self.reading(temperature), levels) != side:
+                return the_time
+            crossing = self._crossing_time(the_time, temperature, heater_on, levels)
+            next_time = self._next_grid_time(crossing if crossing is not None else self._segment_end(the_time))
+            next_time = max(next_time, the_time + self.sample_interval)
+            temperature = self._integrate(the_time, temperature, next_time, heater_on)
+            the_time = next_time
+        return the_time
+
+    def advance(self, the_time, heater_on):
+        """Moves the house on to the_time, with the heater as given since the last call"""
+        self.temperature = self._integrate(self.time, self.temperature, the_time, heater_on)
+        self.time = the_time
+
+    def sample(self, the_time):
+        """Takes the sample at the_time, which next_sample_time() returned"""
+        self._last_reading = self.reading(self.temperature)
+        self._next_sample = self._next_grid_time(the_time + 1)
+        return self._last_reading
+
+
+class Simulation(object):
+    """Runs a Thermostat against a sensor in virtual time
+
+    The thermostat and its heater must use a SimulationClock, and its thermometer must have a
+    settable .temperature. Quiet samples are only skipped when nothing but the thresholds
+    depends on them, i.e. the thermostat has no model or decision trace.
+
+    Example:
+
+    sensor = HouseSensor(ThermalModel(), outdoor=35, start=start)
+    simulation = Simulation.for_target(sensor, 68)
+    simulation.run(start + 180 * 86400)
+    print simulation.format_log()
+    """
+
+    # the most iterations at one time without the thermostat's deadlines moving on
+    max_iterations_per_time = 10
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, thermostat, sensor):
+        self.thermostat = thermostat
+        self.sensor = sensor
+        self.clock = thermostat.clock
+        self.skip_quiet_samples = thermostat.model is None and thermostat.trace is None
+        # (time, event, temperature)
+        self.events = []
+        self.samples = 0
+        self.iterations = 0
+        self.heater_on_time = 0
+        self.cycle_count = 0
+        self._intended_on = thermostat.get_heater_is_on()
+        self._actually_on = self._heater_actually_on()
+        self._target = thermostat.get_target_temperature()
+
+    @classmethod
+    def for_target(cls, sensor, target_temp, heater=None):
+        """A simulation of a new thermostat in target mode, with cycle protection, from the
+        sensor's first sample"""
+        clock = SimulationClock(sensor.start_time())
+        protection = HeaterCycleProtection(heater or AbstractHeater(), clock)
+        thermostat = Thermostat(protection, SimulatedThermometer(), clock)
+        thermostat.set_target_temperature(target_temp)
+        # not set_mode(), which would iterate before there is a reading
+        thermostat.current_mode = 'target'
+        return cls(thermostat, sensor)
+
+    def _heater_actually_on(self):
+        heater = self.thermostat.heater
+        return heater.is_actually_on() if hasattr(heater, "is_actually_on") else heater.is_on()
+
+    def run(self, end):
+        """Simulates up to and including end. Returns the events logged on the way."""
+        thermostat = self.thermostat
+        first_event = len(self.events)
+        last_time = self.clock.time()
+        iterations_here = 0
+        while True:
+            now = self.clock.time()
+            levels = (thermostat.threshold_low, thermostat.threshold_high)
+            deadline = thermostat.next_deadline()
+            if deadline is not None:
+                # a deadline that has passed is due now
+                deadline = max(deadline, now)
+            # the sensor only needs to look as far ahead as the next deadline
+            sample_time = self.sensor.next_sample_time(levels, self._actually_on,
+                                                       end if deadline is None else min(end, deadline),
+                                                       self.skip_quiet_samples)
+            times = [t for t in (sample_time, deadline) if t is not None]
+            the_time = min(times) if times else None
+            if the_time is None or the_time > end:
+                break
+
+            if the_time == last_time:
+                iterations_here += 1
+                if iterations_here > self.max_iterations_per_time:
+                    raise ThermostatException("Thermostat isn't moving past its deadline at {}".format(the_time))
+            else:
+                iterations_here = 0
+            self._advance(the_time)
+            last_time = the_time
+            if the_time == sample_time:
+                thermostat.thermometer.temperature = self.sensor.sample(the_time)
+                self.samples += 1
+            if thermostat.thermometer.temperature is not None:
+                thermostat.iterate()
+                self.iterations += 1
+                self._log_changes()
+        self._advance(max(end, self.clock.time()))
+        return self.events[first_event:]
+
+    def _advance(self, the_time):
+        if self._actually_on:
+            self.heater_on_time += the_time - self.clock.time()
+        self.sensor.advance(the_time, self._actually_on)
+        self.clock.set_clock(the_time)
+
+    def _log_changes(self):
+        thermostat = self.thermostat
+        temperature = thermostat.get_room_temperature()
+        target = thermostat.get_target_temperature()
+        if target != self._target:
+            self._target = target
+            self.events.append((self.clock.time(), "target {}".format(target), temperature))
+        intended_on = thermostat.get_heater_is_on()
+        if intended_on != self._intended_on:
+            self._intended_on = intended_on
+            self.events.append((self.clock.time(), "request on" if intended_on else "request off", temperature))
+        actually_on = self._heater_actually_on()
+        if actually_on != self._actually_on:
+            self._actually_on = actually_on
+            self.cycle_count += actually_on
+            self.events.append((self.clock.time(), "heater on" if actually_on else "heater off", temperature))
+
+    def format_log(self):
+        """The event log as text, one event per line with the time in UTC"""
+        return "".join("{} {:<12} {:.4f}\n".format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(the_time)),
+                                                  event, temperature)
+                       for the_time, event, temperature in self.events)
+
+
+if __name__ == '__main__':
+    import sqlite3
+    # the heater warns every time it reaches its maximum on time
+    logging.basicConfig(level=logging.ERROR)
+    if len(sys.argv) < 3:
+        sys.exit(__doc__)
+
+    def local_time(text):
+        return time.mktime(time.strptime(text, "%Y-%m-%d"))
+
+    start = local_time(sys.argv[3]) if len(sys.argv) > 3 else None
+    end = local_time(sys.argv[4]) if len(sys.argv) > 4 else None
+    sensor = TraceSensor.from_database(sqlite3.connect(sys.argv[1]), start, end)
+    if sensor.start_time() is None:
+        sys.exit("No readings in that range")
+    simulation = Simulation.for_target(sensor, float(sys.argv[2]))
+    simulation.run(sensor.times[-1].item())
+    sys.stdout.write(simulation.format_log())
+    print "{} samples, {} iterations, {} heater cycles, heater on {:.1f} hours".format(
+        simulation.samples, simulation.iterations, simulation.cycle_count, simulation.heater_on_time / 3600.)
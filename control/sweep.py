@@ -0,0 +1,154 @@
+import itertools
+
+import numpy as np
+
+from helpers import ThermostatException
+from heater import HeaterCycleProtection
+from thermostat import Thermostat
+from zones import ZoneBank
+
+
+class ParameterSweep(ZoneBank):
+    """Replays a temperature trace through many thermostat configurations at once.
+
+    Each configuration is a zone of a ZoneBank in 'target' mode, so it behaves exactly like
+    a Thermostat driving a HeaterCycleProtection, and one call to .step() advances all of them.
+
+    Example:
+
+    sweep = ParameterSweep.from_grid(target_temp=[67, 68, 69],
+                                     threshold_time_delay=[60, 300],
+                                     minimum_on_time=[300, 600])
+    times, temperatures = load_readings(sqlite3.connect('therm.db'))
+    results = sweep.run(times, temperatures)
+    """
+
+    parameter_names = ['target_temp',
+                       'threshold_time_delay',
+                       'minimum_on_time',
+                       'minimum_off_time',
+                       'maximum_on_time',
+                       ]
+
+    def __init__(self, target_temp,
+                 threshold_time_delay=Thermostat.threshold_time_delay,
+                 minimum_on_time=HeaterCycleProtection.minimum_on_time,
+                 minimum_off_time=HeaterCycleProtection.minimum_off_time,
+                 maximum_on_time=HeaterCycleProtection.maximum_on_time):
+        """Each parameter is either a single value or one value per configuration.
+
+        All parameters are broadcast against each other, so a single value applies to every
+        configuration.
+        """
+        params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=float)) for p in
+                                       [target_temp, threshold_time_delay, minimum_on_time,
+                                        minimum_off_time, maximum_on_time]])
+        params = [np.array(p) for p in params]
+        ZoneBank.__init__(self, len(params[0]))
+        self.target_temp, self.threshold_time_delay, self.minimum_on_time, \
+            self.minimum_off_time, self.maximum_on_time = params
+        self.mode[:] = self._target
+
+        # same limits as Thermostat.set_target_temperature()
+        if (self.target_temp > Thermostat.target_maximum).any():
+            raise ThermostatException("Can not set target above limit of {}".format(Thermostat.target_maximum))
+        if (self.target_temp < Thermostat.target_minimum).any():
+            raise ThermostatException("Can not set target below limit of {}".format(Thermostat.target_minimum))
+        if (self.maximum_on_time <= 0).any():
+            raise ThermostatException("Maximum on time must be greater than zero")
+
+        self.threshold_low = self.target_temp - 1
+        self.threshold_high = self.target_temp + 1
+
+        self.reset()
+
+    @classmethod
+    def from_grid(cls, **candidates):
+        """Creates a sweep over every combination of the candidate values
+
+        Keyword arguments are parameter names with a list of candidate values. Parameters that
+        are not given use the class defaults of Thermostat and HeaterCycleProtection.
+        """
+        unknown = set(candidates) - set(cls.parameter_names)
+        if unknown:
+            raise ThermostatException("Unrecognized parameters: {}".format(", ".join(sorted(unknown))))
+        names = [name for name in cls.parameter_names if name in candidates]
+        combinations = list(itertools.product(*[np.atleast_1d(candidates[name]) for name in names]))
+        columns = zip(*combinations) if combinations else [[] for _ in names]
+        return cls(**dict(zip(names, [np.array(column, dtype=float) for column in columns])))
+
+    def get_parameters(self, i):
+        """Returns a dictionary of the parameters of configuration i"""
+        return dict((name, getattr(self, name)[i].item()) for name in self.parameter_names)
+
+    def reset(self):
+        """Puts every configuration back in its initial state and clears the results"""
+        ZoneBank.reset(self)
+        self.heater_on_time = np.zeros(self.size)
+        self.time_outside_band = np.zeros(self.size)
+        self._outside_band = np.zeros(self.size, dtype=bool)
+        self._last_time = None
+
+    def run(self, times, temperatures):
+        """Steps through every reading and returns the results
+
+        :param times: increasing sample times in seconds
+        :param temperatures: the room temperature at each sample time
+        """
+        times = np.asarray(times, dtype=float)
+        temperatures = np.asarray(temperatures, dtype=float)
+        if len(times) != len(temperatures):
+            raise ThermostatException("Got {} times but {} temperatures".format(len(times), len(temperatures)))
+        if (np.diff(times) < 0).any():
+            raise ThermostatException("Sample times must be increasing")
+        for the_time, temperature in itertools.izip(times.tolist(), temperatures.tolist()):
+            self.step(the_time, temperature)
+        return self.results()
+
+    def results(self):
+        """Returns per-configuration results accumulated since the last reset
+
+        cycle_count - number of times the heater was actually turned on
+        heater_on_time - seconds the heater was actually running
+        time_outside_band - seconds the room was below the low or above the high threshold
+        """
+        return {'cycle_count': self.cycle_count.copy(),
+                'heater_on_time': self.heater_on_time.copy(),
+                'time_outside_band': self.time_outside_band.copy(),
+                }
+
+    def step(self, the_time, temperature):
+        """Advances every configuration to the_time with a new room temperature reading
+
+        This is the equivalent of calling Thermostat.iterate() on every configuration.
+        """
+        the_time = float(the_time)
+
+        # the state since the previous sample held until now
+        if self._last_time is not None:
+            elapsed = the_time - self._last_time
+            self.heater_on_time += elapsed * self.actually_on
+            self.time_outside_band += elapsed * self._outside_band
+        self._last_time = the_time
+
+        self.temperature[:] = temperature
+        self._outside_band = (temperature < self.threshold_low) | (temperature > self.threshold_high)
+        self._advance(the_time)
+
+
+def load_readings(db):
+    """Returns arrays of (times, temperatures) from the temp table of a therm.db connection
+
+    Times are seconds since the epoch. Databases from before the read_time column held epoch
+    seconds store local time text, which is read as if it were UTC. Only differences between
+    times matter to the thermostat, so this doesn't affect a sweep.
+    """
+    rows = db.execute("SELECT read_time, temperature FROM temp ORDER BY id").fetchall()
+    if not rows:
+        return np.zeros(0), np.zeros(0)
+    read_times, temperatures = zip(*rows)
+    if db.execute("PRAGMA user_version").fetchone()[0] >= 2:
+        times = np.array(read_times, dtype=float)
+    else:
+        times = np.array(read_times, dtype='datetime64[s]').astype(np.int64).astype(float)
+    return times, np.array(temperatures, dtype=float)
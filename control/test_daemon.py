@@ -0,0 +1,217 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from unittest import TestCase
+
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from daemon import ThermostatDaemon, LatestReading
+from journal import StateJournal
+from test_heaterControl import TestClock
+import reading_channel
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class FakeSensor(object):
+    """A thermometer read that returns the given temperature, optionally after a delay"""
+
+    def __init__(self, temperature):
+        self.temperature = temperature
+        self.delay = 0
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if isinstance(self.temperature, Exception):
+            raise self.temperature
+        return self.temperature
+
+
+class FlakyHeater(AbstractHeater):
+    """A heater that can't be switched while .fail is set, like a relay service that is down"""
+    fail = False
+
+    def set_to_on(self, val):
+        if self.fail:
+            raise IOError("Relay service not running")
+        AbstractHeater.set_to_on(self, val)
+
+
+class FakeStorage(object):
+    def __init__(self):
+        self.records = []
+        self.threads = set()
+        self.delay = 0
+
+    def record(self, kind, the_time, value):
+        if self.delay:
+            time.sleep(self.delay)
+        self.threads.add(threading.current_thread().ident)
+        self.records.append((kind, the_time, value))
+
+
+class TestThermostatDaemon(TestCase):
+    def setUp(self):
+        self.clock = TestClock()
+        self.heater = HeaterCycleProtection(AbstractHeater(), self.clock)
+        self.thermostat = Thermostat(self.heater, LatestReading(), self.clock)
+        self.thermostat.set_target_temperature(68)
+        self.thermostat.current_mode = 'target'
+        self.sensor = FakeSensor(68)
+        self.storage = FakeStorage()
+        self.daemon = ThermostatDaemon(self.thermostat, self.sensor.read, self.storage.record)
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def test_no_control_before_first_reading(self):
+        self.assertIsNone(self.daemon.scheduler.run_pending())
+        self.assertNotIn(self.daemon._control, self.daemon.scheduler)
+
+    def test_sample_control_and_persist(self):
+        self.sensor.temperature = 66
+        self.assertEquals(self.daemon.sample_once(), 66)
+        self.assertEquals(self.thermostat.get_room_temperature(), 66)
+        self.assertEquals(self.daemon.scheduler.run_pending(), 5 * 60)
+        self.clock.advance(minutes=5)
+        self.daemon.scheduler.run_pending()
+        self.assertTrue(self.heater.is_actually_on())
+        self.assertEquals(self.daemon.persist_pending(), 3)
+        self.assertEquals(self.storage.records, [("temperature", 0, 66),
+                                                 ("heater", 0, False),
+                                                 ("heater", 5 * 60, True)])
+
+    def test_state_journal(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal = StateJournal(os.path.join(directory, "thermostat.journal"), self.clock)
+            journal.sync_interval = None
+            self.daemon.journal = journal
+            self.sensor.temperature = 66
+            self.daemon.sample_once()
+            self.daemon.scheduler.run_pending()
+            self.clock.advance(minutes=5)
+            self.daemon.scheduler.run_pending()
+            self.daemon.stop()
+            state = StateJournal(journal.path, self.clock).load()
+            self.assertEquals(state['heater']['on_since'], 5 * 60)
+            self.assertEquals(state, self.thermostat.get_state())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_heater_failure_is_retried(self):
+        relay = FlakyHeater()
+        self.heater._heater = relay
+        self.sensor.temperature = 66
+        self.daemon.sample_once()
+        self.daemon.scheduler.run_pending()
+        relay.fail = True
+        self.clock.advance(minutes=5)
+        # the failure doesn't escape, and the switch is tried again
+        self.assertEquals(self.daemon.scheduler.run_pending(), 5 * 60 + self.heater.switch_retry_interval)
+        self.assertFalse(relay.is_on())
+        relay.fail = False
+        self.clock.advance(minutes=1)
+        self.daemon.scheduler.run_pending()
+        self.assertTrue(relay.is_on())
+        # the maximum on time still applies if the relay is down when it is reached
+        relay.fail = True
+        self.clock.advance(minutes=60)
+        self.daemon.scheduler.run_pending()
+        self.assertTrue(relay.is_on())
+        relay.fail = False
+        self.clock.advance(minutes=self.heater.switch_retry_interval / 60.)
+        self.daemon.scheduler.run_pending()
+        self.assertFalse(relay.is_on())
+
+    def test_mapped_thermometer(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "thermometer.reading")
+            writer = reading_channel.ReadingWriter(path, self.clock)
+            thermostat = Thermostat(self.heater, reading_channel.MappedThermometer(path, self.clock), self.clock)
+            thermostat.set_target_temperature(68)
+            thermostat.current_mode = 'target'
+            daemon = ThermostatDaemon(thermostat, record=self.storage.record)
+            # the sampler hasn't published a reading yet
+            self.assertIsNone(daemon.sample_once())
+            self.assertNotIn(daemon._control, daemon.scheduler)
+            writer.write(66)
+            self.assertEquals(daemon.sample_once(), 66)
+            daemon.scheduler.run_pending()
+            self.clock.advance(minutes=5)
+            writer.write(66)
+            daemon.scheduler.run_pending()
+            self.assertTrue(thermostat.get_heater_is_on())
+            # the sampler stops, and the heater goes off once its minimum on time is up
+            writer.close()
+            self.assertIsNone(daemon.sample_once())
+            daemon.scheduler.run_pending()
+            self.clock.advance(minutes=5)
+            daemon.scheduler.run_pending()
+            self.assertFalse(self.heater.is_actually_on())
+            # the sampler records the readings, the daemon only the heater changes
+            daemon.stop()
+            self.assertEquals([kind for kind, _, _ in self.storage.records], ["heater", "heater", "heater"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_failed_read(self):
+        self.sensor.temperature = IOError("USB error")
+        self.assertIsNone(self.daemon.sample_once())
+        self.assertIsNone(self.thermostat.get_room_temperature())
+        self.sensor.temperature = 67
+        self.assertEquals(self.daemon.sample_once(), 67)
+
+    def test_slow_read_is_not_repeated(self):
+        self.daemon.sample_timeout = 0.05
+        self.sensor.delay = 0.2
+        self.assertIsNone(self.daemon.sample_once())
+        self.assertIsNone(self.daemon.sample_once())
+        time.sleep(0.3)
+        self.assertEquals(self.daemon.sample_once(), 68)
+        self.assertEquals(self.sensor.reads, 1)
+
+    def test_records_dropped_when_storage_is_behind(self):
+        self.daemon._records.maxsize = 2
+        for _ in range(3):
+            self.daemon.sample_once()
+        self.assertEquals(self.daemon.persist_pending(), 2)
+
+
+class TestThermostatDaemonThreaded(TestCase):
+
+    def test_slow_io_does_not_delay_heater_off(self):
+        # a real clock, with times scaled down to fractions of a second
+        heater = HeaterCycleProtection(AbstractHeater())
+        heater.minimum_on_time = 0
+        heater.maximum_on_time = 0.3
+        thermostat = Thermostat(heater, LatestReading())
+        thermostat.set_target_temperature(68)
+        thermostat.current_mode = 'target'
+        thermostat.threshold_time_delay = 0
+        sensor = FakeSensor(60)
+        storage = FakeStorage()
+        daemon = ThermostatDaemon(thermostat, sensor.read, storage.record)
+        daemon.sample_interval = 0.05
+        daemon.sample_timeout = 0.01
+        daemon.start()
+        try:
+            time.sleep(0.1)
+            self.assertTrue(heater.is_actually_on())
+            # the thermometer and the database hang, but the heater still turns off on time
+            sensor.delay = 5
+            storage.delay = 5
+            time.sleep(0.4)
+            self.assertFalse(heater.is_actually_on())
+        finally:
+            daemon._device_pool.terminate()
+            daemon._stopped.set()
+            daemon.scheduler.stop()
+        self.assertEquals(len(storage.threads), 1)
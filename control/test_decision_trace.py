@@ -0,0 +1,67 @@
+import os
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from decision_trace import DecisionTrace, read_trace, format_entry, NO_DECISION, TURN_ON
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestDecisionTrace(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_from_thermostat(self):
+        clock = TestClock()
+        thermometer = TestThermometer()
+        heater = HeaterCycleProtection(AbstractHeater(), clock)
+        thermostat = Thermostat(heater, thermometer, clock)
+        thermostat.trace = DecisionTrace(capacity=10)
+        thermostat.set_target_temperature(68)
+        thermometer.temperature = 66
+        thermostat.set_mode('target')
+        clock.advance(minutes=5)
+        thermostat.iterate()
+
+        entries = thermostat.trace.entries()
+        self.assertEquals(len(entries), 2)
+        self.assertEquals(entries[0], {'time': 0, 'temperature': 66, 'threshold_low': 67,
+                                       'threshold_high': 69, 'mode': 'target', 'intended_on': False,
+                                       'actually_on': False, 'decision': 'none'})
+        self.assertEquals(entries[1]['decision'], 'turn on')
+        self.assertTrue(entries[1]['actually_on'])
+        self.assertEquals(format_entry(entries[1]),
+                          "300.0 mode=target temp=66.0 thresholds=67.0/69.0 heater=on/on decision=turn on")
+
+    def test_ring_buffer_keeps_latest(self):
+        trace = DecisionTrace(capacity=3)
+        for i in range(5):
+            trace.record(i, 60 + i, 'off', None, None, False, False, NO_DECISION)
+        self.assertEquals(len(trace), 3)
+        self.assertEquals([e['time'] for e in trace.entries()], [2, 3, 4])
+        self.assertIsNone(trace.entries()[0]['threshold_low'])
+
+    def test_dump_and_read(self):
+        trace = DecisionTrace(capacity=4)
+        for i in range(6):
+            trace.record(i * 60, 66.5, 'target', 67, 69, True, i > 2, TURN_ON if i == 3 else NO_DECISION)
+        path = os.path.join(self.directory, "decisions.trace")
+        trace.dump(path)
+        self.assertEquals(read_trace(path), trace.entries())
+        self.assertEquals([e['time'] for e in read_trace(path)], [120, 180, 240, 300])
+
+    def test_read_wrong_file(self):
+        path = os.path.join(self.directory, "not_a_trace")
+        with open(path, 'wb') as f:
+            f.write("x" * 100)
+        with self.assertRaises(ValueError):
+            read_trace(path)
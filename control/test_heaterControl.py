@@ -2,7 +2,7 @@ import random
 import logging
 from unittest import TestCase
 
-from heater import HeaterCycleProtection
+from heater import AbstractHeater, HeaterCycleProtection
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -32,8 +32,8 @@ class TestClock(object):
     def set_clock(self, the_time):
         self._time = the_time
 
-    def advance(self, minutes=0):
-        self._time += (minutes * 60)
+    def advance(self, minutes=0, seconds=0):
+        self._time += (minutes * 60) + seconds
 
     def advance_random(self):
         self.advance(minutes=random.randint(1, 10))
@@ -42,7 +42,7 @@ class TestClock(object):
 class TestHeaterControl(TestCase):
     def setUp(self):
         self.clock = TestClock()
-        self.heater = HeaterCycleProtection(self.clock)
+        self.heater = HeaterCycleProtection(AbstractHeater(), self.clock)
 
     def test_turn_on(self):
         self.heater.set_to_on(True)
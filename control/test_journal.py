@@ -0,0 +1,160 @@
+import os
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+
+from journal import StateJournal
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestStateJournal(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "thermostat.journal")
+        self.clock = TestClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self):
+        return StateJournal(self.path, self.clock)
+
+    def test_record_and_load(self):
+        journal = self.journal()
+        self.assertIsNone(journal.load())
+        journal.record({'mode': 'target', 'heater': {'on': False}})
+        journal.record({'mode': 'target', 'heater': {'on': True}})
+        # unchanged, nothing to record
+        journal.record({'mode': 'target', 'heater': {'on': True}})
+        self.assertEquals(journal._sequence, 2)
+        journal.close()
+        self.assertEquals(self.journal().load(), {'mode': 'target', 'heater': {'on': True}})
+
+    def test_record_without_load_keeps_journal(self):
+        journal = self.journal()
+        journal.record({'a': 1, 'b': 1})
+        journal.close()
+        journal = self.journal()
+        journal.record({'a': 2, 'b': 1})
+        journal.close()
+        self.assertEquals(self.journal().load(), {'a': 2, 'b': 1})
+
+    def test_line_cut_short(self):
+        journal = self.journal()
+        journal.record({'a': 1})
+        journal.record({'a': 2})
+        journal.close()
+        with open(self.path, "rb+") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        journal = self.journal()
+        self.assertEquals(journal.load(), {'a': 1})
+        # the damaged line is dropped, so new records can be read back
+        journal.record({'a': 3})
+        journal.close()
+        self.assertEquals(self.journal().load(), {'a': 3})
+
+    def test_snapshot(self):
+        journal = self.journal()
+        journal.snapshot_every = 10
+        for i in range(25):
+            journal.record({'a': i, 'b': 'constant'})
+        journal.close()
+        self.assertTrue(os.path.exists(journal.snapshot_path))
+        with open(self.path) as f:
+            self.assertLess(len(f.readlines()), 10)
+        self.assertEquals(self.journal().load(), {'a': 24, 'b': 'constant'})
+
+    def test_sync_batched(self):
+        journal = self.journal()
+        synced = []
+        sync = journal.sync
+        journal.sync = lambda: synced.append(self.clock.time()) or sync()
+        for i in range(10):
+            journal.record({'a': i})
+            self.clock.advance(minutes=0.25 / 60)
+        self.assertEquals(len(synced), 3)
+        journal.close()
+
+
+class TestRestoreState(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "thermostat.journal")
+        self.clock = TestClock()
+        self.relay = AbstractHeater()
+        self.thermometer = TestThermometer()
+        self.thermometer.temperature = 66
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def thermostat(self):
+        thermostat = Thermostat(HeaterCycleProtection(self.relay, self.clock), self.thermometer, self.clock)
+        thermostat.set_target_temperature(68)
+        return thermostat
+
+    def restart(self, thermostat):
+        """Saves the thermostat's state and returns a new thermostat restored from it"""
+        journal = StateJournal(self.path, self.clock)
+        journal.record(thermostat.get_state())
+        journal.close()
+        restarted = self.thermostat()
+        relay_unchanged = self.relay.is_on() == thermostat.heater.get_state()['actually_on']
+        restarted.set_state(StateJournal(self.path, self.clock).load())
+        if relay_unchanged:
+            self.assertEquals(restarted.get_state(), thermostat.get_state())
+        return restarted
+
+    def test_cycle_protection_survives_restart(self):
+        thermostat = self.thermostat()
+        thermostat.set_mode('target')
+        self.clock.advance(minutes=5)
+        thermostat.iterate()
+        self.assertTrue(self.relay.is_on())
+        turned_on = self.clock.time()
+
+        self.clock.advance(minutes=1)
+        thermostat = self.restart(thermostat)
+        self.assertTrue(thermostat.heater.is_actually_on())
+        # too warm, but the heater must run its minimum time from when it really turned on
+        self.thermometer.temperature = 70
+        thermostat.iterate()
+        self.assertEquals(thermostat.crossed_above_high_threshold_at, self.clock.time())
+        self.clock.advance(minutes=5)
+        thermostat.iterate()
+        self.assertFalse(self.relay.is_on())
+        self.assertEquals(thermostat.heater._off_since, turned_on + 6 * 60)
+
+    def test_threshold_crossing_survives_restart(self):
+        thermostat = self.thermostat()
+        thermostat.set_mode('target')
+        self.clock.advance(minutes=3)
+        thermostat.iterate()
+        thermostat = self.restart(thermostat)
+        self.assertEquals(thermostat.crossed_below_low_threshold_at, 0)
+        self.assertEquals(thermostat.next_deadline(), 5 * 60)
+        self.clock.advance(minutes=2)
+        thermostat.iterate()
+        self.assertTrue(self.relay.is_on())
+
+    def test_heater_changed_while_stopped(self):
+        thermostat = self.thermostat()
+        thermostat.set_mode('target')
+        self.clock.advance(minutes=5)
+        thermostat.iterate()
+        # the relay lost power while the daemon was restarting
+        self.relay.set_to_on(False)
+        self.clock.advance(minutes=1)
+        thermostat = self.restart(thermostat)
+        self.assertFalse(thermostat.heater.is_actually_on())
+        self.assertTrue(thermostat.get_heater_is_on())
+        # it comes back on once the minimum off time is up
+        self.assertEquals(thermostat.next_deadline(), self.clock.time() + thermostat.heater.minimum_off_time)
@@ -0,0 +1,162 @@
+import random
+import sqlite3
+import logging
+from unittest import TestCase
+
+import numpy as np
+
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from model import ThermalModel, load_outdoor_temperatures, heater_states
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+LOSS_RATE = 1 / (6 * 60 * 60.)
+HEATING_RATE = 5 / (60 * 60.)
+
+
+def simulate_house(hours=72, step=60, seed=0):
+    """Readings from a house following the model, with a heater cycling on a schedule and a
+    daily swing in outdoor temperature. Returns (times, temperatures, outdoor, heater_on)"""
+    rng = random.Random(seed)
+    truth = ThermalModel(LOSS_RATE, HEATING_RATE)
+    times = np.arange(0, hours * 3600, step, dtype=float)
+    outdoor = 40 + 10 * np.sin(times / 86400. * 2 * np.pi)
+    heater_on = (times // 3600) % 3 == 0
+    temperatures = [65.0]
+    for i in range(1, len(times)):
+        temperatures.append(truth.predict(temperatures[-1], outdoor[i - 1], heater_on[i - 1], step))
+    # readings are noisy and rounded like the thermometer's
+    temperatures = np.round((np.array(temperatures) + [rng.gauss(0, 0.02) for _ in times]) * 16) / 16
+    return times, temperatures, outdoor, heater_on
+
+
+class TestThermalModel(TestCase):
+
+    def test_update_converges(self):
+        times, temperatures, outdoor, heater_on = simulate_house()
+        model = ThermalModel()
+        for reading in zip(times, temperatures, outdoor, heater_on):
+            model.update(*reading)
+        self.assertEquals(model.updates, 72 * 6 - 1)
+        self.assertAlmostEqual(model.loss_rate / LOSS_RATE, 1, delta=0.15)
+        self.assertAlmostEqual(model.heating_rate / HEATING_RATE, 1, delta=0.15)
+
+    def test_bulk_fit(self):
+        times, temperatures, outdoor, heater_on = simulate_house(hours=78)
+        history = 72 * 60
+        model = ThermalModel()
+        model.bulk_fit(times[:history], temperatures[:history], outdoor[:history], heater_on[:history])
+        self.assertAlmostEqual(model.loss_rate / LOSS_RATE, 1, delta=0.15)
+        self.assertAlmostEqual(model.heating_rate / HEATING_RATE, 1, delta=0.15)
+
+        # updates carry on from the bulk fit without a jump
+        loss_rate = model.loss_rate
+        for reading in zip(times[history:], temperatures[history:], outdoor[history:], heater_on[history:]):
+            model.update(*reading)
+        self.assertAlmostEqual(model.loss_rate / loss_rate, 1, delta=0.05)
+
+    def test_gaps_skipped(self):
+        model = ThermalModel()
+        model.update(0, 65, 40, True)
+        model.update(5 * 60, 65.5, 40, True)
+        self.assertEquals(model.updates, 0)
+        model.update(3 * 60 * 60, 60, 40, True)
+        self.assertEquals(model.updates, 0)
+        model.update(3 * 60 * 60 + 10 * 60, 61, 40, True)
+        self.assertEquals(model.updates, 1)
+
+    def test_heater_start_time(self):
+        model = ThermalModel(LOSS_RATE, HEATING_RATE)
+        start = model.heater_start_time(68, 10000, 60, 45)
+        self.assertAlmostEqual(model.predict(60, 45, True, 10000 - start), 68)
+        self.assertEquals(model.heater_start_time(58, 10000, 60, 45), 10000)
+        # with 30 degrees outside, the heater can hold at most 30 + 5 * 6 = 60 degrees
+        self.assertIsNone(model.heater_start_time(68, 10000, 55, 30))
+
+    def test_load_outdoor_temperatures(self):
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE readings(datetime TIMESTAMP PRIMARY KEY, temperature_f NUMERIC)")
+        db.executemany("INSERT INTO readings VALUES(?, ?)", [("2016-02-15 10:00:00", 40), ("2016-02-15 11:00:00", 44)])
+        start = db.execute("SELECT CAST(strftime('%s', '2016-02-15 10:00:00', 'utc') AS INTEGER)").fetchone()[0]
+        self.assertEquals(load_outdoor_temperatures(db, [start, start + 900, start + 7200]).tolist(), [40, 41, 44])
+
+    def test_heater_states(self):
+        entries = [{'time': 100, 'actually_on': True}, {'time': 200, 'actually_on': False}]
+        self.assertEquals(heater_states([50, 100, 150, 250], entries).tolist(), [False, True, True, False])
+
+
+class TestPreheat(TestCase):
+
+    def setUp(self):
+        self.clock = TestClock()
+        self.thermometer = TestThermometer()
+        self.thermometer.temperature = 60
+        self.outdoor = TestThermometer()
+        self.outdoor.temperature = 45
+        heater = HeaterCycleProtection(AbstractHeater(), self.clock)
+        self.thermostat = Thermostat(heater, self.thermometer, self.clock)
+        self.thermostat.threshold_time_delay = 0
+        self.thermostat.set_target_temperature(58)
+        self.thermostat.set_mode('target')
+
+    def test_without_model(self):
+        self.thermostat.schedule_target(68, 10000)
+        self.assertEquals(self.thermostat.next_deadline(), 10000)
+        self.clock.set_clock(9999)
+        self.thermostat.iterate()
+        self.assertEquals(self.thermostat.get_target_temperature(), 58)
+        self.clock.set_clock(10000)
+        self.thermostat.iterate()
+        self.assertEquals(self.thermostat.get_target_temperature(), 68)
+        self.assertTrue(self.thermostat.get_heater_is_on())
+
+    def test_with_model(self):
+        self.thermostat.model = ThermalModel(LOSS_RATE, HEATING_RATE)
+        self.thermostat.outdoor_thermometer = self.outdoor
+        self.thermostat.schedule_target(68, 10000)
+        start = self.thermostat.preheat_start_time()
+        self.assertEquals(start, self.thermostat.model.heater_start_time(68, 10000, 60, 45))
+        self.assertLess(start, 10000)
+        self.assertEquals(self.thermostat.next_deadline(), start)
+        self.clock.set_clock(start)
+        self.thermostat.iterate()
+        self.assertEquals(self.thermostat.get_target_temperature(), 68)
+        self.assertIsNone(self.thermostat.scheduled_target)
+        self.assertTrue(self.thermostat.get_heater_is_on())
+
+    def test_target_reached_by_at_time(self):
+        truth = ThermalModel(LOSS_RATE, HEATING_RATE)
+        self.thermostat.threshold_time_delay = Thermostat.threshold_time_delay
+        self.thermostat.model = ThermalModel(LOSS_RATE, HEATING_RATE)
+        self.thermostat.outdoor_thermometer = self.outdoor
+        # mild enough outside to heat up well within the heater's maximum on time
+        self.outdoor.temperature = 60
+        self.thermometer.temperature = 66
+        self.thermostat.schedule_target(68, 3600)
+        for the_time in range(60, 3601, 60):
+            # the room follows the model, with the heater as it was over the last minute
+            heater_on = self.thermostat.heater.is_actually_on()
+            self.thermometer.temperature = truth.predict(self.thermometer.temperature, 60, heater_on, 60)
+            self.clock.set_clock(the_time)
+            self.thermostat.iterate()
+        # to within the minute between iterations
+        self.assertGreater(self.thermometer.temperature, 67.9)
+
+    def test_unreachable_starts_now(self):
+        self.thermostat.model = ThermalModel(LOSS_RATE, HEATING_RATE)
+        self.thermostat.outdoor_thermometer = self.outdoor
+        self.outdoor.temperature = 0
+        self.thermostat.schedule_target(68, 10000)
+        self.assertEquals(self.thermostat.preheat_start_time(), self.clock.time())
+
+    def test_model_updated(self):
+        self.thermostat.model = ThermalModel()
+        self.thermostat.outdoor_thermometer = self.outdoor
+        for minute in range(1, 31):
+            self.clock.set_clock(minute * 60)
+            self.thermometer.temperature -= 0.05
+            self.thermostat.iterate()
+        self.assertEquals(self.thermostat.model.updates, 2)
@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+from unittest import TestCase
+
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from scheduler import DeadlineScheduler
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestNextDeadline(TestCase):
+    def setUp(self):
+        self.clock = TestClock()
+        self.heater = HeaterCycleProtection(AbstractHeater(), self.clock)
+        self.thermometer = TestThermometer()
+        self.thermometer.temperature = 68
+        self.thermostat = Thermostat(self.heater, self.thermometer, self.clock)
+        self.thermostat.set_target_temperature(68)
+        self.thermostat.set_mode('target')
+
+    def test_nothing_scheduled(self):
+        self.assertIsNone(self.heater.next_deadline())
+        self.assertIsNone(self.thermostat.next_deadline())
+
+    def test_threshold_delay(self):
+        self.clock.advance(minutes=2)
+        self.thermometer.temperature = 66
+        self.thermostat.iterate()
+        self.assertEquals(self.thermostat.next_deadline(), 7 * 60)
+
+    def test_cycle_protection_and_maximum_on_time(self):
+        self.heater.set_to_on(True)
+        self.heater.iterate()
+        self.assertEquals(self.heater.next_deadline(), 60 * 60)
+        self.clock.advance(minutes=1)
+        self.heater.set_to_on(False)
+        self.assertEquals(self.heater.next_deadline(), 5 * 60)
+
+
+class TestDeadlineScheduler(TestCase):
+    def setUp(self):
+        self.clock = TestClock()
+        self.heater = HeaterCycleProtection(AbstractHeater(), self.clock)
+        self.thermometer = TestThermometer()
+        self.thermometer.temperature = 68
+        self.thermostat = Thermostat(self.heater, self.thermometer, self.clock)
+        self.thermostat.set_target_temperature(68)
+        self.thermostat.set_mode('target')
+        self.scheduler = DeadlineScheduler(self.clock)
+        self.scheduler.add(self.thermostat)
+
+    def test_sleeps_until_deadline(self):
+        self.assertIsNone(self.scheduler.run_pending())
+        # a new reading below threshold, the heater is due to turn on after the threshold delay
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = 66
+        self.scheduler.notify_reading(self.thermostat)
+        self.assertEquals(self.scheduler.run_pending(), 6 * 60)
+        # nothing happens before the deadline
+        self.clock.set_clock(6 * 60 - 1)
+        self.assertEquals(self.scheduler.run_pending(), 6 * 60)
+        self.assertFalse(self.heater.is_actually_on())
+        # right at the deadline, the heater turns on. the next deadline is the maximum on time.
+        self.clock.set_clock(6 * 60)
+        self.assertEquals(self.scheduler.run_pending(), 66 * 60)
+        self.assertTrue(self.heater.is_actually_on())
+
+    def test_failing_controller_is_retried(self):
+        class Failing(object):
+            def iterate(self):
+                raise IOError("relay service not running")
+
+            def next_deadline(self):
+                return None
+
+        failing = Failing()
+        self.scheduler.add(failing)
+        self.assertEquals(self.scheduler.run_pending(), self.scheduler.retry_interval)
+        # the other controllers still run
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = 66
+        self.scheduler.notify_reading(self.thermostat)
+        self.assertEquals(self.scheduler.run_pending(), 60 + self.scheduler.retry_interval)
+        self.assertEquals(self.thermostat.crossed_below_low_threshold_at, 60)
+
+    def test_reading_cancels_deadline(self):
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = 66
+        self.scheduler.notify_reading()
+        self.assertEquals(self.scheduler.run_pending(), 6 * 60)
+        # warms back up before the delay passes, so there's nothing left to do
+        self.clock.advance(minutes=2)
+        self.thermometer.temperature = 68
+        self.scheduler.notify_reading()
+        self.assertIsNone(self.scheduler.run_pending())
+
+    def test_remove(self):
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = 66
+        self.scheduler.notify_reading()
+        self.scheduler.run_pending()
+        self.scheduler.remove(self.thermostat)
+        self.assertIsNone(self.scheduler.next_deadline())
+
+
+class TestDeadlineSchedulerThreaded(TestCase):
+
+    def test_wakes_up_on_deadline_and_reading(self):
+        heater = HeaterCycleProtection(AbstractHeater())
+        heater.minimum_on_time = 0
+        heater.maximum_on_time = 0.2
+        scheduler = DeadlineScheduler()
+        scheduler.add(heater)
+        thread = threading.Thread(target=scheduler.run)
+        thread.daemon = True
+        thread.start()
+        try:
+            # the reading wakes up the scheduler, which turns the heater on
+            heater.set_to_on(True)
+            scheduler.notify_reading(heater)
+            time.sleep(0.1)
+            self.assertTrue(heater.is_actually_on())
+            # the maximum on time deadline turns it off without any further prodding
+            time.sleep(0.3)
+            self.assertFalse(heater.is_actually_on())
+        finally:
+            scheduler.stop()
+            thread.join(1)
+        self.assertFalse(thread.is_alive())
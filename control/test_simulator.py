@@ -0,0 +1,119 @@
+import math
+import logging
+from unittest import TestCase
+
+from heater import AbstractHeater, HeaterCycleProtection
+from thermostat import Thermostat
+from model import ThermalModel
+from simulator import Simulation, SimulationClock, SimulatedThermometer, TraceSensor, HouseSensor
+
+logging.basicConfig(level=logging.DEBUG)
+
+LOSS_RATE = 1 / (6 * 60 * 60.)
+HEATING_RATE = 5 / (60 * 60.)
+
+
+def outdoor(the_time):
+    """A mild week with a cooler spell in the middle, never so cold that the heater has to run
+    for its maximum on time"""
+    return 50 - 5 * math.sin(math.pi * the_time / (7 * 86400.)) + 5 * math.sin(2 * math.pi * the_time / 86400.)
+
+
+def house(start=0):
+    return HouseSensor(ThermalModel(LOSS_RATE, HEATING_RATE), outdoor, start=start)
+
+
+def step_every_minute(sensor, target, end):
+    """The event log of iterating at every sample, the way the tests drive the thermostat
+
+    This only matches the simulation while every deadline falls on a sample time. That's not
+    the case after the maximum on time, when the simulation starts the heater again as soon
+    as the thermostat asks rather than at the next sample.
+    """
+    simulation = Simulation.for_target(sensor, target)
+    simulation.skip_quiet_samples = False
+    clock = simulation.clock
+    thermostat = simulation.thermostat
+    while clock.time() <= end:
+        sensor.advance(clock.time(), simulation._actually_on)
+        thermostat.thermometer.temperature = sensor.sample(clock.time())
+        thermostat.iterate()
+        simulation._log_changes()
+        clock.set_clock(clock.time() + 60)
+    return simulation.events
+
+
+class TestSimulation(TestCase):
+
+    def test_house_matches_stepping(self):
+        end = 7 * 86400
+        expected = step_every_minute(house(), 68, end)
+        self.assertGreater(len(expected), 100)
+        simulation = Simulation.for_target(house(), 68)
+        simulation.skip_quiet_samples = False
+        self.assertEquals(simulation.run(end), expected)
+        # the same events, though the thermostat may have seen an earlier reading when they happen
+        simulation = Simulation.for_target(house(), 68)
+        self.assertEquals([event[:2] for event in simulation.run(end)], [event[:2] for event in expected])
+        # skipping quiet samples leaves a fraction of the work
+        self.assertLess(simulation.samples, end / 60 / 10)
+
+    def test_trace_matches_stepping(self):
+        times = range(0, 2 * 86400, 60)
+        temperatures = [68 + 3 * math.sin(2 * math.pi * t / 5000.) for t in times]
+        expected = step_every_minute(TraceSensor(times, temperatures), 68, times[-1])
+        self.assertGreater(len(expected), 10)
+        simulation = Simulation.for_target(TraceSensor(times, temperatures), 68)
+        simulation.skip_quiet_samples = False
+        self.assertEquals(simulation.run(times[-1]), expected)
+        simulation = Simulation.for_target(TraceSensor(times, temperatures), 68)
+        self.assertEquals([event[:2] for event in simulation.run(times[-1])], [event[:2] for event in expected])
+
+    def test_deadlines_between_samples(self):
+        # readings every 10 minutes, but the heater comes on exactly 5 minutes after the
+        # first reading below the threshold
+        sensor = TraceSensor([0, 600, 1200], [68, 66, 66])
+        simulation = Simulation.for_target(sensor, 68)
+        events = simulation.run(1200)
+        self.assertEquals(events[:2], [(900, "request on", 66), (900, "heater on", 66)])
+
+    def test_heater_cycles_off_at_maximum_on_time(self):
+        # too cold for the heater to ever reach the target
+        sensor = HouseSensor(ThermalModel(LOSS_RATE, HEATING_RATE), 0, temperature=50)
+        simulation = Simulation.for_target(sensor, 68)
+        simulation.run(3 * 3600)
+        self.assertIn((300 + 3600, "heater off", simulation.events[2][2]), simulation.events)
+        self.assertEquals(simulation.cycle_count, 3)
+
+    def test_heating_season_is_fast(self):
+        sensor = HouseSensor(ThermalModel(LOSS_RATE, HEATING_RATE),
+                             lambda t: 40 - 15 * math.cos(2 * math.pi * t / (365 * 86400.)) - 8 * math.cos(
+                                 2 * math.pi * t / 86400.))
+        simulation = Simulation.for_target(sensor, 68)
+        # without the debug logging the other tests turn on, a line for every cycle
+        logging.disable(logging.INFO)
+        try:
+            simulation.run(180 * 86400)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertGreater(simulation.cycle_count, 180)
+        # a sample for every 50 minutes or more, rather than every minute, and a few thermostat
+        # iterations per heater cycle. the time it takes is measured by bench/run_bench.py.
+        self.assertLess(simulation.samples, 180 * 1440 / 50)
+        self.assertLess(simulation.iterations, 4 * simulation.cycle_count)
+
+    def test_log_format(self):
+        simulation = Simulation.for_target(TraceSensor([0, 600], [66, 66]), 68)
+        simulation.run(600)
+        self.assertEquals(simulation.format_log().splitlines()[0], "1970-01-01 00:05:00 request on   66.0000")
+
+    def test_uses_existing_thermostat(self):
+        clock = SimulationClock()
+        thermostat = Thermostat(HeaterCycleProtection(AbstractHeater(), clock), SimulatedThermometer(), clock)
+        thermostat.set_target_temperature(68)
+        thermostat.current_mode = 'target'
+        thermostat.model = ThermalModel()
+        simulation = Simulation(thermostat, TraceSensor([0, 60, 120], [66, 66, 66]))
+        self.assertFalse(simulation.skip_quiet_samples)
+        simulation.run(120)
+        self.assertEquals(simulation.samples, 3)
@@ -0,0 +1,133 @@
+import random
+import sqlite3
+import logging
+from unittest import TestCase
+
+import numpy as np
+
+from helpers import ThermostatException
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from sweep import ParameterSweep, load_readings
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class CountingHeater(AbstractHeater):
+    """A heater that counts how many times it was turned on"""
+
+    def __init__(self):
+        self.cycle_count = 0
+
+    def set_to_on(self, val):
+        if val and not self._heater_is_on:
+            self.cycle_count += 1
+        AbstractHeater.set_to_on(self, val)
+
+
+def run_scalar(times, temperatures, parameters):
+    """Replays a trace through the real Thermostat and HeaterCycleProtection classes"""
+    clock = TestClock()
+    thermometer = TestThermometer()
+    heater = CountingHeater()
+    protection = HeaterCycleProtection(heater, clock)
+    protection.minimum_on_time = parameters['minimum_on_time']
+    protection.minimum_off_time = parameters['minimum_off_time']
+    protection.maximum_on_time = parameters['maximum_on_time']
+    thermostat = Thermostat(protection, thermometer, clock)
+    thermostat.threshold_time_delay = parameters['threshold_time_delay']
+    thermostat.set_target_temperature(parameters['target_temp'])
+
+    heater_on_time = 0
+    time_outside_band = 0
+    for i, (the_time, temperature) in enumerate(zip(times, temperatures)):
+        if i > 0:
+            elapsed = the_time - times[i - 1]
+            heater_on_time += elapsed * heater.is_on()
+            time_outside_band += elapsed * (temperatures[i - 1] < thermostat.threshold_low or
+                                            temperatures[i - 1] > thermostat.threshold_high)
+        clock.set_clock(the_time)
+        thermometer.temperature = temperature
+        if i == 0:
+            thermostat.set_mode('target')
+        else:
+            thermostat.iterate()
+    return heater.cycle_count, heater_on_time, time_outside_band
+
+
+class TestParameterSweep(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        random.seed(0)
+        # a random walk around 68 degrees, sampled roughly every minute
+        cls.times = []
+        cls.temperatures = []
+        the_time = 1000.0
+        temperature = 68.0
+        for _ in range(1500):
+            the_time += random.choice([30, 60, 60, 60, 90, 240])
+            temperature += random.choice([-0.5, -0.25, 0, 0, 0.25, 0.5])
+            temperature = min(max(temperature, 63), 73)
+            cls.times.append(the_time)
+            cls.temperatures.append(temperature)
+
+    def test_matches_scalar_classes(self):
+        sweep = ParameterSweep.from_grid(target_temp=[67, 68.5],
+                                         threshold_time_delay=[0, 120, 300],
+                                         minimum_on_time=[60, 300, 900],
+                                         minimum_off_time=[0, 300],
+                                         maximum_on_time=[600, 3600])
+        results = sweep.run(self.times, self.temperatures)
+        self.assertEquals(sweep.size, 72)
+        # the trace should exercise the heater
+        self.assertTrue((results['cycle_count'] > 0).all())
+        for i in range(sweep.size):
+            cycles, on_time, outside = run_scalar(self.times, self.temperatures, sweep.get_parameters(i))
+            self.assertEquals(results['cycle_count'][i], cycles, sweep.get_parameters(i))
+            self.assertEquals(results['heater_on_time'][i], on_time, sweep.get_parameters(i))
+            self.assertEquals(results['time_outside_band'][i], outside, sweep.get_parameters(i))
+
+    def test_maximum_on_time(self):
+        # always cold, heater runs for the maximum time then rests for the minimum off time
+        times = np.arange(0, 4 * 60 * 60, 60)
+        temperatures = np.full(len(times), 60)
+        sweep = ParameterSweep(target_temp=68, threshold_time_delay=0, minimum_off_time=600,
+                               maximum_on_time=[1800, 3600])
+        results = sweep.run(times, temperatures)
+        self.assertEquals(results['cycle_count'].tolist(), [6, 4])
+        self.assertTrue((results['time_outside_band'] == times[-1]).all())
+
+    def test_broadcast_parameters(self):
+        sweep = ParameterSweep(target_temp=[66, 68, 70], minimum_on_time=60)
+        self.assertEquals(sweep.size, 3)
+        self.assertEquals(sweep.minimum_on_time.tolist(), [60, 60, 60])
+        self.assertEquals(sweep.threshold_low.tolist(), [65, 67, 69])
+
+    def test_target_out_of_range(self):
+        with self.assertRaises(ThermostatException):
+            ParameterSweep(target_temp=[68, 90])
+
+    def test_unknown_grid_parameter(self):
+        with self.assertRaises(ThermostatException):
+            ParameterSweep.from_grid(target_temp=[68], threshold=[1])
+
+    def test_load_readings(self):
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE temp(id INTEGER PRIMARY KEY, read_time DATETIME, temperature FLOAT)")
+        db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+                       [("2016-02-15 10:00:00", 67.5), ("2016-02-15 10:01:00", 67.0)])
+        times, temperatures = load_readings(db)
+        self.assertEquals(np.diff(times).tolist(), [60])
+        self.assertEquals(temperatures.tolist(), [67.5, 67.0])
+
+    def test_load_readings_epoch(self):
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE temp(id INTEGER PRIMARY KEY, read_time INTEGER, temperature FLOAT)")
+        db.execute("PRAGMA user_version=2")
+        db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+                       [(1455544800, 67.5), (1455544860, 67.0)])
+        times, temperatures = load_readings(db)
+        self.assertEquals(times.tolist(), [1455544800, 1455544860])
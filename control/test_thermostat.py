@@ -1,10 +1,15 @@
+import os
+import sys
 import random
 import logging
+import subprocess
 from unittest import TestCase
 
 from helpers import ThermostatException
+import thermostat
 from thermostat import Thermostat
-from heater import HeaterCycleProtection
+from decision_trace import TURN_ON
+from heater import AbstractHeater, HeaterCycleProtection
 from test_heaterControl import TestClock
 
 logging.basicConfig(level=logging.DEBUG)
@@ -147,6 +152,13 @@ class TestThermostat(TestCase):
         self.thermostat.iterate()
         self.assertTrue(self.heater.is_on())
 
+    def test_metrics(self):
+        decisions = thermostat._decisions[TURN_ON].value
+        iterations = thermostat._iterate_seconds.count
+        self.helper_get_cold_to_trigger_heater()
+        self.assertEquals(thermostat._decisions[TURN_ON].value, decisions + 1)
+        self.assertEquals(thermostat._iterate_seconds.count, iterations + 2)
+
     def test_turn_heater_on_when_too_cold_helper(self):
         self.helper_get_cold_to_trigger_heater()
 
@@ -188,6 +200,28 @@ class TestThermostat(TestCase):
         self.thermostat.iterate()
         self.assertFalse(self.heater.is_on())
 
+    def test_turn_heater_off_without_temperature(self):
+        self.helper_get_cold_to_trigger_heater()
+        # the thermometer fails or goes stale
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = None
+        self.heater.exception_if_turned_off = False
+        self.thermostat.iterate()
+        self.assertFalse(self.heater.is_on())
+
+    def test_dont_heat_without_temperature(self):
+        # below threshold, then the thermometer fails before the delay is up
+        self.clock.advance_random()
+        self.thermometer.temperature = 66
+        self.thermostat.iterate()
+        self.clock.advance(minutes=1)
+        self.thermometer.temperature = None
+        for _ in range(10):
+            self.clock.advance(minutes=1)
+            self.thermostat.iterate()
+        self.assertIsNone(self.thermostat.crossed_below_low_threshold_at)
+        self.assertIsNone(self.thermostat.next_deadline())
+
     # def test_dont_cycle_off_heater_too_quickly(self):
     #     self.helper_get_cold_to_trigger_heater()
     #     # advance 1 minute, already warm enough, but don't cycle off heater yet
@@ -229,7 +263,7 @@ class TestThermostat(TestCase):
 
     def test_dont_keep_heater_on_forever(self):
         # use the real heater controller, not the test heater
-        self.heater = HeaterCycleProtection(self.clock)
+        self.heater = HeaterCycleProtection(AbstractHeater(), self.clock)
         self.thermostat = Thermostat(self.heater, self.thermometer, self.clock)
         self.thermostat.set_mode('on')
         # advance to just before time limit
@@ -240,3 +274,12 @@ class TestThermostat(TestCase):
         self.clock.advance(minutes=1)
         self.thermostat.iterate()
         self.assertFalse(self.heater.is_on())
+
+
+class TestPackage(TestCase):
+
+    def test_import_without_common(self):
+        # the package from the repository root, in an interpreter without common/ on the path
+        code = "import control; control.Thermostat()"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEquals(subprocess.call([sys.executable, "-c", code], cwd=root), 0)
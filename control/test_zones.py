@@ -0,0 +1,123 @@
+import random
+import logging
+from unittest import TestCase
+
+from helpers import ThermostatException
+from thermostat import Thermostat
+from heater import AbstractHeater, HeaterCycleProtection
+from zones import ZoneBank
+from test_heaterControl import TestClock
+from test_thermostat import TestThermometer
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestZoneBank(TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.clock = TestClock()
+        self.heaters = [AbstractHeater() for _ in range(8)]
+        self.bank = ZoneBank(8, heaters=self.heaters, clock=self.clock)
+
+    def test_matches_scalar_classes(self):
+        # the same zones, built from the scalar classes
+        thermometers = [TestThermometer() for _ in range(8)]
+        scalar_heaters = [AbstractHeater() for _ in range(8)]
+        thermostats = [Thermostat(HeaterCycleProtection(h, self.clock), t, self.clock)
+                       for h, t in zip(scalar_heaters, thermometers)]
+
+        temperatures = [68.0] * 8
+        for minute in range(2000):
+            # once in a while, change the settings of a random zone
+            if random.random() < 0.02:
+                i = random.randrange(8)
+                target = random.choice([66, 68, 70])
+                mode = random.choice(['target', 'target', 'on', 'off'])
+                thermostats[i].set_target_temperature(target)
+                thermostats[i].set_mode(mode)
+                self.bank[i].set_target_temperature(target)
+                self.bank[i].set_mode(mode)
+
+            temperatures = [min(max(t + random.choice([-0.5, 0, 0.5]), 62), 74) for t in temperatures]
+            for thermometer, temperature in zip(thermometers, temperatures):
+                thermometer.temperature = temperature
+            for thermostat in thermostats:
+                thermostat.iterate()
+            self.bank.tick(temperatures)
+
+            for i, thermostat in enumerate(thermostats):
+                zone = self.bank[i]
+                self.assertEquals(zone.get_heater_is_on(), thermostat.get_heater_is_on())
+                self.assertEquals(self.heaters[i].is_on(), scalar_heaters[i].is_on())
+                self.assertEquals(zone.current_mode, thermostat.current_mode)
+            self.clock.advance(minutes=random.choice([0.5, 1, 1, 2]))
+
+        self.assertTrue(self.bank.cycle_count.sum() > 0)
+
+    def test_turn_on_heater_manually(self):
+        self.bank[3].set_mode('on')
+        self.assertTrue(self.bank[3].get_heater_is_on())
+        self.assertTrue(self.heaters[3].is_on())
+        self.assertFalse(self.heaters[2].is_on())
+
+    def test_turn_heater_on_when_too_cold(self):
+        zone = self.bank[0]
+        zone.set_target_temperature(68)
+        zone.set_mode('target')
+        temperatures = [68] * 8
+        temperatures[0] = 66
+        self.bank.tick(temperatures)
+        self.clock.advance(minutes=4.9)
+        self.bank.tick()
+        self.assertFalse(zone.get_heater_is_on())
+        self.clock.advance(minutes=0.1)
+        self.bank.tick()
+        self.assertTrue(zone.get_heater_is_on())
+        self.assertTrue(self.heaters[0].is_on())
+        self.assertEquals(zone.get_room_temperature(), 66)
+
+    def test_zone_iterate_only_touches_its_zone(self):
+        for i in range(2):
+            self.bank[i].set_target_temperature(68)
+            self.bank[i].set_mode('target')
+        self.bank[0].set_room_temperature(60)
+        self.bank[1].set_room_temperature(60)
+        self.bank[0].iterate()
+        self.assertEquals(self.bank.crossed_below_low_threshold_at[0], 0)
+        self.assertNotEquals(self.bank.crossed_below_low_threshold_at[1], 0)
+
+    def test_zone_iterate_switches_its_heater(self):
+        zone = self.bank[-1]
+        zone.set_target_temperature(68)
+        zone.set_mode('target')
+        zone.set_room_temperature(60)
+        self.bank[6].set_room_temperature(60)
+        zone.iterate()
+        # still off just before the delay ends
+        self.clock.advance(seconds=Thermostat.threshold_time_delay - 1)
+        zone.iterate()
+        self.assertFalse(self.heaters[7].is_on())
+        self.clock.advance(seconds=1)
+        zone.iterate()
+        self.assertTrue(self.heaters[7].is_on())
+        self.assertEquals(self.bank.cycle_count.tolist(), [0] * 7 + [1])
+
+    def test_set_point(self):
+        zone = self.bank[5]
+        self.assertIsNone(zone.get_target_temperature())
+        zone.set_target_temperature(70)
+        self.assertEquals(zone.get_target_temperature(), 70)
+        self.assertEquals(zone.threshold_low, 69)
+        self.assertEquals(zone.threshold_high, 71)
+        with self.assertRaises(ThermostatException):
+            zone.set_target_temperature(83)
+        with self.assertRaises(ThermostatException):
+            zone.set_mode('auto')
+
+    def test_zone_index(self):
+        self.assertEquals(self.bank[-1].index, 7)
+        with self.assertRaises(IndexError):
+            self.bank[8]
+        with self.assertRaises(ThermostatException):
+            ZoneBank(2, heaters=self.heaters)
@@ -1,7 +1,16 @@
+import time
 import logging
 
-from helpers import ThermostatException, Clock
-from heater import HeaterCycleProtection
+from helpers import ThermostatException, Clock, metrics
+from heater import AbstractHeater, HeaterCycleProtection
+from decision_trace import NO_DECISION, TURN_ON, TURN_OFF
+
+# wall clock time of each iterate(), whatever clock the thermostat runs on
+_iterate_seconds = metrics.histogram("thermostat_iterate_seconds", "Time taken by each Thermostat.iterate()")
+_decisions = {
+    TURN_ON: metrics.counter("thermostat_decisions_total", "Heater decisions made by the thermostat", decision="on"),
+    TURN_OFF: metrics.counter("thermostat_decisions_total", "Heater decisions made by the thermostat", decision="off"),
+}
 
 
 class Thermostat(object):
@@ -18,26 +27,54 @@ class Thermostat(object):
     crossed_below_low_threshold_at = None
     crossed_above_high_threshold_at = None
     threshold_time_delay = 5 * 60 # 5 minutes
+    # optional DecisionTrace that records every iteration
+    trace = None
+    # optional ThermalModel, updated every iteration and used to start scheduled targets early
+    # enough to reach them on time. it needs the outdoor temperature from outdoor_thermometer.
+    model = None
+    outdoor_thermometer = None
+    # (temperature, time) set by schedule_target()
+    scheduled_target = None
 
-    def __init__(self, heater=HeaterCycleProtection(), thermometer=None, clock=Clock()):
+    def __init__(self, heater=None, thermometer=None, clock=None):
+        if clock is None:
+            clock = Clock()
+        if heater is None:
+            heater = HeaterCycleProtection(AbstractHeater(), clock)
         self.heater = heater
         self.clock = clock
         self.thermometer = thermometer
 
     def iterate(self):
+        started = time.time()
 
         # report
-        self._logger.debug("starting iterate() - mode={m}, heater={h}, temp={t}, targets={x}, clock={c}".format( \
-            m=self.current_mode,
-            h="on" if self.get_heater_is_on() else "off",
-            t=self.get_room_temperature(),
-            x="{}/{}/{}".format(self.threshold_low, self.target_temp, self.threshold_high),
-            c=self.clock.time()
-        ))
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("starting iterate() - mode={m}, heater={h}, temp={t}, targets={x}, clock={c}".format( \
+                m=self.current_mode,
+                h="on" if self.get_heater_is_on() else "off",
+                t=self.get_room_temperature(),
+                x="{}/{}/{}".format(self.threshold_low, self.target_temp, self.threshold_high),
+                c=self.clock.time()
+            ))
+
+        if self.model is not None:
+            self._update_model()
+        if self.scheduled_target is not None and self.clock.time() >= self.preheat_start_time():
+            self._logger.info("Starting scheduled target of {}".format(self.scheduled_target[0]))
+            self.set_target_temperature(self.scheduled_target[0])
+            self.scheduled_target = None
 
         self.check_thresholds()
+        decision = NO_DECISION
 
-        if self.current_mode == "target":
+        if self.current_mode == "target" and self.get_room_temperature() is None:
+            # the thermometer has failed or gone stale. fail safe rather than heat blind.
+            if self.get_heater_is_on():
+                self._logger.warn("No room temperature, turning off heater")
+                self.heater.set_to_on(False)
+                decision = TURN_OFF
+        elif self.current_mode == "target":
             # if we've been below threshold and...
             #    the heater isn't currently on and...
             #    we've been below threshold long enough
@@ -47,6 +84,7 @@ class Thermostat(object):
                     (self.clock.time() >= (self.crossed_below_low_threshold_at + self.threshold_time_delay)):
                     self._logger.info("Too long below threshold, turning on heater")
                     self.heater.set_to_on(True)
+                    decision = TURN_ON
 
             # opposite above for turning off heater
             if self.crossed_above_high_threshold_at is not None and \
@@ -54,13 +92,106 @@ class Thermostat(object):
                     (self.clock.time() >= (self.crossed_above_high_threshold_at + self.threshold_time_delay)):
                     self._logger.info("Too long above threshold, turning off heater")
                     self.heater.set_to_on(False)
+                    decision = TURN_OFF
 
         # iterate the heater
         self.heater.iterate()
 
+        if decision != NO_DECISION:
+            _decisions[decision].inc()
+
+        if self.trace is not None:
+            self.trace.record(self.clock.time(), self.get_room_temperature(), self.current_mode,
+                              self.threshold_low, self.threshold_high, self.get_heater_is_on(),
+                              self.heater.is_actually_on() if hasattr(self.heater, "is_actually_on")
+                              else self.heater.is_on(),
+                              decision)
+        _iterate_seconds.observe(time.time() - started)
+
+    def next_deadline(self):
+        """The next time at which .iterate() has something to do, or None if nothing is scheduled.
+
+        This only covers the passage of time. A new temperature reading can also make .iterate()
+        do something, so it should be called whenever the thermometer changes as well.
+        """
+        deadlines = []
+        if self.current_mode == "target":
+            if self.crossed_below_low_threshold_at is not None and not self.get_heater_is_on():
+                deadlines.append(self.crossed_below_low_threshold_at + self.threshold_time_delay)
+            if self.crossed_above_high_threshold_at is not None and self.get_heater_is_on():
+                deadlines.append(self.crossed_above_high_threshold_at + self.threshold_time_delay)
+        if hasattr(self.heater, "next_deadline"):
+            deadlines.append(self.heater.next_deadline())
+        if self.scheduled_target is not None:
+            deadlines.append(self.preheat_start_time())
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def get_state(self):
+        """The mode, target and threshold crossings, with the heater's state if it keeps one,
+        as a dictionary for saving with journal.StateJournal and restoring with set_state()"""
+        state = {
+            'mode': self.current_mode,
+            'target_temp': self.target_temp,
+            'crossed_below_low_threshold_at': self.crossed_below_low_threshold_at,
+            'crossed_above_high_threshold_at': self.crossed_above_high_threshold_at,
+            'scheduled_target': list(self.scheduled_target) if self.scheduled_target is not None else None,
+        }
+        if hasattr(self.heater, "get_state"):
+            state['heater'] = self.heater.get_state()
+        return state
+
+    def set_state(self, state):
+        """Restores a state from get_state(), without iterating"""
+        if state['target_temp'] is not None:
+            self.set_target_temperature(state['target_temp'])
+        self.current_mode = state['mode']
+        self.crossed_below_low_threshold_at = state['crossed_below_low_threshold_at']
+        self.crossed_above_high_threshold_at = state['crossed_above_high_threshold_at']
+        self.scheduled_target = tuple(state['scheduled_target']) if state['scheduled_target'] is not None else None
+        if 'heater' in state and hasattr(self.heater, "set_state"):
+            self.heater.set_state(state['heater'])
+
     def get_heater_is_on(self):
         return self.heater.is_on()
 
+    def schedule_target(self, temp, at_time):
+        """Sets the target temperature to reach by at_time
+
+        The target is set at at_time, or earlier if the model says the heater needs longer to
+        reach it, allowing for the threshold_time_delay before the heater comes on. The target
+        applies in target mode like any other.
+        """
+        self._check_target_limits(temp)
+        self.scheduled_target = (temp, at_time)
+
+    def preheat_start_time(self):
+        """The time at which the scheduled target will be set, or None if there isn't one"""
+        if self.scheduled_target is None:
+            return None
+        temp, at_time = self.scheduled_target
+        outdoor_temp = self.outdoor_thermometer.temperature if self.outdoor_thermometer is not None else None
+        room_temp = self.get_room_temperature()
+        if self.model is None or outdoor_temp is None or room_temp is None:
+            return at_time
+        # the heater comes on threshold_time_delay after the new target puts the room below its
+        # low threshold, and the room keeps cooling until then
+        room_temp = self.model.predict(room_temp, outdoor_temp, False, self.threshold_time_delay)
+        start = self.model.heater_start_time(temp, at_time, room_temp, outdoor_temp)
+        if start is None:
+            # the heater can't get there, start as soon as possible
+            return self.clock.time()
+        return min(start - self.threshold_time_delay, at_time)
+
+    def _update_model(self):
+        outdoor_temp = self.outdoor_thermometer.temperature if self.outdoor_thermometer is not None else None
+        room_temp = self.get_room_temperature()
+        if outdoor_temp is None or room_temp is None:
+            return
+        heater_is_on = self.heater.is_actually_on() if hasattr(self.heater, "is_actually_on") \
+            else self.heater.is_on()
+        self.model.update(self.clock.time(), room_temp, outdoor_temp, heater_is_on)
+
     def set_mode(self, mode):
         if mode not in self.available_modes:
             raise ThermostatException("Unrecognized mode: {}".format(mode))
@@ -83,10 +214,7 @@ class Thermostat(object):
         return self.thermometer.temperature
 
     def set_target_temperature(self, temp):
-        if temp > self.target_maximum:
-            raise ThermostatException("Can not set target above limit of {}".format(self.target_maximum))
-        if temp < self.target_minimum:
-            raise ThermostatException("Can not set target below limit of {}".format(self.target_minimum))
+        self._check_target_limits(temp)
         self.target_temp = temp
         self.threshold_low = temp - 1
         self.threshold_high = temp + 1
@@ -94,11 +222,23 @@ class Thermostat(object):
     def get_target_temperature(self):
         return self.target_temp
 
+    def _check_target_limits(self, temp):
+        if temp > self.target_maximum:
+            raise ThermostatException("Can not set target above limit of {}".format(self.target_maximum))
+        if temp < self.target_minimum:
+            raise ThermostatException("Can not set target below limit of {}".format(self.target_minimum))
+
     def check_thresholds(self):
+        temperature = self.get_room_temperature()
+        # without a reading, neither threshold has been crossed
+        if temperature is None:
+            self.crossed_below_low_threshold_at = None
+            self.crossed_above_high_threshold_at = None
+            return
         # record threshold crossings
         if self.threshold_low is not None:
             # if below low threshold
-            if self.thermometer.temperature < self.threshold_low:
+            if temperature < self.threshold_low:
                 if self.crossed_below_low_threshold_at is None:
                     self.crossed_below_low_threshold_at = self.clock.time()
                     self._logger.debug("Exceeded low threshold")
@@ -109,7 +249,7 @@ class Thermostat(object):
                     self._logger.debug("Within low threshold");
         if self.threshold_high is not None:
             # if above high threshold
-            if self.thermometer.temperature > self.threshold_high:
+            if temperature > self.threshold_high:
                 if self.crossed_above_high_threshold_at is None:
                     self.crossed_above_high_threshold_at = self.clock.time()
                     self._logger.debug("Exceeded high threshold")
@@ -0,0 +1,298 @@
+import logging
+
+import numpy as np
+
+from helpers import Clock, ThermostatException
+from heater import HeaterCycleProtection
+from thermostat import Thermostat
+
+
+class ZoneBank(object):
+    """Holds the state of many thermostat zones in arrays and advances them all at once
+
+    Every zone behaves like a Thermostat driving its own HeaterCycleProtection. Instead of
+    one pair of objects per zone, the bank keeps each piece of state in an array with one
+    element per zone, reads the clock once per tick and updates every zone with a handful of
+    array operations. State that the scalar classes keep as None is kept as NaN here.
+
+    Per-zone views returned by bank[i] provide the familiar Thermostat methods, so existing
+    callers can keep using set_mode(), set_target_temperature(), get_heater_is_on(), etc.
+
+    Example:
+
+    bank = ZoneBank(3, heaters=[relay_1, relay_2, relay_3])
+    bank[0].set_target_temperature(68)
+    bank[0].set_mode('target')
+    ...
+    bank.tick(temperatures=[67.5, 70.1, 64.0])
+    """
+
+    # mode codes stored in the mode array are indexes in this list
+    available_modes = Thermostat.available_modes
+    _off, _on, _target = [available_modes.index(m) for m in ['off', 'on', 'target']]
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, size, heaters=None, clock=None):
+        """
+
+        :param size: the number of zones
+        :param heaters: optional list of the underlying heaters, one per zone. See AbstractHeater.
+        :param clock: the instance used to determine time. This is only here to facilitate
+        testing. In production, the default should be used.
+        """
+        if heaters is not None and len(heaters) != size:
+            raise ThermostatException("Got {} heaters for {} zones".format(len(heaters), size))
+        self.size = size
+        self._heaters = heaters
+        self._clock = clock if clock else Clock()
+
+        # settings, initially the same defaults as the scalar classes
+        self.threshold_time_delay = np.full(size, float(Thermostat.threshold_time_delay))
+        self.minimum_on_time = np.full(size, float(HeaterCycleProtection.minimum_on_time))
+        self.minimum_off_time = np.full(size, float(HeaterCycleProtection.minimum_off_time))
+        self.maximum_on_time = np.full(size, float(HeaterCycleProtection.maximum_on_time))
+        self.target_temp = np.full(size, np.nan)
+        self.threshold_low = np.full(size, np.nan)
+        self.threshold_high = np.full(size, np.nan)
+        self.mode = np.full(size, self._off, dtype=np.int8)
+
+        # latest room temperature of each zone
+        self.temperature = np.full(size, np.nan)
+
+        self.reset()
+
+    def reset(self):
+        """Clears the thermostat and cycle protection state of every zone"""
+        n = self.size
+        # Thermostat state
+        self.crossed_below_low_threshold_at = np.full(n, np.nan)
+        self.crossed_above_high_threshold_at = np.full(n, np.nan)
+        # HeaterCycleProtection state
+        self.no_turn_on_before = np.full(n, np.nan)
+        self.no_turn_off_before = np.full(n, np.nan)
+        self.turn_on_time = np.full(n, np.nan)
+        self.turn_off_time = np.full(n, np.nan)
+        self.on_since = np.full(n, np.nan)
+        self.off_since = np.full(n, np.nan)
+        self.intended_on = np.zeros(n, dtype=bool)
+        self.actually_on = np.zeros(n, dtype=bool)
+        # number of times each heater was actually turned on
+        self.cycle_count = np.zeros(n, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not -self.size <= i < self.size:
+            raise IndexError("Zone {} out of range".format(i))
+        return ZoneView(self, i % self.size)
+
+    def tick(self, temperatures=None):
+        """Advances every zone to the current time
+
+        :param temperatures: optional new room temperatures, one per zone (or a single value for
+        all zones). If not given, the last temperatures set on the bank are used.
+        """
+        if temperatures is not None:
+            self.temperature[:] = temperatures
+        self._advance(self._clock.time())
+
+    def next_deadline(self):
+        """The earliest time at which any zone has something to do, or None if nothing is scheduled.
+
+        See Thermostat.next_deadline()
+        """
+        with np.errstate(invalid='ignore'):
+            in_target_mode = self.mode == self._target
+            deadlines = [np.where(in_target_mode & ~self.intended_on,
+                                  self.crossed_below_low_threshold_at + self.threshold_time_delay, np.nan),
+                         np.where(in_target_mode & self.intended_on,
+                                  self.crossed_above_high_threshold_at + self.threshold_time_delay, np.nan),
+                         self.turn_on_time,
+                         self.turn_off_time,
+                         np.where(np.isnan(self.turn_off_time), self.on_since + self.maximum_on_time, np.nan),
+                         ]
+        if not self.size:
+            return None
+        earliest = np.fmin.reduce(np.concatenate(deadlines))
+        return None if np.isnan(earliest) else earliest.item()
+
+    def _advance(self, the_time, zones=slice(None)):
+        """Vectorized Thermostat.iterate() for every zone, or the zones in the slice
+
+        The helpers below work on views of the arrays for the zones in the slice, so advancing
+        one zone is a handful of one element operations rather than a pass over the whole bank.
+        """
+        was_on = self.actually_on[zones].copy()
+        with np.errstate(invalid='ignore'):
+            self._check_thresholds(the_time, zones)
+
+            in_target_mode = self.mode[zones] == self._target
+            threshold_time_delay = self.threshold_time_delay[zones]
+
+            # been below threshold long enough with the heater off
+            turn_on = in_target_mode & ~self.intended_on[zones] & \
+                (the_time >= self.crossed_below_low_threshold_at[zones] + threshold_time_delay)
+            self._set_to_on(turn_on, True, the_time, zones)
+
+            # been above threshold long enough with the heater on
+            turn_off = in_target_mode & self.intended_on[zones] & \
+                (the_time >= self.crossed_above_high_threshold_at[zones] + threshold_time_delay)
+            self._set_to_on(turn_off, False, the_time, zones)
+
+            self._iterate_heater(the_time, zones)
+        self._update_heaters(was_on, zones)
+
+    def _check_thresholds(self, the_time, zones=slice(None)):
+        """Vectorized Thermostat.check_thresholds()"""
+        temperature = self.temperature[zones]
+        below = self.crossed_below_low_threshold_at[zones]
+        above = self.crossed_above_high_threshold_at[zones]
+        below[:] = np.where(temperature < self.threshold_low[zones], np.fmin(below, the_time), np.nan)
+        above[:] = np.where(temperature > self.threshold_high[zones], np.fmin(above, the_time), np.nan)
+
+    def _set_to_on(self, mask, val, the_time, zones=slice(None)):
+        """Vectorized HeaterCycleProtection.set_to_on() for the zones in mask, a boolean array
+        over the zones in the slice"""
+        intended_on = self.intended_on[zones]
+        actually_on = self.actually_on[zones]
+        turn_on_time = self.turn_on_time[zones]
+        turn_off_time = self.turn_off_time[zones]
+        if val:
+            intended_on |= mask
+            starting = mask & ~actually_on
+            turn_on_time[starting] = np.fmax(self.no_turn_on_before[zones][starting], the_time)
+            turn_off_time[mask] = np.nan
+        else:
+            intended_on &= ~mask
+            stopping = mask & actually_on
+            turn_off_time[stopping] = np.fmax(self.no_turn_off_before[zones][stopping], the_time)
+            turn_on_time[mask] = np.nan
+
+    def _iterate_heater(self, the_time, zones=slice(None)):
+        """Vectorized HeaterCycleProtection.iterate() for every zone, or the zones in the slice"""
+        actually_on = self.actually_on[zones]
+        turn_on_time = self.turn_on_time[zones]
+        turn_off_time = self.turn_off_time[zones]
+        on_since = self.on_since[zones]
+        off_since = self.off_since[zones]
+        no_turn_on_before = self.no_turn_on_before[zones]
+        no_turn_off_before = self.no_turn_off_before[zones]
+
+        # passed the turn off time
+        turning_off = turn_off_time <= the_time
+        if turning_off.any():
+            actually_on &= ~turning_off
+            turn_off_time[turning_off] = np.nan
+            turn_on_time[turning_off] = np.nan
+            on_since[turning_off] = np.nan
+            off_since[turning_off] = the_time
+            no_turn_off_before[turning_off] = np.nan
+            no_turn_on_before[turning_off] = the_time + self.minimum_off_time[zones][turning_off]
+
+        # passed the turn on time
+        turning_on = turn_on_time <= the_time
+        if turning_on.any():
+            if (turning_on & turning_off).any():
+                raise ThermostatException("Already handled, this probably shouldn't be happening")
+            actually_on |= turning_on
+            turn_off_time[turning_on] = np.nan
+            turn_on_time[turning_on] = np.nan
+            on_since[turning_on] = the_time
+            off_since[turning_on] = np.nan
+            no_turn_off_before[turning_on] = the_time + self.minimum_on_time[zones][turning_on]
+            no_turn_on_before[turning_on] = np.nan
+            self.cycle_count[zones] += turning_on
+
+        # passed the maximum on time and a shutdown isn't already scheduled
+        maxed_out = np.isnan(turn_off_time) & (the_time - on_since >= self.maximum_on_time[zones])
+        if maxed_out.any():
+            if (maxed_out & (turning_on | turning_off)).any():
+                raise ThermostatException("Already handled, this probably shouldn't be happening")
+            self._logger.warn("{} zone(s) reached maximum consecutive on time. Scheduling for shutdown.".format(
+                np.count_nonzero(maxed_out)))
+            self._set_to_on(maxed_out, False, the_time, zones)
+            self._iterate_heater(the_time, zones)
+
+    def _update_heaters(self, was_on, zones=slice(None)):
+        """Switches the underlying heaters of the zones in the slice that changed state"""
+        if self._heaters is None:
+            return
+        first = zones.indices(self.size)[0]
+        for i in np.flatnonzero(was_on != self.actually_on[zones]):
+            self._heaters[first + i].set_to_on(bool(self.actually_on[first + i]))
+
+
+class ZoneView(object):
+    """A single zone of a ZoneBank with the same interface as Thermostat"""
+
+    available_modes = Thermostat.available_modes
+    target_maximum = Thermostat.target_maximum
+    target_minimum = Thermostat.target_minimum
+
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
+        # the bank's helpers take a slice, which indexes a view of this zone's elements only
+        self._zone = slice(index, index + 1)
+
+    def iterate(self):
+        self.bank._advance(self.bank._clock.time(), self._zone)
+
+    @property
+    def current_mode(self):
+        return self.available_modes[self.bank.mode[self.index]]
+
+    @property
+    def threshold_low(self):
+        return _none_if_nan(self.bank.threshold_low[self.index])
+
+    @property
+    def threshold_high(self):
+        return _none_if_nan(self.bank.threshold_high[self.index])
+
+    def get_heater_is_on(self):
+        return bool(self.bank.intended_on[self.index])
+
+    def get_heater_is_actually_on(self):
+        return bool(self.bank.actually_on[self.index])
+
+    def set_mode(self, mode):
+        if mode not in self.available_modes:
+            raise ThermostatException("Unrecognized mode: {}".format(mode))
+
+        if mode in ("on", "off"):
+            bank = self.bank
+            the_time = bank._clock.time()
+            was_on = bank.actually_on[self._zone].copy()
+            with np.errstate(invalid='ignore'):
+                bank._set_to_on(np.ones(1, dtype=bool), mode == "on", the_time, self._zone)
+                bank._iterate_heater(the_time, self._zone)
+            bank._update_heaters(was_on, self._zone)
+
+        self.bank.mode[self.index] = self.available_modes.index(mode)
+        self.iterate()
+
+    def get_room_temperature(self):
+        return _none_if_nan(self.bank.temperature[self.index])
+
+    def set_room_temperature(self, temp):
+        self.bank.temperature[self.index] = temp
+
+    def set_target_temperature(self, temp):
+        if temp > self.target_maximum:
+            raise ThermostatException("Can not set target above limit of {}".format(self.target_maximum))
+        if temp < self.target_minimum:
+            raise ThermostatException("Can not set target below limit of {}".format(self.target_minimum))
+        self.bank.target_temp[self.index] = temp
+        self.bank.threshold_low[self.index] = temp - 1
+        self.bank.threshold_high[self.index] = temp + 1
+
+    def get_target_temperature(self):
+        return _none_if_nan(self.bank.target_temp[self.index])
+
+
+def _none_if_nan(value):
+    value = value.item()
+    return None if value != value else value
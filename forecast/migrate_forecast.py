@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Upgrade the forecast tables of an existing database to the current layout
+
+Version 1 kept every forecast in one table, with an is_latest flag that was cleared on every
+row each time a run was added. Version 2 has a forecast_runs table and a latest_run pointer,
+see query_forecast.setup_database(). Each distinct create_datetime becomes a run.
+
+Usage: migrate_forecast.py db_path
+"""
+import os
+import sys
+import sqlite3
+import logging
+
+if __name__ == '__main__':
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import query_forecast
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(db):
+	"""Upgrades the forecast tables in place. Returns the number of runs found."""
+	if query_forecast.database_version(db) >= query_forecast.schema_version:
+		return 0
+
+	# the whole upgrade is one transaction, so python's sqlite3 mustn't commit before the
+	# CREATE/DROP/ALTER statements
+	isolation_level = db.isolation_level
+	db.isolation_level = None
+	try:
+		db.execute("BEGIN")
+		db.execute("ALTER TABLE forecasts RENAME TO forecasts_v1")
+		db.execute("DROP INDEX IF EXISTS forecast_unique")
+		query_forecast.create_tables(db)
+		db.execute("""
+		INSERT INTO forecast_runs(create_datetime)
+		SELECT DISTINCT create_datetime FROM forecasts_v1 ORDER BY create_datetime
+		""")
+		db.execute("""
+		INSERT INTO forecasts(run_id, forecast_datetime, temperature)
+		SELECT run_id, forecast_datetime, temperature FROM forecasts_v1 JOIN forecast_runs USING (create_datetime)
+		""")
+		db.execute("""
+		INSERT INTO latest_run(id, run_id)
+		SELECT 0, run_id FROM forecast_runs ORDER BY run_id DESC LIMIT 1
+		""")
+		runs = db.execute("SELECT count(*) FROM forecast_runs").fetchone()[0]
+		db.execute("DROP TABLE forecasts_v1")
+		db.execute("COMMIT")
+	except Exception:
+		try:
+			db.execute("ROLLBACK")
+		except sqlite3.OperationalError:
+			# no transaction was open
+			pass
+		raise
+	finally:
+		db.isolation_level = isolation_level
+	_logger.info("Migrated {} forecast runs".format(runs))
+	return runs
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	if len(sys.argv) < 2:
+		sys.exit(__doc__)
+	db_path = sys.argv[1]
+	if not os.path.exists(db_path):
+		sys.exit("Database path does not exist: {}".format(db_path))
+	db = sqlite3.connect(db_path)
+	runs = migrate(db)
+	print "Migrated {} forecast runs".format(runs)
@@ -1,65 +1,155 @@
 #!/usr/bin/env python
 
-import urllib2
 import json
 import sqlite3
 import datetime
 import sys, os
 
+if __name__ == '__main__':
+	# the shared fetch layer lives next to this directory
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import fetch
+import metrics
+import store as store_module
+
 forecast_api_url="http://api.wunderground.com/api/9836d881af5d6fc2/hourly/q/NC/Charlotte.json"
 
-def query_and_save(db_path, verbose=False):
-	db = sqlite3.connect(db_path)
-	forecast_tuples = query_forecast(verbose)
-	append_records(db, forecast_tuples)
+_fetch_seconds, _fetch_bytes, _parse_seconds = metrics.collector_metrics("forecast")
+_commit_seconds, _rows_written = metrics.database_metrics("forecast")
+
+def query_and_save(db_path, verbose=False, fetcher=None, store=None):
+	"""Query the API and add the forecast to the database as a new run, and to the store if one is given
+
+	db_path may be None to only write to the store. Nothing is written if the forecast hasn't
+	changed since the last query. The response is only cached as seen once it has been
+	written, so a failed write is retried on the next query. Returns the new run_id, or None if
+	nothing was written.
+	"""
+	if fetcher is None:
+		fetcher = fetch.CachedFetcher()
+	response = _fetch(fetcher, verbose)
+	if not response.changed:
+		if verbose:
+			print "Forecast unchanged"
+		return None
+	with _parse_seconds.time():
+		forecast_tuples = parse_forecast(response.body)
+	run_id = None
+	if store is not None:
+		run_id = store.add_run('forecast', [(store_module.local_epoch(forecast_datetime), temperature)
+		                                    for forecast_datetime, temperature in forecast_tuples])
+	if db_path is not None:
+		run_id = append_records(sqlite3.connect(db_path), forecast_tuples)
+	fetcher.commit(forecast_api_url)
+	return run_id
+
+schema_version = 2
 
 def setup_database(db):
-	# setup table and index
-	sql = """
+	"""Creates the forecast tables (drop if already exists)
+
+	Each query of the API is a row in forecast_runs, and its forecasts are tagged with its
+	run_id. latest_run has a single row pointing at the most recent run. Rows are only ever
+	added, so the cost of adding a run doesn't grow with the history.
+	"""
+	db.execute("DROP TABLE IF EXISTS latest_run")
+	db.execute("DROP TABLE IF EXISTS forecasts")
+	db.execute("DROP TABLE IF EXISTS forecast_runs")
+	create_tables(db)
+	db.commit()
+
+def create_tables(db):
+	db.execute("""
+	CREATE TABLE forecast_runs(
+	  run_id INTEGER PRIMARY KEY,
+	  create_datetime DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)
+	""")
+	db.execute("CREATE INDEX forecast_runs_created ON forecast_runs(create_datetime)")
+	db.execute("""
 	CREATE TABLE forecasts(
-	  create_datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-	  is_latest BOOLEAN default(1),
+	  run_id INTEGER NOT NULL REFERENCES forecast_runs(run_id),
 	  forecast_datetime DATETIME,
 	  temperature NUMERIC)
-	"""
-	db.execute("DROP TABLE IF EXISTS forecasts")
-	db.execute(sql)
+	""")
+	db.execute("CREATE UNIQUE INDEX forecast_run ON forecasts(run_id, forecast_datetime)")
+	db.execute("""
+	CREATE TABLE latest_run(
+	  id INTEGER PRIMARY KEY CHECK (id = 0),
+	  run_id INTEGER NOT NULL REFERENCES forecast_runs(run_id))
+	""")
+	db.execute("PRAGMA user_version={}".format(schema_version))
 
-	db.execute("DROP INDEX IF EXISTS forecast_unique")
-	db.execute("CREATE UNIQUE INDEX forecast_unique ON forecasts(create_datetime, forecast_datetime)")
-	db.commit()	
+def database_version(db):
+	"""The layout version of the forecast tables in the database"""
+	version = db.execute("PRAGMA user_version").fetchone()[0]
+	# databases created before the version was recorded
+	return version or 1
 
-def append_records(db, forecast_tuples):
-	"""Add records to the setup_database
+def append_records(db, forecast_tuples, create_datetime=None):
+	"""Add records to the setup_database as a new run, and make it the latest
 
 	forecast_tuples is a list of tuples in the form: [(datetime, temp), (datetime, temp), ...]
+	create_datetime is the UTC time of the run, and defaults to now. Returns the run_id.
 	"""
-	# clear is_latest flags
-	db.execute("UPDATE forecasts SET is_latest=0")
-	db.executemany("INSERT INTO forecasts(forecast_datetime, temperature) VALUES(?, ?)", forecast_tuples)
-	db.commit()
+	with _commit_seconds.time(), db:
+		if create_datetime is None:
+			curs = db.execute("INSERT INTO forecast_runs DEFAULT VALUES")
+		else:
+			curs = db.execute("INSERT INTO forecast_runs(create_datetime) VALUES(?)", (create_datetime,))
+		run_id = curs.lastrowid
+		db.executemany("INSERT INTO forecasts(run_id, forecast_datetime, temperature) VALUES(?, ?, ?)",
+		               [(run_id, forecast_datetime, temperature) for forecast_datetime, temperature in forecast_tuples])
+		db.execute("INSERT OR REPLACE INTO latest_run(id, run_id) VALUES(0, ?)", (run_id,))
+	_rows_written.inc(len(forecast_tuples))
+	return run_id
 
 def get_latest_records(db):
 	"""Provide a generator for the latest records in the form of forecast_tuples
 
 	Each yield is a tuples in the form: (u'datetime, temp)
 	"""
-	rows = db.execute("SELECT forecast_datetime, temperature FROM forecasts WHERE is_latest=1 ORDER BY forecast_datetime")
+	rows = db.execute("""
+	SELECT forecast_datetime, temperature FROM latest_run JOIN forecasts USING (run_id)
+	ORDER BY forecast_datetime
+	""")
+	for row in rows:
+	    yield (row[0], row[1])
+
+def get_records_as_of(db, as_of):
+	"""Provide a generator for the records of the last run at or before as_of
+
+	as_of is a UTC datetime. Each yield is a tuples in the form: (u'datetime, temp)
+	"""
+	rows = db.execute("""
+	SELECT forecast_datetime, temperature FROM forecasts
+	WHERE run_id = (SELECT run_id FROM forecast_runs WHERE create_datetime <= ?
+	                ORDER BY create_datetime DESC LIMIT 1)
+	ORDER BY forecast_datetime
+	""", (as_of,))
 	for row in rows:
 	    yield (row[0], row[1])
 
-def query_forecast(verbose=False):
+def query_forecast(verbose=False, fetcher=None):
 	"""Query weather.com API for hourly forecast
 	"""
+	return parse_forecast(_fetch(fetcher, verbose).body)
+
+def _fetch(fetcher, verbose):
+	if fetcher is None:
+		fetcher = fetch.CachedFetcher()
 	if verbose:
 		print "Querying weather.com for forecase...",
 		sys.stdout.flush()
-	f = urllib2.urlopen(forecast_api_url)
-	json_string = f.read()
-	f.close()
+	with _fetch_seconds.time():
+		response = fetcher.fetch(forecast_api_url)
+	_fetch_bytes.inc(len(response.body or ""))
 	if verbose:
 		print "Done"
 		sys.stdout.flush()
+	return response
+
+def parse_forecast(json_string):
+	"""The forecast_tuples in a response from the API"""
 	parsed_json = json.loads(json_string)
 	forecast_list = parsed_json['hourly_forecast']
 	forecast_tuples = [(datetime.datetime.strptime(forecast['FCTTIME']['pretty'], '%I:%M %p %Z on %B %d, %Y'),
@@ -75,5 +165,8 @@ if __name__ == '__main__':
 		print "Using database: {}".format(db_path)
 	else:
 		sys.exit("Database does not exist: {}".format(db_path))
-	query_and_save(db_path, verbose=True)
+	# optionally also write to a store
+	store = store_module.connect(sys.argv[2]) if len(sys.argv) > 2 else None
+	query_and_save(db_path, verbose=True, store=store)
+	metrics.write_snapshot(os.path.splitext(db_path)[0] + ".metrics.json")
 
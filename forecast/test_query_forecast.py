@@ -0,0 +1,119 @@
+import os
+import json
+import shutil
+import sqlite3
+import datetime
+import tempfile
+from unittest import TestCase
+
+import query_forecast
+import migrate_forecast
+import fetch
+import store
+
+
+def forecast_tuples(start, temperatures):
+	return [(start + datetime.timedelta(hours=i), temperature) for i, temperature in enumerate(temperatures)]
+
+
+class TestForecastRuns(TestCase):
+	def setUp(self):
+		self.db = sqlite3.connect(":memory:")
+		query_forecast.setup_database(self.db)
+		self.start = datetime.datetime(2016, 2, 15, 10)
+
+	def test_latest(self):
+		self.assertEquals(list(query_forecast.get_latest_records(self.db)), [])
+		query_forecast.append_records(self.db, forecast_tuples(self.start, [40, 41, 42]), "2016-02-15 09:00:00")
+		run_id = query_forecast.append_records(self.db, forecast_tuples(self.start, [50, 51]), "2016-02-15 10:00:00")
+		self.assertEquals(run_id, 2)
+		self.assertEquals(list(query_forecast.get_latest_records(self.db)),
+		                  [("2016-02-15 10:00:00", 50), ("2016-02-15 11:00:00", 51)])
+		# the earlier run is kept
+		self.assertEquals(self.db.execute("SELECT count(*) FROM forecasts").fetchone()[0], 5)
+
+	def test_as_of(self):
+		query_forecast.append_records(self.db, forecast_tuples(self.start, [40, 41, 42]), "2016-02-15 09:00:00")
+		query_forecast.append_records(self.db, forecast_tuples(self.start, [50, 51]), "2016-02-15 10:00:00")
+		self.assertEquals(len(list(query_forecast.get_records_as_of(self.db, "2016-02-15 09:30:00"))), 3)
+		self.assertEquals(len(list(query_forecast.get_records_as_of(self.db, "2016-02-15 10:00:00"))), 2)
+		self.assertEquals(list(query_forecast.get_records_as_of(self.db, "2016-02-15 08:00:00")), [])
+
+	def test_uses_indexes(self):
+		plan = " ".join(row[-1] for row in self.db.execute(
+		    "EXPLAIN QUERY PLAN SELECT forecast_datetime, temperature FROM latest_run JOIN forecasts USING (run_id)"))
+		self.assertIn("forecast_run", plan)
+
+
+class TestMigrateForecast(TestCase):
+	def setUp(self):
+		# the original layout
+		self.db = sqlite3.connect(":memory:")
+		self.db.execute("""
+		CREATE TABLE forecasts(
+		  create_datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
+		  is_latest BOOLEAN default(1),
+		  forecast_datetime DATETIME,
+		  temperature NUMERIC)
+		""")
+		self.db.execute("CREATE UNIQUE INDEX forecast_unique ON forecasts(create_datetime, forecast_datetime)")
+		start = datetime.datetime(2016, 2, 15, 10)
+		for create_datetime, temperatures in [("2016-02-15 09:00:00", [40, 41]), ("2016-02-15 10:00:00", [50, 51, 52])]:
+			self.db.execute("UPDATE forecasts SET is_latest=0")
+			self.db.executemany("INSERT INTO forecasts(create_datetime, forecast_datetime, temperature) VALUES(?, ?, ?)",
+			                    [(create_datetime, d, t) for d, t in forecast_tuples(start, temperatures)])
+		self.db.commit()
+
+	def test_migrate(self):
+		self.assertEquals(query_forecast.database_version(self.db), 1)
+		self.assertEquals(migrate_forecast.migrate(self.db), 2)
+		self.assertEquals(query_forecast.database_version(self.db), 2)
+		self.assertEquals([t for _, t in query_forecast.get_latest_records(self.db)], [50, 51, 52])
+		self.assertEquals([t for _, t in query_forecast.get_records_as_of(self.db, "2016-02-15 09:30:00")], [40, 41])
+		# new runs go on the end
+		query_forecast.append_records(self.db, [("2016-02-15 11:00:00", 60)])
+		self.assertEquals(list(query_forecast.get_latest_records(self.db)), [("2016-02-15 11:00:00", 60)])
+		# already done
+		self.assertEquals(migrate_forecast.migrate(self.db), 0)
+
+
+class FakeFetcher(object):
+	def __init__(self, body):
+		self.body = body
+		self.changed = True
+		self.committed = []
+
+	def fetch(self, url):
+		return fetch.Response(self.body, self.changed, 200 if self.changed else 304)
+
+	def commit(self, url):
+		self.committed.append(url)
+
+
+class TestQueryAndSave(TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.directory, "forecast.db")
+		query_forecast.setup_database(sqlite3.connect(self.db_path))
+		self.fetcher = FakeFetcher(json.dumps({'hourly_forecast': [
+		    {'FCTTIME': {'pretty': "10:00 AM UTC on February 15, 2016"}, 'temp': {'english': "40"}},
+		    {'FCTTIME': {'pretty': "11:00 AM UTC on February 15, 2016"}, 'temp': {'english': "42"}}]}))
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_unchanged_forecast_skipped(self):
+		self.assertEquals(query_forecast.query_and_save(self.db_path, fetcher=self.fetcher), 1)
+		self.assertEquals(self.fetcher.committed, [query_forecast.forecast_api_url])
+		self.fetcher.changed = False
+		self.assertEquals(query_forecast.query_and_save(self.db_path, fetcher=self.fetcher), None)
+		db = sqlite3.connect(self.db_path)
+		self.assertEquals(db.execute("SELECT count(*) FROM forecast_runs").fetchone()[0], 1)
+		self.assertEquals(list(query_forecast.get_latest_records(db)),
+		                  [("2016-02-15 10:00:00", 40), ("2016-02-15 11:00:00", 42)])
+
+	def test_store(self):
+		s = store.connect(":memory:")
+		run_id = query_forecast.query_and_save(None, fetcher=self.fetcher, store=s)
+		self.assertEquals(s.latest_run('forecast'), run_id)
+		self.assertEquals([row[2] for row in s.select(['forecast'])], [40, 42])
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""Heater relay service, the one process that switches the relay's GPIO pin
+
+Other processes switch the heater through a unix socket, with RemoteHeater, which has the same
+is_on()/set_to_on() interface as control/heater.AbstractHeater:
+
+heater = HeaterCycleProtection(RemoteHeater(), clock)
+
+The pin is set up once when the service starts, and its state is kept so that a command for
+the state the relay is already in doesn't write the pin. Commands are applied by a single
+worker thread: a burst of commands that arrives while the relay is settling is collapsed into
+the last one, so the relay never chatters through the intermediate states.
+
+Usage: relay.py [socket_path]
+
+Must run as administrator to access the GPIO pins. The relay is switched off when the
+service stops.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import ctypes
+import logging
+import threading
+import SocketServer
+
+if __name__ == '__main__':
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import metrics
+
+default_socket_path = "/tmp/heater.sock"
+
+_writes = metrics.counter("relay_pin_writes_total", "Writes to the relay's GPIO pin")
+_commands = metrics.counter("relay_commands_total", "Commands received by the relay service")
+_skipped = metrics.counter("relay_commands_skipped_total",
+                           "Commands not written to the pin, because the relay was already in that state "
+                           "or a later command replaced them")
+
+
+class RelayNotRunning(IOError):
+	pass
+
+
+class RPiGPIO(object):
+	"""The Raspberry Pi's GPIO pins, numbered by their position on the board"""
+
+	def __init__(self):
+		# only importable on a pi
+		import RPi.GPIO
+		self._gpio = RPi.GPIO
+		self._gpio.setmode(self._gpio.BOARD)
+
+	def setup_output(self, pin):
+		self._gpio.setup(pin, self._gpio.OUT)
+
+	def read(self, pin):
+		return bool(self._gpio.input(pin))
+
+	def write(self, pin, value):
+		self._gpio.output(pin, self._gpio.HIGH if value else self._gpio.LOW)
+
+	def cleanup(self):
+		self._gpio.cleanup()
+
+
+class FakeGPIO(object):
+	"""Pins in memory, for running the service and its tests on a machine without GPIO"""
+
+	def __init__(self):
+		self.pins = {}
+		# every (pin, value) written, in order
+		self.writes = []
+
+	def setup_output(self, pin):
+		self.pins.setdefault(pin, False)
+
+	def read(self, pin):
+		return self.pins[pin]
+
+	def write(self, pin, value):
+		self.pins[pin] = bool(value)
+		self.writes.append((pin, bool(value)))
+
+	def cleanup(self):
+		self.pins = {}
+
+
+class RelayActuator(object):
+	"""Switches the heater relay on a GPIO pin. Works as the heater of HeaterCycleProtection.
+
+	set_to_on() returns at once and the worker thread writes the pin. is_on() is the state most
+	recently asked for, and pin_state() the state last written to the pin.
+
+	:param gpio: RPiGPIO, or FakeGPIO for testing
+	"""
+
+	pin_num = 11
+	# seconds the worker waits after a command before writing the pin, for more commands of
+	# the same burst to arrive
+	coalesce_window = 0.1
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, gpio, pin_num=None):
+		if pin_num is not None:
+			self.pin_num = pin_num
+		self._gpio = gpio
+		self._gpio.setup_output(self.pin_num)
+		self._pin_state = self._gpio.read(self.pin_num)
+		self._intended_on = self._pin_state
+		# commands received since the worker last wrote the pin
+		self._pending = 0
+		self._condition = threading.Condition()
+		self._stopped = False
+		self._worker = threading.Thread(target=self._run, name="relay")
+		self._worker.daemon = True
+		self._worker.start()
+
+	def is_on(self):
+		return self._intended_on
+
+	def pin_state(self):
+		return self._pin_state
+
+	def set_to_on(self, val):
+		_commands.inc()
+		with self._condition:
+			self._intended_on = bool(val)
+			self._pending += 1
+			self._condition.notify()
+
+	def flush(self, timeout=None):
+		"""Waits until the pin is in the intended state. Returns whether it is."""
+		deadline = None if timeout is None else time.time() + timeout
+		with self._condition:
+			while self._pending and not self._stopped:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					break
+				self._condition.wait(remaining)
+			return self._pin_state == self._intended_on
+
+	def close(self):
+		"""Switches the relay off, stops the worker and releases the pins"""
+		if self._stopped:
+			return
+		self.set_to_on(False)
+		self.flush(timeout=5)
+		with self._condition:
+			self._stopped = True
+			self._condition.notify_all()
+		self._worker.join(5)
+		self._gpio.cleanup()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._pending and not self._stopped:
+					self._condition.wait()
+				if self._stopped:
+					return
+			time.sleep(self.coalesce_window)
+			with self._condition:
+				intended, pending = self._intended_on, self._pending
+				if intended != self._pin_state:
+					self._gpio.write(self.pin_num, intended)
+					self._pin_state = intended
+					_writes.inc()
+					pending -= 1
+					self._logger.info("Relay {}".format("on" if intended else "off"))
+				_skipped.inc(pending)
+				self._pending = 0
+				self._condition.notify_all()
+
+
+class RelayRequestHandler(SocketServer.StreamRequestHandler):
+	"""Answers one command per line with one line of json, {"on": ..., "pin": ...}
+
+	on - switch the heater on
+	off - switch the heater off
+	state - only report the state
+	"""
+
+	def handle(self):
+		actuator = self.server.actuator
+		for line in self.rfile:
+			command = line.strip()
+			if command in ("on", "off"):
+				actuator.set_to_on(command == "on")
+			elif command != "state":
+				self.wfile.write(json.dumps({'error': "Unknown command: {}".format(command)}) + "\n")
+				self.wfile.flush()
+				continue
+			self.wfile.write(json.dumps({'on': actuator.is_on(), 'pin': actuator.pin_state()}) + "\n")
+			self.wfile.flush()
+
+
+class RelayServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, actuator, socket_path=default_socket_path):
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		SocketServer.UnixStreamServer.__init__(self, socket_path, RelayRequestHandler)
+		# the service runs as admin, but the thermostat may not
+		os.chmod(socket_path, 0666)
+		self.actuator = actuator
+		self.socket_path = socket_path
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+
+class RemoteHeater(object):
+	"""A heater that is switched by the relay service
+
+	The connection is kept open and reopened if the service restarts. is_on() is the state
+	the service last reported, so it doesn't wait on the socket.
+	"""
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, socket_path=default_socket_path, timeout=5):
+		self._socket_path = socket_path
+		self._timeout = timeout
+		self._socket = None
+		self._file = None
+		self._heater_is_on = False
+
+	def is_on(self):
+		return self._heater_is_on
+
+	def set_to_on(self, val):
+		self._heater_is_on = self._request("on" if val else "off")['on']
+
+	def state(self):
+		"""The service's state as a dictionary: on, the intended state, and pin, the pin's state"""
+		response = self._request("state")
+		self._heater_is_on = response['on']
+		return response
+
+	def close(self):
+		if self._socket is not None:
+			self._file.close()
+			self._socket.close()
+			self._socket = self._file = None
+
+	def _connect(self):
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		client.settimeout(self._timeout)
+		try:
+			client.connect(self._socket_path)
+		except socket.error as e:
+			client.close()
+			raise RelayNotRunning("Relay service not running at {}: {}".format(self._socket_path, e))
+		self._socket = client
+		self._file = client.makefile()
+
+	def _request(self, command):
+		# one retry on a fresh connection, in case the service restarted since the last command
+		for attempt in range(2):
+			if self._socket is None:
+				self._connect()
+			try:
+				self._socket.sendall(command + "\n")
+				line = self._file.readline()
+				if line:
+					return json.loads(line)
+			except socket.error:
+				if attempt:
+					raise
+			self._logger.info("Reconnecting to the relay service")
+			self.close()
+		raise RelayNotRunning("Relay service at {} closed the connection".format(self._socket_path))
+
+
+def exit_if_not_admin():
+	try:
+		is_admin = os.getuid() == 0
+	except AttributeError:
+		is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
+	if not is_admin:
+		sys.exit("Must run as administrator")
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	exit_if_not_admin()
+	actuator = RelayActuator(RPiGPIO())
+	server = RelayServer(actuator, sys.argv[1] if len(sys.argv) > 1 else default_socket_path)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	stopped = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+	try:
+		while not stopped.is_set():
+			# wait in short steps so ctrl-c is noticed in python 2
+			stopped.wait(60)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
+		server.server_close()
+		actuator.close()
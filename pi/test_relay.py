@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import relay
+from relay import FakeGPIO, RelayActuator, RelayServer, RemoteHeater, RelayNotRunning
+
+
+class TestRelayActuator(TestCase):
+
+	def setUp(self):
+		self.gpio = FakeGPIO()
+		self.actuator = RelayActuator(self.gpio)
+		self.actuator.coalesce_window = 0.01
+
+	def tearDown(self):
+		self.actuator.close()
+
+	def test_switch(self):
+		self.assertFalse(self.actuator.is_on())
+		self.actuator.set_to_on(True)
+		self.assertTrue(self.actuator.is_on())
+		self.assertTrue(self.actuator.flush(timeout=5))
+		self.assertEquals(self.gpio.pins[11], True)
+		self.actuator.set_to_on(False)
+		self.assertTrue(self.actuator.flush(timeout=5))
+		self.assertEquals(self.gpio.writes, [(11, True), (11, False)])
+
+	def test_redundant_commands_skipped(self):
+		for _ in range(3):
+			self.actuator.set_to_on(False)
+			self.actuator.flush(timeout=5)
+		self.assertEquals(self.gpio.writes, [])
+
+	def test_burst_coalesced(self):
+		self.actuator.coalesce_window = 0.2
+		for val in [True, False, True, False, True]:
+			self.actuator.set_to_on(val)
+		self.assertTrue(self.actuator.flush(timeout=5))
+		self.assertEquals(self.gpio.writes, [(11, True)])
+
+	def test_close_switches_off(self):
+		self.actuator.set_to_on(True)
+		self.actuator.flush(timeout=5)
+		self.actuator.close()
+		self.assertEquals(self.gpio.writes, [(11, True), (11, False)])
+
+
+class TestRelayServer(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.socket_path = os.path.join(self.directory, "heater.sock")
+		self.gpio = FakeGPIO()
+		self.actuator = RelayActuator(self.gpio)
+		self.actuator.coalesce_window = 0.01
+		self.start_server()
+
+	def start_server(self):
+		self.server = RelayServer(self.actuator, self.socket_path)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.actuator.close()
+		shutil.rmtree(self.directory)
+
+	def test_remote_heater(self):
+		heater = RemoteHeater(self.socket_path)
+		heater.set_to_on(True)
+		self.assertTrue(heater.is_on())
+		self.actuator.flush(timeout=5)
+		self.assertEquals(heater.state(), {'on': True, 'pin': True})
+		heater.set_to_on(False)
+		self.assertFalse(heater.is_on())
+		heater.close()
+
+	def test_reconnect_after_restart(self):
+		heater = RemoteHeater(self.socket_path)
+		heater.set_to_on(True)
+		self.server.shutdown()
+		self.server.server_close()
+		self.start_server()
+		heater.set_to_on(False)
+		self.assertFalse(self.actuator.is_on())
+		heater.close()
+
+	def test_not_running(self):
+		with self.assertRaises(RelayNotRunning):
+			RemoteHeater(os.path.join(self.directory, "missing.sock")).set_to_on(True)
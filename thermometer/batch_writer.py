@@ -0,0 +1,110 @@
+"""Group-commit writer for temperature readings
+
+Committing every reading costs a sync of the SD card. BatchedWriter queues readings and
+writes them in a single transaction once enough have queued up or the oldest has waited
+long enough.
+
+Example use:
+
+import query_temp
+from batch_writer import BatchedWriter
+
+with BatchedWriter(query_temp.database_connect("therm.db")) as writer:
+	while True:
+		writer.add(query_temp.query_temp())
+		time.sleep(5)
+"""
+import time
+import logging
+import threading
+
+import query_temp
+import metrics
+
+_commit_seconds, _rows_written = metrics.database_metrics("therm")
+
+
+class BatchedWriter(object):
+	"""Queues readings for the temp table and writes them in batches"""
+
+	# flush when this many readings are queued
+	max_batch_size = 60
+	# flush when the oldest queued reading is this many seconds old
+	max_batch_age = 5 * 60
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, db, clock=time, store=None):
+		"""
+
+		:param db: a connection from query_temp.database_connect()
+		:param store: an optional store.Store that also gets every batch, as the 'room' source
+		:param clock: provides .time(). This is only here to facilitate testing.
+		"""
+		self._db = db
+		self._clock = clock
+		self._store = store
+		self._queue = []
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._queue)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def add(self, temperature, read_time=None):
+		"""Queues a reading, and writes the queue if it is full or old enough
+
+		:param read_time: a time.time() value, defaults to now
+		Returns the rows written as a list of (id, read_time, temperature), which is empty
+		if nothing was written.
+		"""
+		now = self._clock.time()
+		with self._lock:
+			self._queue.append((query_temp.epoch_read_time(now if read_time is None else read_time),
+			                    temperature, now))
+			if len(self._queue) < self.max_batch_size and now - self._queue[0][2] < self.max_batch_age:
+				return []
+		return self.flush()
+
+	def flush(self):
+		"""Writes every queued reading in a single transaction
+
+		Returns the rows written as a list of (id, read_time, temperature)
+		"""
+		with self._lock:
+			queue, self._queue = self._queue, []
+			if not queue:
+				return []
+			rows = []
+			started = time.time()
+			try:
+				curs = self._db.cursor()
+				for read_time, temperature, _ in queue:
+					curs.execute("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+					             (query_temp.column_read_time(self._db, read_time), temperature))
+					rows.append((curs.lastrowid, read_time, temperature))
+				self._db.commit()
+				_commit_seconds.observe(time.time() - started)
+				_rows_written.inc(len(rows))
+			except Exception:
+				# keep the readings for the next attempt
+				self._db.rollback()
+				self._queue = queue + self._queue
+				raise
+			if self._store is not None:
+				try:
+					self._store.add('room', [(read_time, temperature) for _, read_time, temperature in rows])
+				except Exception:
+					# the readings are safe in the database, and migrate_store.py can copy them later
+					self._logger.exception("Failed to add readings to the store")
+		self._logger.debug("Wrote {} readings".format(len(rows)))
+		return rows
+
+	def close(self):
+		"""Writes any queued readings. Call this on shutdown."""
+		self.flush()
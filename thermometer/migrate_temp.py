@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Upgrade the temp table of an existing database to the current layout
+
+Version 1 stored read_time as local time text with no index. Version 2 stores it as seconds
+since the epoch (UTC) with an index, see query_temp.database_setup(). Version 3 adds the
+sensor_temp table of multi-sensor mode, and version 4 the rollup tables of rollup.py. Adding
+the rollups rewrites the file to enable incremental vacuum, which also needs room for a copy.
+
+The rows are copied to a new table in chunks, each in its own transaction, so memory use
+stays bounded and an interrupted migration picks up where it left off when run again. The
+database needs room for a second copy of the table while migrating.
+
+Usage: migrate_temp.py db_path [chunk_size]
+"""
+import os
+import sys
+import sqlite3
+import logging
+
+if __name__ == '__main__':
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import query_temp
+import rollup
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(db, chunk_size=10000):
+	"""Upgrades the database in place. Returns the number of rows copied."""
+	version = query_temp.database_version(db)
+	if version >= query_temp.schema_version:
+		return 0
+	copied = _migrate_read_time(db, chunk_size) if version < 2 else 0
+	if version < 3:
+		with db:
+			db.execute(query_temp.sensor_table_sql)
+			db.execute("PRAGMA user_version=3")
+	rollup.setup(db)
+	rollup.enable_incremental_vacuum(db)
+	with db:
+		db.execute("PRAGMA user_version={}".format(query_temp.schema_version))
+	return copied
+
+
+def _migrate_read_time(db, chunk_size):
+	"""Version 1 to 2: copies temp to a table with epoch read times, and swaps it in"""
+	# manage transactions explicitly. python's sqlite3 would otherwise commit before every
+	# CREATE/DROP/ALTER, and the final swap of the tables must be a single transaction.
+	isolation_level = db.isolation_level
+	db.isolation_level = None
+	try:
+		db.execute("""
+		CREATE TABLE IF NOT EXISTS temp_v2(
+			id INTEGER PRIMARY KEY,
+			read_time INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+			temperature FLOAT)
+		""")
+
+		copied = 0
+		while True:
+			db.execute("BEGIN")
+			count = _copy_rows(db, chunk_size)
+			db.execute("COMMIT")
+			if count <= 0:
+				break
+			copied += count
+			_logger.info("Copied {} rows".format(copied))
+
+		# the sampler may have inserted rows since the last chunk. IMMEDIATE takes the write lock
+		# up front, so none can be added between copying them and swapping the tables.
+		db.execute("BEGIN IMMEDIATE")
+		copied += _copy_rows(db)
+		db.execute("DROP TABLE temp")
+		db.execute("ALTER TABLE temp_v2 RENAME TO temp")
+		db.execute("CREATE INDEX temp_read_time ON temp(read_time, temperature)")
+		db.execute("PRAGMA user_version=2")
+		db.execute("COMMIT")
+	except Exception:
+		try:
+			db.execute("ROLLBACK")
+		except sqlite3.OperationalError:
+			# no transaction was open
+			pass
+		raise
+	finally:
+		db.isolation_level = isolation_level
+	return copied
+
+
+def _copy_rows(db, limit=None):
+	"""Copies the rows of temp after the last one in temp_v2, at most limit of them. Returns the
+	number copied."""
+	# resume after the last row copied
+	last_id = db.execute("SELECT coalesce(max(id), 0) FROM temp_v2").fetchone()[0]
+	# the 'utc' modifier converts the stored local time to UTC. a writer that already uses epoch
+	# times may have added integer rows, which are copied as they are.
+	curs = db.execute("""
+	INSERT INTO temp_v2(id, read_time, temperature)
+	SELECT id, CASE WHEN typeof(read_time) = 'integer' THEN read_time
+		ELSE CAST(strftime('%s', read_time, 'utc') AS INTEGER) END, temperature
+	FROM temp WHERE id > ? ORDER BY id LIMIT ?
+	""", (last_id, limit if limit is not None else -1))
+	return max(curs.rowcount, 0)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	if len(sys.argv) < 2:
+		sys.exit(__doc__)
+	db_path = sys.argv[1]
+	if not os.path.exists(db_path):
+		sys.exit("Database path does not exist: {}".format(db_path))
+	db = sqlite3.connect(db_path)
+	copied = migrate(db, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+	print "Migrated {} rows".format(copied)
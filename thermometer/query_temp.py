@@ -1,84 +1,315 @@
 #!/usr/bin/env python
 import sys
+import time
 import sqlite3
+import logging
 import ctypes, os
+from multiprocessing.pool import ThreadPool
 
 import temperusb
 
+if __name__ == '__main__':
+	# programs that import this module put common/ on the path themselves
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import metrics
+import rollup
+
+_read_seconds = metrics.histogram("thermometer_read_seconds", "Time to read the USB thermometer")
+_read_errors = metrics.counter("thermometer_read_errors_total", "Failed USB thermometer reads")
+_commit_seconds, _rows_written = metrics.database_metrics("therm")
+_sweep_seconds = metrics.histogram("thermometer_sweep_seconds", "Time to read every sensor of every thermometer")
+
+_logger = logging.getLogger(__name__)
+
 _sensor_count = 1  # Default unless specified otherwise
 _sensor_id = [0,]  # Default to first sensor unless specified
+_device_id = None  # device_id() of the thermometer to read when several are plugged in
 
 def query_temp(admin_check=True):
 	"""Returns a float of the temperature in fahrenheit
+
+	This opens the device for a single reading. See sampler.py for a service that keeps
+	the device open and samples continuously.
 	"""
 	# check that running as admin
 	if admin_check:
-		try:
-			is_admin = os.getuid() == 0
-		except AttributeError:
-			is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-		if not is_admin:
-			raise SystemError("Must run as administrator")
+		check_admin()
+	return read_device(open_device())
+
+def check_admin():
+	"""Raises SystemError if not running as administrator, which is needed for USB access"""
+	try:
+		is_admin = os.getuid() == 0
+	except AttributeError:
+		is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
+	if not is_admin:
+		raise SystemError("Must run as administrator")
 
+def open_device(dev_id=None):
+	"""Finds the USB thermometer and prepares it for reading
+
+	If several are plugged in, the one with device_id() dev_id is used, defaulting to
+	_device_id, or else the first by id. See open_devices() to read them all.
+	"""
 	# get device
 	th = temperusb.TemperHandler()
 	devs = th.get_devices()
-	if len(devs) > 1:
-		ValueError('More than one device found')
-	dev = devs[0]
-
-	# query device
+	if not devs:
+		raise IOError('No TEMPer device found')
+	if dev_id is None:
+		dev_id = _device_id
+	if dev_id is not None:
+		matching = [dev for dev in devs if device_id(dev) == dev_id]
+		if not matching:
+			raise IOError('No TEMPer device at {}, found {}'.format(dev_id, ", ".join(sorted(map(device_id, devs)))))
+		dev = matching[0]
+	else:
+		dev = min(devs, key=device_id)
+		if len(devs) > 1:
+			_logger.warn("Found {} thermometers, reading {}. Set query_temp._device_id to choose another."
+			             .format(len(devs), device_id(dev)))
 	dev.set_sensor_count(_sensor_count)
-	reading = dev.get_temperatures(sensors=_sensor_id)
+	return dev
+
+def read_device(dev):
+	"""Returns a float of the temperature in fahrenheit from a device returned by open_device()
+	"""
+	started = time.time()
+	try:
+		# query device
+		reading = dev.get_temperatures(sensors=_sensor_id)
+	except Exception:
+		_read_errors.inc()
+		raise
+	_read_seconds.observe(time.time() - started)
 	if len(reading) > 1:
-		ValueError('More than one set of data in reading')
+		raise ValueError('More than one set of data in reading')
 
 	# parse result
 	reading_data = reading.itervalues().next()
 	fahrenheit = reading_data['temperature_f']
 	return fahrenheit
 
+# #########################
+# multi-sensor mode, for several thermometers, each with one or two probes
+
+def open_devices():
+	"""Finds every USB thermometer, each set to read all of its sensors"""
+	devs = temperusb.TemperHandler().get_devices()
+	if not devs:
+		raise IOError('No TEMPer device found')
+	return devs
+
+def device_id(dev):
+	"""An id for a device that stays the same while it stays plugged into the same USB port,
+	e.g. '1-1.2' for bus 1, port 1.2"""
+	return "{}-{}".format(dev.get_bus(), dev.get_ports())
+
+def read_sensors(dev):
+	"""Returns {sensor id: fahrenheit} for every sensor of one device, with sensor ids of
+	device_id() and the sensor number, e.g. '1-1.2:0'
+
+	The device reports all of its sensors in one transfer, so this takes one read.
+	"""
+	started = time.time()
+	try:
+		reading = dev.get_temperatures(sensors=None)
+	except Exception:
+		_read_errors.inc()
+		raise
+	_read_seconds.observe(time.time() - started)
+	dev_id = device_id(dev)
+	return dict(("{}:{}".format(dev_id, sensor), data['temperature_f']) for sensor, data in reading.items())
+
+def _read_sensors_or_none(dev):
+	try:
+		return read_sensors(dev)
+	except Exception:
+		_logger.exception("Failed to read thermometer {}".format(device_id(dev)))
+		return None
+
+def read_all(devs, pool=None):
+	"""Returns {sensor id: fahrenheit} for every sensor of every device in devs, see read_sensors()
+
+	The devices are read at the same time, so a sweep takes about as long as the slowest
+	device. A device that fails to read is left out. Raises IOError if they all fail.
+
+	:param pool: an optional ThreadPool to read with, for callers that sweep repeatedly. By
+	default a pool with a thread per device is made for the sweep.
+	"""
+	started = time.time()
+	if len(devs) == 1:
+		results = [_read_sensors_or_none(devs[0])]
+	elif pool is not None:
+		results = pool.map(_read_sensors_or_none, devs)
+	else:
+		pool = ThreadPool(len(devs))
+		try:
+			results = pool.map(_read_sensors_or_none, devs)
+		finally:
+			pool.terminate()
+	readings = {}
+	for result in results:
+		if result is not None:
+			readings.update(result)
+	if not readings:
+		raise IOError('Every thermometer failed to read')
+	_sweep_seconds.observe(time.time() - started)
+	return readings
+
+def query_sensors(admin_check=True):
+	"""Returns {sensor id: fahrenheit} for every sensor of every attached thermometer"""
+	if admin_check:
+		check_admin()
+	devs = open_devices()
+	try:
+		return read_all(devs)
+	finally:
+		for dev in devs:
+			dev.close()
+
+def query_latest():
+	"""Returns the latest temperature from the sampler service
+
+	If the service isn't running, the device is read directly.
+	"""
+	import sampler
+	try:
+		return sampler.get_latest()['temperature']
+	except sampler.SamplerNotRunning:
+		return query_temp()
+
+# version of the database layout, stored in the database's user_version. version 1 stored
+# read_time as local time text, version 2 had no sensor_temp table and version 3 no rollup
+# tables. see migrate_temp.py to upgrade an existing database.
+schema_version = 4
+
+# readings of multi-sensor mode, by sensor id. the single-sensor readings stay in temp.
+sensor_table_sql = """
+CREATE TABLE IF NOT EXISTS sensor_temp(
+	sensor TEXT NOT NULL,
+	read_time INTEGER NOT NULL,
+	temperature FLOAT,
+	PRIMARY KEY(sensor, read_time)) WITHOUT ROWID
+"""
+
 def database_setup(db_path):
-	"""Creates a sqlite database with a temperature table
+	"""Creates a sqlite database with a temperature table, its rollups (see rollup.py), and a
+	sensor_temp table for multi-sensor mode
+
+	read_time is seconds since the epoch (UTC). The index on read_time also holds the
+	temperature, so time range queries are answered from the index alone.
 	"""
 	db = sqlite3.connect(db_path)
+	# so rollup.apply_retention() can give deleted rows' space back. only takes effect on a
+	# new file, see rollup.enable_incremental_vacuum() for an existing one.
+	db.execute("PRAGMA auto_vacuum=INCREMENTAL")
 
 	sql = """
 	CREATE TABLE temp(
 		id INTEGER PRIMARY KEY,
-		read_time DATETIME DEFAULT (datetime('now', 'localtime')),
+		read_time INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
 		temperature FLOAT)
 	"""
 	db.execute("DROP TABLE IF EXISTS temp")
 	db.execute(sql)
+	db.execute("CREATE INDEX temp_read_time ON temp(read_time, temperature)")
+	db.execute("DROP TABLE IF EXISTS sensor_temp")
+	db.execute(sensor_table_sql)
+	db.commit()
+	rollup.setup(db)
+	db.execute("PRAGMA user_version={}".format(schema_version))
 	db.commit()
 	return db
 
+def database_version(db):
+	"""The layout version of the temp table in the database"""
+	version = db.execute("PRAGMA user_version").fetchone()[0]
+	# databases created before the version was recorded
+	return version or 1
+
 def database_connect(db_path="therm.db"):
 	db = sqlite3.connect(db_path)
+	# with a write-ahead log and synchronous=NORMAL, commits append to the log and the
+	# SD card is only synced when the log is checkpointed, not on every commit
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
 	return db
 
-def database_insert(db, temperature):
-	"""Record a value in the databse"""
+def epoch_read_time(t=None):
+	"""The read_time column value for a time.time() value, defaults to now"""
+	return int(time.time() if t is None else t)
+
+def column_read_time(db, read_time):
+	"""The value to write to the read_time column for an epoch_read_time()
+
+	A version 1 table, not yet migrated by migrate_temp.py, still holds local time text, so
+	that is what it gets.
+	"""
+	if database_version(db) < 2:
+		return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(read_time))
+	return read_time
+
+def database_insert(db, temperature, read_time=None):
+	"""Record a value in the databse
+
+	Returns the new row as (id, read_time, temperature), with read_time as an epoch_read_time()
+	"""
+	read_time = epoch_read_time(read_time)
+	started = time.time()
 	curs = db.cursor()
-	curs.execute("INSERT INTO temp(temperature) VALUES(?)", (temperature,))
+	curs.execute("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+	             (column_read_time(db, read_time), temperature))
 	db.commit()
-	id = curs.lastrowid
-	return curs.execute("SELECT * FROM temp WHERE id=?", (id,)).fetchone()
+	_commit_seconds.observe(time.time() - started)
+	_rows_written.inc()
+	return (curs.lastrowid, read_time, temperature)
+
+def database_insert_sweep(db, readings, read_time=None):
+	"""Record a reading of every sensor, from read_all(), in one transaction
+
+	A sensor's second reading within the same second replaces the first. Returns the number
+	of rows written.
+	"""
+	read_time = epoch_read_time(read_time)
+	started = time.time()
+	with db:
+		db.executemany("INSERT OR REPLACE INTO sensor_temp(sensor, read_time, temperature) VALUES(?, ?, ?)",
+		               [(sensor, read_time, temperature) for sensor, temperature in sorted(readings.items())])
+	_commit_seconds.observe(time.time() - started)
+	_rows_written.inc(len(readings))
+	return len(readings)
+
+def database_select_sensor_range(db, sensor, start=None, end=None):
+	"""Rows of (read_time, temperature) of one sensor with start <= read_time < end, in time order"""
+	return db.execute("SELECT read_time, temperature FROM sensor_temp "
+	                  "WHERE sensor = ? AND read_time >= ? AND read_time < ? ORDER BY read_time",
+	                  (sensor, start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1))
 
 def database_select(db):
-	rows = db.execute("SELECT * FROM temp")
+	"""All rows as (id, read_time, temperature), with read_time as local time text"""
+	rows = db.execute("SELECT id, datetime(read_time, 'unixepoch', 'localtime'), temperature FROM temp ORDER BY id")
+	return rows
+
+def database_select_range(db, start=None, end=None):
+	"""Rows of (read_time, temperature) with start <= read_time < end, in time order
+
+	Times are seconds since the epoch. Either end of the range may be None for no limit.
+	"""
+	rows = db.execute("SELECT read_time, temperature FROM temp "
+	                  "WHERE read_time >= ? AND read_time < ? ORDER BY read_time",
+	                  (start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1))
 	return rows
 
 def query_and_record(db):
-	temp = query_temp()
+	temp = query_latest()
 	return database_insert(db, temp)
 
 if __name__ == '__main__':
 	# without arguments
 	if len(sys.argv) == 1:
 		try:
-			print "{:2.1f}".format(query_temp())
+			print "{:2.1f}".format(query_latest())
 		except SystemError as e:
 			sys.exit(str(e))
 	else:
@@ -94,12 +325,23 @@ if __name__ == '__main__':
 			res = query_and_record(db)
 			print res
 			sys.exit()
+		elif subcommand == "sensors":
+			try:
+				readings = query_sensors()
+			except SystemError as e:
+				sys.exit(str(e))
+			for sensor, temperature in sorted(readings.items()):
+				print "{} {:2.1f}".format(sensor, temperature)
+			if len(sys.argv) >= 3:
+				db = database_connect(sys.argv[2])
+				db.execute(sensor_table_sql)
+				database_insert_sweep(db, readings)
 		elif subcommand == "get":
 			db = database_connect()
 			rows = database_select(db)
 			for row in rows:
 				print row
 		else:
-			sys.exit("Usage: {} [db [db_path]]").format(sys.argv[0])
+			sys.exit("Usage: {} [db [db_path] | sensors [db_path] | get]".format(sys.argv[0]))
 
 
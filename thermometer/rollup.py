@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Rollups of the temp table at 5 minute, hourly and daily resolution, and raw row retention
+
+Each rollup table has a row per time bucket with the minimum, maximum, sum and count of the
+readings in it, so the mean is sum / count. The tables are kept up to date by a trigger on temp,
+so each insert adds to the three buckets it falls in rather than anything being recomputed.
+Buckets are aligned to UTC, so a daily bucket runs from midnight UTC.
+
+Deleting from temp leaves the rollups alone. That lets apply_retention() delete raw rows once
+they are old, and long range queries read the rollups instead, a few hundred rows rather than
+a reading a minute. The freed pages are returned to the file system with an incremental
+vacuum, so the database stays about the same size.
+
+The triggers are written without UPSERT, which the sqlite of older Raspbian doesn't have.
+
+Usage: rollup.py db_path [raw_days]
+
+applies the retention policy, keeping raw rows for raw_days (default 90). Run it daily, e.g.
+from cron.
+"""
+import os
+import sys
+import time
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# (table, bucket seconds), finest first
+resolutions = [
+	('temp_5min', 5 * 60),
+	('temp_hourly', 60 * 60),
+	('temp_daily', 24 * 60 * 60),
+]
+
+# days of rows to keep in each table. tables that aren't listed are kept forever.
+default_retention = {
+	'temp': 90,
+	'temp_5min': 2 * 365,
+}
+
+# rows deleted per transaction by apply_retention(), so the sampler's writes aren't held up
+delete_chunk_size = 10000
+
+
+def setup(db):
+	"""Creates the rollup tables and their trigger, and rolls up the rows already in temp"""
+	with db:
+		for table, seconds in resolutions:
+			db.execute("""
+			CREATE TABLE IF NOT EXISTS {}(
+				bucket INTEGER PRIMARY KEY,
+				min FLOAT NOT NULL,
+				max FLOAT NOT NULL,
+				sum FLOAT NOT NULL,
+				count INTEGER NOT NULL)
+			""".format(table))
+		db.execute("DROP TRIGGER IF EXISTS temp_rollup")
+		statements = []
+		for table, seconds in resolutions:
+			bucket = "NEW.read_time - NEW.read_time % {}".format(seconds)
+			statements.append("INSERT OR IGNORE INTO {table}(bucket, min, max, sum, count) "
+			                  "VALUES({bucket}, NEW.temperature, NEW.temperature, 0, 0);".format(table=table, bucket=bucket))
+			statements.append("UPDATE {table} SET min = min(min, NEW.temperature), max = max(max, NEW.temperature), "
+			                  "sum = sum + NEW.temperature, count = count + 1 "
+			                  "WHERE bucket = {bucket};".format(table=table, bucket=bucket))
+		db.execute("""
+		CREATE TRIGGER temp_rollup AFTER INSERT ON temp
+		WHEN NEW.temperature IS NOT NULL
+		BEGIN
+		{}
+		END
+		""".format("\n".join(statements)))
+	rebuild(db)
+
+
+def rebuild(db):
+	"""Recomputes the rollups of the buckets that have rows in temp from those rows
+
+	Buckets whose raw rows have been deleted by retention are kept as they are.
+	"""
+	with db:
+		for table, seconds in resolutions:
+			db.execute("""
+			INSERT OR REPLACE INTO {table}(bucket, min, max, sum, count)
+			SELECT read_time - read_time % {seconds}, min(temperature), max(temperature), sum(temperature),
+				count(temperature)
+			FROM temp WHERE temperature IS NOT NULL GROUP BY 1
+			""".format(table=table, seconds=seconds))
+
+
+def has_rollups(db):
+	"""Whether setup() has been run on the database, so inserts into temp are rolled up"""
+	return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'temp_rollup'").fetchone() \
+		is not None
+
+
+def apply_retention(db, retention=None, now=None):
+	"""Deletes rows older than the retention policy allows, then frees their pages
+
+	:param retention: {table: days} for temp and the rollup tables, default default_retention.
+	Raw rows are only deleted from buckets that are complete, so their rollups are final.
+	:return: {table: rows deleted}
+	:raises ValueError: if the database has no rollups yet, see migrate_temp.py. Nothing is
+	deleted, as the raw rows would be the only record of their time.
+	"""
+	if not has_rollups(db):
+		raise ValueError("The database has no rollups, migrate it with migrate_temp.py first")
+	if retention is None:
+		retention = default_retention
+	now = time.time() if now is None else now
+	coarsest = resolutions[-1][1]
+	deleted = {}
+	for table, days in sorted(retention.items()):
+		if table == 'temp':
+			# whole days only, so the cutoff never splits a bucket of any resolution
+			cutoff = int(now - days * 86400)
+			cutoff -= cutoff % coarsest
+			deleted[table] = _delete_before(db, "temp", "id", "read_time", cutoff)
+		else:
+			cutoff = int(now - days * 86400)
+			deleted[table] = _delete_before(db, table, "bucket", "bucket", cutoff)
+		if deleted[table]:
+			_logger.info("Deleted {} rows from {}".format(deleted[table], table))
+	if any(deleted.values()):
+		incremental_vacuum(db)
+	return deleted
+
+
+def _delete_before(db, table, key, time_column, cutoff):
+	deleted = 0
+	while True:
+		with db:
+			curs = db.execute("DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} WHERE {time} < ? LIMIT ?)"
+			                  .format(table=table, key=key, time=time_column), (cutoff, delete_chunk_size))
+		if curs.rowcount <= 0:
+			return deleted
+		deleted += curs.rowcount
+
+
+def incremental_vacuum(db):
+	"""Returns the database's free pages to the file system. Needs auto_vacuum=INCREMENTAL,
+	see enable_incremental_vacuum()."""
+	free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+	# the pragma returns a row per page freed, and only frees them as the rows are read
+	db.execute("PRAGMA incremental_vacuum").fetchall()
+	_logger.info("Freed {} pages".format(free_pages))
+
+
+def enable_incremental_vacuum(db):
+	"""Switches an existing database to auto_vacuum=INCREMENTAL. This rewrites the whole file,
+	so needs room for a second copy of it."""
+	if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+		return
+	db.commit()
+	db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+	db.execute("VACUUM")
+
+
+def select_range(db, table, start=None, end=None):
+	"""Rows of (bucket, min, max, mean, count) of a rollup table with start <= bucket < end"""
+	return db.execute("SELECT bucket, min, max, sum / count, count FROM {} "
+	                  "WHERE bucket >= ? AND bucket < ? ORDER BY bucket".format(table),
+	                  (start if start is not None else -2 ** 63, end if end is not None else 2 ** 63 - 1))
+
+
+def resolution_for(start, end, max_points):
+	"""The finest table, 'temp' or a rollup, with at most about max_points rows between start
+	and end, assuming a raw reading a minute"""
+	span = end - start
+	if span / 60 <= max_points:
+		return 'temp'
+	for table, seconds in resolutions:
+		if span / seconds <= max_points:
+			return table
+	return resolutions[-1][0]
+
+
+def select_history(db, start=None, end=None, finest='temp'):
+	"""Rows of (time, temperature) with start <= time < end, in time order, from the finest
+	data there is for each time
+
+	Raw rows are used where retention has kept them, then the means of the 5 minute buckets that
+	end before the first raw row, and so on. A bucket is only used if it ends before the finer
+	data starts, so no time is covered twice.
+
+	:param finest: the finest table to use, 'temp' or a rollup table, e.g. from resolution_for()
+	"""
+	start = start if start is not None else -2 ** 63
+	end = end if end is not None else 2 ** 63 - 1
+	rows = []
+	if finest == 'temp':
+		rows = db.execute("SELECT read_time, temperature FROM temp WHERE read_time >= ? AND read_time < ? "
+		                  "ORDER BY read_time", (start, end)).fetchall()
+	covered_from = rows[0][0] if rows else end
+	tables = [table for table, seconds in resolutions]
+	for table, seconds in resolutions[tables.index(finest) if finest in tables else 0:]:
+		if covered_from <= start:
+			break
+		# whole buckets before the finer data only
+		limit = covered_from - covered_from % seconds
+		coarser = db.execute("SELECT bucket, sum / count FROM {} WHERE bucket >= ? AND bucket < ? "
+		                     "ORDER BY bucket".format(table), (start, limit)).fetchall()
+		if coarser:
+			rows[:0] = coarser
+			covered_from = coarser[0][0]
+	return rows
+
+
+if __name__ == '__main__':
+	import sqlite3
+	logging.basicConfig(level=logging.INFO)
+	if len(sys.argv) < 2:
+		sys.exit(__doc__)
+	db_path = sys.argv[1]
+	if not os.path.exists(db_path):
+		sys.exit("Database path does not exist: {}".format(db_path))
+	retention = dict(default_retention)
+	if len(sys.argv) > 2:
+		retention['temp'] = float(sys.argv[2])
+	db = sqlite3.connect(db_path)
+	if not has_rollups(db):
+		sys.exit("{} has no rollups, migrate it with migrate_temp.py first".format(db_path))
+	for table, count in sorted(apply_retention(db, retention).items()):
+		print "Deleted {} rows from {}".format(count, table)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Long-lived thermometer sampling service
+
+Opens the USB thermometer once and keeps sampling it, instead of finding and opening the
+device for every reading. Local programs get the latest reading and a short history over a
+unix socket, e.g. with get_latest() or query_temp.query_latest().
+
+Usage: sampler.py [interval_seconds [socket_path [db_path [store_path]]]]
+
+With a db_path, every reading is also recorded in the database, in batches, and with a
+store_path in the common time-series store as well.
+
+The latest reading is also published in the memory-mapped file /tmp/thermometer.reading, which
+the thermostat reads with reading_channel.MappedThermometer.
+
+Metrics, including the read latency and errors, are served in the Prometheus text format at
+http://localhost:9103/metrics.
+
+Must run as administrator to access the USB device.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import logging
+import threading
+import SocketServer
+from collections import deque
+
+if __name__ == '__main__':
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import query_temp
+import store as store_module
+import metrics
+import reading_channel
+from batch_writer import BatchedWriter
+
+default_socket_path = "/tmp/thermometer.sock"
+metrics_port = 9103
+
+
+class SamplerNotRunning(IOError):
+	pass
+
+
+class TemperSampler(object):
+	"""Samples the thermometer at a fixed rate and keeps the recent readings in memory
+
+	The device is opened on the first sample and kept open. If a read fails, the device is
+	closed and opened again on the next sample, so the sampler recovers when the thermometer
+	is unplugged and plugged back in.
+	"""
+
+	# seconds between samples
+	interval = 5
+	# number of readings kept in the history
+	history_size = 720  # 1 hour at the default interval
+
+	_logger = logging.getLogger(__name__)
+
+	def __init__(self, open_device=query_temp.open_device, read_device=query_temp.read_device, clock=time,
+	             writer=None, channel=None):
+		"""
+
+		:param writer: an optional BatchedWriter that records every reading
+		:param channel: an optional reading_channel.ReadingWriter that publishes every reading,
+		and every failed read
+		"""
+		self._open_device = open_device
+		self._read_device = read_device
+		self._clock = clock
+		self._writer = writer
+		self._channel = channel
+		self._device = None
+		self._history = deque(maxlen=self.history_size)
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self.errors = 0
+
+	def sample(self):
+		"""Reads the thermometer once. Returns the reading, or None if the read failed."""
+		try:
+			if self._device is None:
+				self._device = self._open_device()
+				self._logger.info("Opened thermometer")
+			temperature = self._read_device(self._device)
+		except Exception:
+			self.errors += 1
+			self._logger.exception("Thermometer read failed, will reopen the device")
+			self._close()
+			if self._channel is not None:
+				latest = self.latest()
+				self._channel.write(latest['temperature'] if latest else None, reading_channel.READ_ERROR,
+				                    self._clock.time())
+			return None
+		reading = {'time': self._clock.time(), 'temperature': temperature}
+		with self._lock:
+			self._history.append(reading)
+		if self._channel is not None:
+			self._channel.write(temperature, reading_channel.OK, reading['time'])
+		if self._writer is not None:
+			try:
+				self._writer.add(temperature, reading['time'])
+			except Exception:
+				# the writer keeps the readings and tries again with the next one
+				self._logger.exception("Failed to record readings")
+		return reading
+
+	def latest(self):
+		"""The most recent reading as a dictionary with time and temperature, or None"""
+		with self._lock:
+			return self._history[-1] if self._history else None
+
+	def history(self):
+		"""The recent readings, oldest first"""
+		with self._lock:
+			return list(self._history)
+
+	def run(self):
+		"""Samples every interval seconds until stop() is called"""
+		while not self._stopped.is_set():
+			started = self._clock.time()
+			self.sample()
+			self._stopped.wait(max(0, self.interval - (self._clock.time() - started)))
+		self._close()
+		if self._writer is not None:
+			self._writer.close()
+		if self._channel is not None:
+			self._channel.close()
+
+	def stop(self):
+		self._stopped.set()
+
+	def _close(self):
+		if self._device is not None:
+			try:
+				self._device.close()
+			except Exception:
+				pass
+			self._device = None
+
+
+class SamplerRequestHandler(SocketServer.StreamRequestHandler):
+	"""Answers one command per line with one line of json
+
+	latest - the most recent reading: {"time": ..., "temperature": ...}, or null
+	history - a list of recent readings, oldest first
+	"""
+
+	def handle(self):
+		for line in self.rfile:
+			command = line.strip()
+			if command == "latest":
+				response = self.server.sampler.latest()
+			elif command == "history":
+				response = self.server.sampler.history()
+			else:
+				response = {'error': "Unknown command: {}".format(command)}
+			self.wfile.write(json.dumps(response) + "\n")
+			self.wfile.flush()
+
+
+class SamplerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, sampler, socket_path=default_socket_path):
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		SocketServer.UnixStreamServer.__init__(self, socket_path, SamplerRequestHandler)
+		# the sampler runs as admin, but anyone may read the temperature
+		os.chmod(socket_path, 0666)
+		self.sampler = sampler
+		self.socket_path = socket_path
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+
+def _request(command, socket_path, timeout):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(timeout)
+	try:
+		client.connect(socket_path)
+	except socket.error as e:
+		client.close()
+		raise SamplerNotRunning("Sampler not running at {}: {}".format(socket_path, e))
+	try:
+		client.sendall(command + "\n")
+		return json.loads(client.makefile().readline())
+	finally:
+		client.close()
+
+
+def get_latest(socket_path=default_socket_path, max_age=60, timeout=5):
+	"""Returns the latest reading from the sampler service as a dictionary with time and temperature
+
+	Raises SamplerNotRunning if the service isn't running, or IOError if it has no reading
+	from the last max_age seconds.
+	"""
+	reading = _request("latest", socket_path, timeout)
+	if reading is None:
+		raise IOError("Sampler has no readings yet")
+	if max_age is not None and time.time() - reading['time'] > max_age:
+		raise IOError("Latest reading is {:.0f} seconds old".format(time.time() - reading['time']))
+	return reading
+
+
+def get_history(socket_path=default_socket_path, timeout=5):
+	"""Returns the recent readings from the sampler service, oldest first"""
+	return _request("history", socket_path, timeout)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	try:
+		query_temp.check_admin()
+	except SystemError as e:
+		sys.exit(str(e))
+	writer = None
+	if len(sys.argv) > 3:
+		store = store_module.connect(sys.argv[4]) if len(sys.argv) > 4 else None
+		writer = BatchedWriter(query_temp.database_connect(sys.argv[3]), store=store)
+	sampler = TemperSampler(writer=writer, channel=reading_channel.ReadingWriter())
+	if len(sys.argv) > 1:
+		sampler.interval = float(sys.argv[1])
+	server = SamplerServer(sampler, sys.argv[2] if len(sys.argv) > 2 else default_socket_path)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	metrics.start_http_server(metrics_port)
+	# shut down cleanly on kill, so queued readings are recorded
+	signal.signal(signal.SIGTERM, lambda signum, frame: sampler.stop())
+	try:
+		sampler.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
+		server.server_close()
+		if writer is not None:
+			writer.close()
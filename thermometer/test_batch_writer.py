@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import query_temp
+import store
+from batch_writer import BatchedWriter
+from test_sampler import FakeClock
+
+
+class TestBatchedWriter(TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.directory, "therm.db")
+		query_temp.database_setup(self.db_path).close()
+		self.db = query_temp.database_connect(self.db_path)
+		self.clock = FakeClock()
+		self.writer = BatchedWriter(self.db, self.clock)
+		self.writer.max_batch_size = 3
+		self.writer.max_batch_age = 60
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.directory)
+
+	def count_rows(self):
+		# a separate connection only sees committed rows
+		other = sqlite3.connect(self.db_path)
+		try:
+			return other.execute("SELECT count(*) FROM temp").fetchone()[0]
+		finally:
+			other.close()
+
+	def test_wal_mode(self):
+		self.assertEquals(self.db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+		self.assertEquals(self.db.execute("PRAGMA synchronous").fetchone()[0], 1)
+
+	def test_flush_on_size(self):
+		self.assertEquals(self.writer.add(68.0), [])
+		self.assertEquals(self.writer.add(68.5), [])
+		self.assertEquals(self.count_rows(), 0)
+		rows = self.writer.add(69.0)
+		self.assertEquals([r[2] for r in rows], [68.0, 68.5, 69.0])
+		self.assertEquals(self.count_rows(), 3)
+		self.assertEquals(len(self.writer), 0)
+		# the ids returned are the ids in the table
+		self.assertEquals(self.db.execute("SELECT * FROM temp ORDER BY id").fetchall(),
+		                  [tuple(r) for r in rows])
+
+	def test_flush_on_age(self):
+		self.writer.add(68.0)
+		self.clock._time += 59
+		self.assertEquals(self.writer.add(68.0), [])
+		self.clock._time += 1
+		self.assertEquals(len(self.writer.add(68.0)), 3)
+
+	def test_close_flushes(self):
+		with self.writer:
+			self.writer.add(68.0, read_time=0)
+		self.assertEquals(self.count_rows(), 1)
+		self.assertEquals(self.db.execute("SELECT read_time FROM temp").fetchone()[0], 0)
+
+	def test_failed_flush_keeps_readings(self):
+		self.writer.add(68.0)
+		self.db.execute("DROP TABLE temp")
+		with self.assertRaises(sqlite3.OperationalError):
+			self.writer.flush()
+		self.assertEquals(len(self.writer), 1)
+
+	def test_store(self):
+		s = store.connect(":memory:")
+		self.writer = BatchedWriter(self.db, self.clock, store=s)
+		self.writer.add(68.0, read_time=100)
+		self.writer.add(68.5, read_time=105)
+		self.writer.flush()
+		self.assertEquals(s.select(['room']), [(100, 'room', 68.0), (105, 'room', 68.5)])
+
+	def test_store_failure_keeps_database_rows(self):
+		s = store.connect(":memory:")
+		s.db.execute("DROP TABLE series")
+		self.writer = BatchedWriter(self.db, self.clock, store=s)
+		self.writer.add(68.0)
+		self.assertEquals(len(self.writer.flush()), 1)
+		self.assertEquals(self.count_rows(), 1)
+		self.assertEquals(len(self.writer), 0)
+
+	def test_database_insert(self):
+		row = query_temp.database_insert(self.db, 70.0)
+		self.assertEquals(self.db.execute("SELECT * FROM temp WHERE id=?", (row[0],)).fetchone(), tuple(row))
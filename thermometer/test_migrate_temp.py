@@ -0,0 +1,111 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import query_temp
+import migrate_temp
+from batch_writer import BatchedWriter
+
+
+class TestMigrateTemp(TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.directory, "therm.db")
+		# the original layout
+		self.db = sqlite3.connect(self.db_path)
+		self.db.execute("""
+		CREATE TABLE temp(
+			id INTEGER PRIMARY KEY,
+			read_time DATETIME DEFAULT (datetime('now', 'localtime')),
+			temperature FLOAT)
+		""")
+		self.read_times = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1455544800 + 60 * i))
+		                   for i in range(25)]
+		self.db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+		                    [(t, 60 + i) for i, t in enumerate(self.read_times)])
+		self.db.commit()
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.directory)
+
+	def test_migrate(self):
+		self.assertEquals(query_temp.database_version(self.db), 1)
+		self.assertEquals(migrate_temp.migrate(self.db, chunk_size=10), 25)
+		self.assertEquals(query_temp.database_version(self.db), query_temp.schema_version)
+		rows = self.db.execute("SELECT id, read_time, temperature FROM temp ORDER BY id").fetchall()
+		self.assertEquals(rows, [(i + 1, 1455544800 + 60 * i, 60 + i) for i in range(25)])
+		# the local time text is unchanged when read back
+		self.assertEquals([r[1] for r in query_temp.database_select(self.db)], self.read_times)
+		# already migrated
+		self.assertEquals(migrate_temp.migrate(self.db), 0)
+
+	def test_resume(self):
+		# an earlier run copied part of the table before it was interrupted
+		self.db.execute("CREATE TABLE temp_v2(id INTEGER PRIMARY KEY, read_time INTEGER NOT NULL, temperature FLOAT)")
+		self.db.execute("INSERT INTO temp_v2 VALUES(1, 1455544800, 60)")
+		self.db.commit()
+		self.assertEquals(migrate_temp.migrate(self.db, chunk_size=10), 24)
+		self.assertEquals(self.db.execute("SELECT count(*) FROM temp").fetchone()[0], 25)
+
+	def test_rows_inserted_while_migrating(self):
+		copy_rows = migrate_temp._copy_rows
+		writer = sqlite3.connect(self.db_path)
+
+		def copy_rows_then_insert(db, limit=None):
+			count = copy_rows(db, limit)
+			if limit is not None and count == 0:
+				# the sampler writes after the last chunk, before the swap
+				db.execute("COMMIT")
+				writer.execute("INSERT INTO temp(read_time, temperature) VALUES('2016-02-15 10:00:00', 99)")
+				writer.commit()
+				db.execute("BEGIN")
+			return count
+		migrate_temp._copy_rows = copy_rows_then_insert
+		try:
+			self.assertEquals(migrate_temp.migrate(self.db, chunk_size=10), 26)
+		finally:
+			migrate_temp._copy_rows = copy_rows
+			writer.close()
+		self.assertEquals(self.db.execute("SELECT count(*), max(temperature) FROM temp").fetchone(), (26, 99))
+
+	def test_epoch_rows_before_migrating(self):
+		# the new writers write local time text to a version 1 table
+		self.assertEquals(query_temp.database_insert(self.db, 90, 1455544800 + 60 * 25)[1:], (1455544800 + 60 * 25, 90))
+		with BatchedWriter(self.db) as writer:
+			writer.add(91, 1455544800 + 60 * 26)
+		# and a row some other writer added with an epoch time is copied as it is
+		self.db.execute("INSERT INTO temp(read_time, temperature) VALUES(?, 92)", (1455544800 + 60 * 27,))
+		self.db.commit()
+		migrate_temp.migrate(self.db)
+		self.assertEquals(list(query_temp.database_select_range(self.db, 1455544800 + 60 * 24)),
+		                  [(1455544800 + 60 * i, 60 + i) for i in range(24, 25)] +
+		                  [(1455544800 + 60 * i, 65 + i) for i in range(25, 28)])
+
+	def test_add_sensor_table(self):
+		migrate_temp.migrate(self.db)
+		self.db.execute("DROP TABLE sensor_temp")
+		self.db.execute("PRAGMA user_version=2")
+		self.assertEquals(migrate_temp.migrate(self.db), 0)
+		self.assertEquals(query_temp.database_version(self.db), query_temp.schema_version)
+		self.assertEquals(query_temp.database_insert_sweep(self.db, {'1-1:0': 68.0}, 1455544800), 1)
+
+	def test_range_query_uses_index(self):
+		migrate_temp.migrate(self.db)
+		start = 1455544800 + 60 * 5
+		rows = list(query_temp.database_select_range(self.db, start, start + 60 * 3))
+		self.assertEquals(rows, [(start, 65), (start + 60, 66), (start + 120, 67)])
+		plan = " ".join(str(r) for r in self.db.execute(
+			"EXPLAIN QUERY PLAN SELECT read_time, temperature FROM temp WHERE read_time >= 0 AND read_time < 1"))
+		self.assertIn("COVERING INDEX temp_read_time", plan)
+
+	def test_new_database(self):
+		db = query_temp.database_setup(os.path.join(self.directory, "new.db"))
+		self.assertEquals(query_temp.database_version(db), query_temp.schema_version)
+		row = query_temp.database_insert(db, 68.0, 1455544800.7)
+		self.assertEquals(row[1:], (1455544800, 68.0))
+		self.assertEquals(list(query_temp.database_select_range(db, end=1455544801)), [(1455544800, 68.0)])
+		db.close()
@@ -0,0 +1,94 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import query_temp
+
+
+class FakeTemperDevice(object):
+	"""Stands in for temperusb.TemperDevice"""
+
+	def __init__(self, bus, ports, temperatures, delay=0):
+		self.bus = bus
+		self.ports = ports
+		# fahrenheit, one per sensor
+		self.temperatures = temperatures
+		self.delay = delay
+		self.fail = False
+		self.sensor_count = None
+
+	def set_sensor_count(self, count):
+		self.sensor_count = count
+
+	def get_bus(self):
+		return self.bus
+
+	def get_ports(self):
+		return self.ports
+
+	def get_temperatures(self, sensors=None):
+		time.sleep(self.delay)
+		if self.fail:
+			raise IOError("USB error")
+		if sensors is None:
+			sensors = range(len(self.temperatures))
+		return dict((sensor, {'sensor': sensor, 'temperature_f': self.temperatures[sensor]}) for sensor in sensors)
+
+
+class TestMultiSensor(TestCase):
+	def setUp(self):
+		self.devs = [FakeTemperDevice(1, "1.2", [68.0, 41.0], delay=0.2),
+		             FakeTemperDevice(1, "1.3", [66.5], delay=0.2),
+		             FakeTemperDevice(2, "1", [70.25], delay=0.2)]
+
+	def test_read_all(self):
+		self.assertEquals(query_temp.read_all(self.devs),
+		                  {'1-1.2:0': 68.0, '1-1.2:1': 41.0, '1-1.3:0': 66.5, '2-1:0': 70.25})
+
+	def test_devices_read_in_parallel(self):
+		started = time.time()
+		query_temp.read_all(self.devs)
+		self.assertLess(time.time() - started, 0.5)
+
+	def test_failed_device_left_out(self):
+		self.devs[1].fail = True
+		self.assertEquals(sorted(query_temp.read_all(self.devs)), ['1-1.2:0', '1-1.2:1', '2-1:0'])
+		for dev in self.devs:
+			dev.fail = True
+		with self.assertRaises(IOError):
+			query_temp.read_all(self.devs)
+
+	def test_single_sensor_with_several_devices(self):
+		devs = self.devs
+
+		class FakeTemperHandler(object):
+			def get_devices(self):
+				return devs
+
+		temperusb = query_temp.temperusb
+		query_temp.temperusb = type("FakeTemperUSB", (object,), {'TemperHandler': FakeTemperHandler})
+		try:
+			# the first by id, unless another is chosen
+			self.assertIs(query_temp.open_device(), devs[0])
+			self.assertEquals(query_temp.read_device(query_temp.open_device("1-1.3")), 66.5)
+			with self.assertRaises(IOError):
+				query_temp.open_device("3-1")
+			self.assertEquals(query_temp.open_devices(), devs)
+		finally:
+			query_temp.temperusb = temperusb
+
+	def test_insert_sweep(self):
+		directory = tempfile.mkdtemp()
+		try:
+			db = query_temp.database_setup(os.path.join(directory, "therm.db"))
+			for i, temperature in enumerate([68.0, 68.5]):
+				self.devs[0].temperatures[0] = temperature
+				self.assertEquals(query_temp.database_insert_sweep(db, query_temp.read_all(self.devs), 1000 + i), 4)
+			self.assertEquals(list(query_temp.database_select_sensor_range(db, '1-1.2:0')),
+			                  [(1000, 68.0), (1001, 68.5)])
+			self.assertEquals(db.execute("SELECT count(*) FROM temp").fetchone()[0], 0)
+			db.close()
+		finally:
+			shutil.rmtree(directory)
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import query_temp
+import rollup
+
+day = 24 * 60 * 60
+
+
+class TestRollup(TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.directory, "therm.db")
+		self.db = query_temp.database_setup(self.db_path)
+		# a reading a minute for three days, 60 on the first day, 61 the second and 62 the third,
+		# with a dip of 10 degrees in the first minute of each day
+		self.start = 100 * day
+		with self.db:
+			self.db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+			                    [(t, 60 + (t - self.start) // day - (10 if t % day == 0 else 0))
+			                     for t in range(self.start, self.start + 3 * day, 60)])
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.directory)
+
+	def test_rollups_kept_on_insert(self):
+		daily = list(rollup.select_range(self.db, 'temp_daily'))
+		self.assertEquals([r[0] for r in daily], [self.start, self.start + day, self.start + 2 * day])
+		self.assertEquals(daily[1][1:3], (51, 61))
+		self.assertAlmostEquals(daily[1][3], 61 - 10 / 1440.)
+		self.assertEquals(daily[1][4], 1440)
+		self.assertEquals(self.db.execute("SELECT count(*), sum(count) FROM temp_hourly").fetchone(), (72, 3 * 1440))
+		self.assertEquals(list(rollup.select_range(self.db, 'temp_5min', self.start + 300, self.start + 600)),
+		                  [(self.start + 300, 60, 60, 60, 5)])
+
+	def test_rebuild_matches_trigger(self):
+		tables = [table for table, seconds in rollup.resolutions]
+		before = [list(self.db.execute("SELECT * FROM {} ORDER BY bucket".format(t))) for t in tables]
+		for table in tables:
+			self.db.execute("DELETE FROM {}".format(table))
+		rollup.rebuild(self.db)
+		self.assertEquals([list(self.db.execute("SELECT * FROM {} ORDER BY bucket".format(t))) for t in tables], before)
+
+	def test_retention(self):
+		size = os.path.getsize(self.db_path)
+		deleted = rollup.apply_retention(self.db, {'temp': 1.5, 'temp_5min': 2}, now=self.start + 3 * day)
+		# the cutoff is rounded down to a whole day
+		self.assertEquals(deleted, {'temp': 1440, 'temp_5min': 288})
+		self.assertEquals(self.db.execute("SELECT min(read_time) FROM temp").fetchone()[0], self.start + day)
+		self.assertEquals(self.db.execute("SELECT count(*) FROM temp_daily").fetchone()[0], 3)
+		self.assertLess(os.path.getsize(self.db_path), size)
+		self.assertEquals(self.db.execute("PRAGMA freelist_count").fetchone()[0], 0)
+		# new readings still roll up into the kept tables
+		query_temp.database_insert(self.db, 70, self.start + 3 * day)
+		self.assertEquals(self.db.execute("SELECT count FROM temp_daily WHERE bucket = ?",
+		                                  (self.start + 3 * day,)).fetchone()[0], 1)
+
+	def test_retention_without_rollups(self):
+		# a version 3 database, before migrate_temp.py added the rollups
+		self.db.execute("DROP TRIGGER temp_rollup")
+		for table, seconds in rollup.resolutions:
+			self.db.execute("DROP TABLE {}".format(table))
+		self.db.execute("PRAGMA user_version=3")
+		self.db.commit()
+		with self.assertRaises(ValueError):
+			rollup.apply_retention(self.db, now=self.start + 365 * day)
+		self.assertEquals(self.db.execute("SELECT count(*) FROM temp").fetchone()[0], 3 * 1440)
+
+	def test_history_uses_finest_data(self):
+		rollup.apply_retention(self.db, {'temp': 2, 'temp_5min': 2.5}, now=self.start + 3 * day)
+		history = rollup.select_history(self.db)
+		# hourly for the first half day, 5 minute for the rest of the first day, then raw
+		self.assertEquals(len(history), 12 + 144 + 2 * 1440)
+		self.assertEquals([t for t, _ in history], sorted(t for t, _ in history))
+		self.assertEquals(len(rollup.select_history(self.db, self.start + 2 * day)), 1440)
+
+	def test_history_without_retention(self):
+		# a reading part way through the 5 minute bucket before the first day
+		query_temp.database_insert(self.db, 59, self.start - 90)
+		history = rollup.select_history(self.db)
+		# every row is raw, with no bucket means before or among them
+		self.assertEquals(history, list(self.db.execute("SELECT read_time, temperature FROM temp ORDER BY read_time")))
+		self.assertEquals(len(rollup.select_history(self.db, end=self.start + day)), 1441)
+
+	def test_resolution_for(self):
+		self.assertEquals(rollup.resolution_for(0, day, 2000), 'temp')
+		self.assertEquals(rollup.resolution_for(0, 6 * day, 2000), 'temp_5min')
+		self.assertEquals(rollup.resolution_for(0, 365 * day, 2000), 'temp_daily')
+		self.assertEquals(rollup.resolution_for(0, 30 * day, 2000), 'temp_hourly')
+
+	def test_migrate_existing_database(self):
+		import migrate_temp
+		self.db.execute("DROP TRIGGER temp_rollup")
+		for table, seconds in rollup.resolutions:
+			self.db.execute("DROP TABLE {}".format(table))
+		self.db.execute("PRAGMA user_version=3")
+		self.db.commit()
+		migrate_temp.migrate(self.db)
+		self.assertEquals(query_temp.database_version(self.db), query_temp.schema_version)
+		self.assertEquals(self.db.execute("SELECT sum(count) FROM temp_daily").fetchone()[0], 3 * 1440)
+		self.assertEquals(self.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
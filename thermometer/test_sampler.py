@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import sampler
+import reading_channel
+from sampler import TemperSampler, SamplerServer, SamplerNotRunning
+
+
+class FakeClock(object):
+	def __init__(self):
+		self._time = 1000
+
+	def time(self):
+		return self._time
+
+
+class FakeDevice(object):
+	def __init__(self):
+		self.temperature = 68.0
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+
+class FakeUSB(object):
+	"""Stands in for query_temp.open_device and read_device"""
+
+	def __init__(self):
+		self.opened = []
+		self.fail = False
+
+	def open_device(self):
+		if self.fail:
+			raise IOError("No TEMPer device found")
+		self.opened.append(FakeDevice())
+		return self.opened[-1]
+
+	def read_device(self, dev):
+		if self.fail:
+			raise IOError("USB error")
+		return dev.temperature
+
+
+class TestTemperSampler(TestCase):
+	def setUp(self):
+		self.usb = FakeUSB()
+		self.clock = FakeClock()
+		self.sampler = TemperSampler(self.usb.open_device, self.usb.read_device, self.clock)
+
+	def test_device_opened_once(self):
+		for _ in range(3):
+			self.sampler.sample()
+		self.assertEquals(len(self.usb.opened), 1)
+		self.assertEquals(self.sampler.latest(), {'time': 1000, 'temperature': 68.0})
+		self.assertEquals(len(self.sampler.history()), 3)
+
+	def test_reconnect_after_error(self):
+		self.sampler.sample()
+		self.usb.fail = True
+		self.assertIsNone(self.sampler.sample())
+		self.assertTrue(self.usb.opened[0].closed)
+		self.assertIsNone(self.sampler.sample())
+		self.usb.fail = False
+		self.clock._time = 1010
+		self.assertEquals(self.sampler.sample(), {'time': 1010, 'temperature': 68.0})
+		self.assertEquals(len(self.usb.opened), 2)
+		self.assertEquals(self.sampler.errors, 2)
+
+	def test_history_is_bounded(self):
+		self.sampler._history = sampler.deque(maxlen=2)
+		for i in range(3):
+			self.clock._time = i
+			self.sampler.sample()
+		self.assertEquals([r['time'] for r in self.sampler.history()], [1, 2])
+
+	def test_publish_to_channel(self):
+		directory = tempfile.mkdtemp()
+		try:
+			path = os.path.join(directory, "thermometer.reading")
+			self.sampler._channel = reading_channel.ReadingWriter(path)
+			reader = reading_channel.ReadingReader(path)
+			self.sampler.sample()
+			self.assertEquals(reader.read()[1:], (1000, 68.0, reading_channel.OK))
+			self.usb.fail = True
+			self.clock._time = 1005
+			self.sampler.sample()
+			self.assertEquals(reader.read()[1:], (1005, 68.0, reading_channel.READ_ERROR))
+			reader.close()
+		finally:
+			shutil.rmtree(directory)
+
+
+class TestSamplerServer(TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.socket_path = os.path.join(self.directory, "thermometer.sock")
+		self.usb = FakeUSB()
+		self.sampler = TemperSampler(self.usb.open_device, self.usb.read_device)
+		self.server = SamplerServer(self.sampler, self.socket_path)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.directory)
+
+	def test_latest_and_history(self):
+		with self.assertRaises(IOError):
+			sampler.get_latest(self.socket_path)
+		self.sampler.sample()
+		self.usb.opened[0].temperature = 70.5
+		self.sampler.sample()
+		self.assertEquals(sampler.get_latest(self.socket_path)['temperature'], 70.5)
+		self.assertEquals([r['temperature'] for r in sampler.get_history(self.socket_path)], [68.0, 70.5])
+
+	def test_stale_reading(self):
+		self.sampler.sample()
+		self.sampler._history[-1]['time'] -= 120
+		with self.assertRaises(IOError):
+			sampler.get_latest(self.socket_path, max_age=60)
+		self.assertEquals(sampler.get_latest(self.socket_path, max_age=None)['temperature'], 68.0)
+
+	def test_not_running(self):
+		with self.assertRaises(SamplerNotRunning):
+			sampler.get_latest(os.path.join(self.directory, "missing.sock"))
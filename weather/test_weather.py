@@ -0,0 +1,130 @@
+import os
+import json
+import sys
+import sqlite3
+import shutil
+import datetime
+import tempfile
+import subprocess
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+import weather
+import fetch
+import store
+
+
+class TestAppendRecords(TestCase):
+
+	def setUp(self):
+		self.db = sqlite3.connect(":memory:")
+		weather.setup_table(self.db)
+
+	def make_data(self, times):
+		data = pd.DataFrame({'datetime': pd.to_datetime(times)})
+		data['wind_mph'] = "Calm"
+		data['vis_mi'] = 10.0
+		data['temperature_f'] = np.arange(len(times)) + 40
+		data['humidity'] = ["55", "60", "65"][:len(times)]
+		data['wind_chill_f'] = np.nan
+		return data
+
+	def test_duplicates_ignored(self):
+		result = weather.append_records(self.db, self.make_data(["2/15/2016 10:53", "2/15/2016 11:53"]))
+		self.assertEquals(result, (2, 0))
+		result = weather.append_records(self.db, self.make_data(["2/15/2016 10:53", "2/15/2016 11:53",
+		                                                          "2/15/2016 12:53"]))
+		self.assertEquals(result, (1, 2))
+		rows = self.db.execute("SELECT datetime, temperature_f, humidity, wind_chill_f FROM readings "
+		                       "ORDER BY datetime").fetchall()
+		self.assertEquals(rows, [("2016-02-15 10:53:00", 40, 55, None),
+		                         ("2016-02-15 11:53:00", 41, 60, None),
+		                         ("2016-02-15 12:53:00", 42, 65, None)])
+
+
+class TestParseObservations(TestCase):
+
+	def setUp(self):
+		with open(os.path.join(os.path.dirname(__file__), "fixtures", "KCLT.html")) as f:
+			self.html = f.read()
+
+	def test_rows(self):
+		rows = weather.parse_observations(self.html, now=datetime.datetime(2016, 4, 2, 2, 10))
+		self.assertEquals(len(rows), 7)
+		self.assertEquals(rows[1], (datetime.datetime(2016, 4, 2, 0, 52), "N 3", 10.0, "Fair", "CLR", 46.0,
+		                            30.0, 53.0, 44.0, None, 30.20, 1022.9, None))
+		self.assertEquals(rows[4][-1], 0.04)
+
+	def test_month_rollover(self):
+		rows = weather.parse_observations(self.html, now=datetime.datetime(2016, 4, 2, 2, 10))
+		self.assertEquals([row[0].date() for row in rows[-2:]], [datetime.date(2016, 3, 31)] * 2)
+
+	def test_year_rollover(self):
+		now = datetime.datetime(2016, 1, 1, 1, 0)
+		self.assertEquals(weather.observation_datetime(31, "23:52", now), datetime.datetime(2015, 12, 31, 23, 52))
+		self.assertEquals(weather.observation_datetime(1, "00:52", now), datetime.datetime(2016, 1, 1, 0, 52))
+		# February has no 30th
+		now = datetime.datetime(2016, 3, 1, 1, 0)
+		self.assertEquals(weather.observation_datetime(30, "23:52", now), datetime.datetime(2016, 1, 30, 23, 52))
+
+	def test_save(self):
+		db = sqlite3.connect(":memory:")
+		weather.setup_table(db)
+		rows = weather.parse_observations(self.html, now=datetime.datetime(2016, 4, 2, 2, 10))
+		self.assertEquals(weather.append_rows(db, rows), (7, 0))
+		self.assertEquals(weather.append_rows(db, rows), (0, 7))
+		self.assertEquals(db.execute("SELECT min(datetime), max(datetime) FROM readings").fetchone(),
+		                  ("2016-03-31 12:52:00", "2016-04-02 01:52:00"))
+
+	def test_no_pandas_import(self):
+		code = "import sys; sys.path.insert(0, '../common'); import weather; sys.exit('pandas' in sys.modules)"
+		self.assertEquals(subprocess.call([sys.executable, "-c", code], cwd=os.path.dirname(__file__)), 0)
+
+
+class FakeFetcher(object):
+	def __init__(self, body):
+		self.body = body
+		self.changed = True
+		self.committed = []
+
+	def fetch(self, url):
+		return fetch.Response(self.body, self.changed, 200 if self.changed else 304)
+
+	def commit(self, url):
+		self.committed.append(url)
+
+
+class TestQueryAndSave(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.directory, "weather.db")
+		weather.setup_table(sqlite3.connect(self.db_path))
+		with open(os.path.join(os.path.dirname(__file__), "fixtures", "KCLT.html")) as f:
+			self.fetcher = FakeFetcher(f.read())
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_unchanged_page_skipped(self):
+		self.assertEquals(weather.query_and_save(self.db_path, fetcher=self.fetcher)[0], 7)
+		self.assertEquals(self.fetcher.committed, [weather.url])
+		self.fetcher.body = None
+		self.fetcher.changed = False
+		self.assertEquals(weather.query_and_save(self.db_path, fetcher=self.fetcher), (0, 0))
+
+	def test_failed_write_not_committed(self):
+		with self.assertRaises(sqlite3.Error):
+			weather.query_and_save(os.path.join(self.directory, "missing", "weather.db"), fetcher=self.fetcher)
+		self.assertEquals(self.fetcher.committed, [])
+
+	def test_store(self):
+		s = store.connect(":memory:")
+		self.assertEquals(weather.query_and_save(None, fetcher=self.fetcher, store=s), (7, 0))
+		rows = s.db.execute("SELECT ts, value, attrs FROM series WHERE source='weather' ORDER BY ts").fetchall()
+		self.assertEquals(len(rows), 7)
+		first = min(weather.parse_observations(self.fetcher.body))
+		self.assertEquals(rows[0][:2], (store.local_epoch(first[0]), first[5]))
+		self.assertEquals(json.loads(rows[0][2])['wind_mph'], first[1])
@@ -20,43 +20,190 @@ weather.setup_table(db)
 weather.query_and_save('weather.db')
 
 
-TODO:
-CRITICAL - smarter dates - it uses the current month even when the last 48 hours includes the previous month
-INSERT OR IGNORE instead of individual try-catch
-
-
+The page is parsed with the standard library, so an hourly cron job doesn't pay for
+importing pandas. query_weather_web() and clean_weather_table() still give the table as a
+pandas DataFrame for analysis.
 """
 
 import sys
-import pandas as pd
 import datetime
 import sqlite3
 import os
+from HTMLParser import HTMLParser
+
+if __name__ == '__main__':
+	# the shared fetch layer lives next to this directory
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+import fetch
+import metrics
+import store as store_module
+
+url = "http://w1.weather.gov/obhistory/KCLT.html"
+
+# columns of the readings table, in order
+reading_columns = ['datetime', 'wind_mph', 'vis_mi', 'weather', 'sky', 'temperature_f', 'dewpoint_f',
+                   'humidity', 'wind_chill_f', 'heat_index_f', 'pressure_in', 'pressure_mb', 'precipitation']
+
+numeric_columns = ['vis_mi', 'temperature_f', 'dewpoint_f', 'humidity', 'wind_chill_f', 'heat_index_f',
+                   'pressure_in', 'pressure_mb', 'precipitation']
+
+_fetch_seconds, _fetch_bytes, _parse_seconds = metrics.collector_metrics("weather")
+_commit_seconds, _rows_written = metrics.database_metrics("weather")
+
 
+def query_and_save(db_path, verbose=False, fetcher=None, store=None):
+	"""Query the web and add new records to database, and to the store if one is given
 
-def query_and_save(db_path, verbose=False):
-	"""Query the web and add new records to database
+	db_path may be None to only write to the store. Nothing is parsed or written if the page
+	hasn't changed since the last query. The page is only cached as seen once it has been
+	written, so a failed write is retried on the next query. Returns (added, duplicated)
 	"""
-	db = sqlite3.connect(db_path)
-	data1 = query_weather_web(verbose)
-	data2 = clean_weather_table(data1)
-	result = append_records(db, data2, verbose)
+	if fetcher is None:
+		fetcher = fetch.CachedFetcher()
+	response = _fetch(fetcher, verbose)
+	if not response.changed:
+		if verbose:
+			print "Page unchanged"
+		return (0, 0)
+	with _parse_seconds.time():
+		rows = parse_observations(response.body)
+	result = (0, 0)
+	if db_path is not None:
+		result = append_rows(sqlite3.connect(db_path), rows, verbose)
+	if store is not None:
+		added = store.add('weather', store_rows(rows))
+		if db_path is None:
+			result = (added, len(rows) - added)
+	fetcher.commit(url)
 	return result
 
-def query_weather_web(verbose=False):
-	"""Query the website for the table of weather data
-	"""
+def store_rows(rows):
+	"""Rows from parse_observations() as (ts, temperature, attrs) for store.Store.add()"""
+	return [(store_module.local_epoch(row[0]), row[reading_columns.index('temperature_f')],
+	         dict((col, value) for col, value in zip(reading_columns[1:], row[1:])
+	              if col != 'temperature_f' and value is not None))
+	        for row in rows]
+
+def _fetch(fetcher, verbose):
+	if fetcher is None:
+		fetcher = fetch.CachedFetcher()
 	if verbose:
 		print "Querying website...",
 		sys.stdout.flush()
-	website_tables = pd.read_html("http://w1.weather.gov/obhistory/KCLT.html")
+	with _fetch_seconds.time():
+		response = fetcher.fetch(url)
+	_fetch_bytes.inc(len(response.body or ""))
 	if verbose:
 		print "Done"
+	return response
+
+
+class ObservationTableParser(HTMLParser):
+	"""Collects the cells of the observation rows of the page
+
+	The observation rows are the ones with a td for each of col_labels and a day number in
+	the first. Header, footer and layout rows are skipped. Feed the page in one piece or in
+	chunks, and read the rows as lists of strings from .rows.
+	"""
+
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.rows = []
+		self._row = None
+		self._cell = None
+
+	def handle_starttag(self, tag, attrs):
+		if tag == 'tr':
+			self._row = []
+		elif tag == 'td' and self._row is not None:
+			self._cell = []
+
+	def handle_endtag(self, tag):
+		if tag == 'td' and self._cell is not None:
+			self._row.append("".join(self._cell).strip())
+			self._cell = None
+		elif tag == 'tr' and self._row is not None:
+			if len(self._row) == len(col_labels) and self._row[0].isdigit():
+				self.rows.append(self._row)
+			self._row = None
+
+	def handle_data(self, data):
+		if self._cell is not None:
+			self._cell.append(data)
+
+	def handle_entityref(self, name):
+		if self._cell is not None:
+			self._cell.append(" ")
+
+
+def parse_observations(html, now=None):
+	"""Returns the observations on the page as tuples of the reading_columns
+
+	Numbers are floats, or None when missing. now is used to work out the month and year of
+	each observation, and defaults to the current time.
+	"""
+	if now is None:
+		now = datetime.datetime.now()
+	parser = ObservationTableParser()
+	parser.feed(html)
+	parser.close()
+	rows = []
+	for cells in parser.rows:
+		values = dict(zip(col_labels, cells))
+		values['datetime'] = observation_datetime(int(values['day']), values['time'], now)
+		for col in numeric_columns:
+			values[col] = _to_number(values[col])
+		rows.append(tuple(values[col] for col in reading_columns))
+	return rows
+
+
+def observation_datetime(day, time_text, now):
+	"""The date and time of an observation that only gives the day of the month
+
+	The page covers the last few days, so this is the most recent date with that day of the
+	month that isn't after now (allowing a day for time zones). On the 1st of the month, the
+	31st is in the month before.
+	"""
+	hour, minute = [int(_) for _ in time_text.split(":")]
+	year, month = now.year, now.month
+	latest = now.date() + datetime.timedelta(days=1)
+	for _ in range(12):
+		try:
+			date = datetime.date(year, month, day)
+		except ValueError:
+			# no such day in this month
+			date = None
+		if date is not None and date <= latest:
+			return datetime.datetime(date.year, date.month, date.day, hour, minute)
+		month -= 1
+		if month == 0:
+			month = 12
+			year -= 1
+	raise ValueError("Not a day of the month: {}".format(day))
+
+
+def _to_number(text):
+	text = text.replace("%", "").strip()
+	if text in ("", "NA"):
+		return None
+	return float(text)
+
+
+def query_weather_web(verbose=False, fetcher=None):
+	"""Query the website for the table of weather data
+
+	Returns a pandas DataFrame with all the columns of the table.
+	"""
+	import pandas as pd
+	website_tables = pd.read_html(_fetch(fetcher, verbose).body)
 
 	weather_table = website_tables[3].copy()
 	return weather_table
 
-def clean_weather_table(weather_table):
+def clean_weather_table(weather_table, now=None):
+	import pandas as pd
+	if now is None:
+		now = datetime.datetime.now()
 	data = weather_table.copy()
 
 	# column names
@@ -81,20 +228,15 @@ def clean_weather_table(weather_table):
 	data.humidity = data.humidity.apply(lambda x: x.replace("%", ""))
 
 	# make a date_time column
-	data['month'] = datetime.datetime.today().month
-	data['year'] = datetime.datetime.today().year
-	data['datetime'] = data.month.apply(str) + "/" + data.day.apply(str) + "/" + data.year.apply(str) \
-	    + " " + data.time.apply(str)
-	data['datetime'] = pd.to_datetime(data.datetime)
+	data['datetime'] = pd.to_datetime([observation_datetime(int(day), str(time), now)
+	                                   for day, time in zip(data.day, data.time)])
 
 	# put the datetime column first and get rid of the redudant columns
-	data.drop(['day', 'month', 'year', 'time'], axis=1, inplace=True)
-	cols = ['datetime'] + [_ for _ in data.columns if _ is not 'datetime']
-	data = data[cols]
+	data.drop(['day', 'time'], axis=1, inplace=True)
+	data = data[reading_columns]
 
 	# convert columns to numeric
-	for col in ['vis_mi', 'temperature_f', 'dewpoint_f', 'humidity', 'wind_chill_f', 'heat_index_f',
-	            'pressure_in', 'pressure_mb', 'precipitation']:
+	for col in numeric_columns:
 	    data[col] = pd.to_numeric(data[col], errors='raise')
 
 	return data
@@ -123,30 +265,42 @@ def setup_table(db):
 	db.execute(sql)
 	db.commit()
 
-def append_records(db, data, verbose=False):
-	"""Add records to database
+def append_rows(db, rows, verbose=False, columns=reading_columns):
+	"""Add rows of the columns to database, as from parse_observations()
 
-	Any records that already exist in the databse are not re-added (no duplicates are created.)
+	Any rows that already exist in the databse are not re-added (no duplicates are created.)
+	All rows are added in a single transaction. Returns (added, duplicated)
 	"""
-	added = 0
-	duplicated = 0
 	if verbose:
 		print "Adding records...",
 		sys.stdout.flush()
-	for i,row in data.iterrows():
-	    row = row.to_frame().T
-	    row.set_index('datetime', inplace=True)
-	    try:
-	        row.to_sql("readings", db, if_exists='append')
-	        added += 1
-	    except sqlite3.IntegrityError:
-	        duplicated += 1        
-	db.commit()
-	
+	sql = "INSERT OR IGNORE INTO readings({}) VALUES({})".format(
+	    ", ".join(columns), ", ".join(["?"] * len(columns)))
+	changes = db.total_changes
+	with _commit_seconds.time():
+		with db:
+			db.executemany(sql, rows)
+	added = db.total_changes - changes
+	_rows_written.inc(added)
+	duplicated = len(rows) - added
+
 	if verbose:
 		print "{} added, {} already existed".format(added, duplicated)
 	return (added, duplicated)
 
+def append_records(db, data, verbose=False):
+	"""Add records from a DataFrame to database, as from clean_weather_table()
+
+	Any records that already exist in the databse are not re-added (no duplicates are created.)
+	"""
+	import pandas as pd
+	data = data[[col for col in reading_columns if col in data.columns]].copy()
+	if data['datetime'].dtype.kind == 'M':
+		data['datetime'] = data['datetime'].dt.strftime('%Y-%m-%d %H:%M:%S')
+	# tolist() gives python values that sqlite accepts, with None in place of missing values
+	rows = data.astype(object).where(pd.notnull(data), None).values.tolist()
+	return append_rows(db, rows, verbose, list(data.columns))
+
 
 # column headings for table on http://w1.weather.gov/obhistory/KCLT.html
 col_labels="""
@@ -182,6 +336,9 @@ if __name__ == '__main__':
 	else:
 		sys.exit("Database file does not exist: {}".format(db_path))
 
-	# run
-	query_and_save(db_path, verbose=True)
+	# optionally also write to a store
+	store = store_module.connect(sys.argv[2]) if len(sys.argv) > 2 else None
 
+	# run
+	query_and_save(db_path, verbose=True, store=store)
+	metrics.write_snapshot(os.path.splitext(db_path)[0] + ".metrics.json")
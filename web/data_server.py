@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Web server for the page, with a data API that queries the databases directly
+
+Serves the files in the current directory, plus:
+
+/data?source=room,weather&from=2016-02-14 00:00:00&to=2016-02-15 00:00:00&max_points=2000
+
+which answers with the same columns as data.tsv (date, temp, source). Every parameter is
+optional: source defaults to every source, from and to to the whole history, and max_points
+to default_max_points per source. Dates are local time.
+
+If the time-series store (thermostat.db, see common/store.py) is in the data directory, a
+source is read from it when the store's data for the source is at least as recent as the
+source's own database. A store that only some writers add to, or that was filled once by
+migrate_store.py, leaves the other sources to their databases.
+
+The room is always read from therm.db when it has rollups, as the store has none. Room
+temperatures come from the rollup tables where the range is too long for the raw readings,
+or retention has deleted them, see thermometer/rollup.py.
+
+Responses are cached until one of the databases changes, and support ETag/If-None-Match and
+gzip, so refreshing the chart costs little more than a round trip.
+
+Usage: data_server.py [port [data_dir]]
+"""
+import os
+import sys
+import time
+import gzip
+import sqlite3
+import hashlib
+import logging
+import urlparse
+import BaseHTTPServer
+import SimpleHTTPServer
+from StringIO import StringIO
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from downsample import lttb
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "thermometer"))
+import rollup
+import store
+
+# the points to send for each source if max_points isn't given
+default_max_points = 2000
+# requests may not ask for more points than this
+max_max_points = 20000
+
+# the time-series store, read in place of the databases below when it is up to date
+store_file = "thermostat.db"
+
+# for each source, its database, a query that returns (seconds, local time text, temperature)
+# between the :start and :end local times, either of which may be null, and a query for the
+# seconds since the epoch (UTC) of its newest row, to compare with the store. A room database
+# with rollups is read by DataCache._room_rows() instead.
+sources = OrderedDict([
+    ('room', ("therm.db", """
+        SELECT read_time, datetime(read_time, 'unixepoch', 'localtime'), temperature FROM temp
+        WHERE read_time BETWEEN coalesce(CAST(strftime('%s', :start, 'utc') AS INTEGER), 0)
+        AND coalesce(CAST(strftime('%s', :end, 'utc') AS INTEGER), 1e12)
+        ORDER BY read_time""", """
+        SELECT max(read_time) FROM temp""")),
+    ('weather', ("weather.db", """
+        SELECT CAST(strftime('%s', datetime) AS INTEGER), datetime(datetime), temperature_f FROM readings
+        WHERE datetime BETWEEN coalesce(:start, '') AND coalesce(:end, '9999-12-31')
+        ORDER BY datetime""", """
+        SELECT CAST(strftime('%s', max(datetime), 'utc') AS INTEGER) FROM readings""")),
+    ('forecast', ("forecast.db", """
+        SELECT CAST(strftime('%s', forecast_datetime) AS INTEGER), datetime(forecast_datetime), temperature
+        FROM latest_run JOIN forecasts USING (run_id)
+        WHERE forecast_datetime BETWEEN coalesce(:start, '') AND coalesce(:end, '9999-12-31')
+        ORDER BY forecast_datetime""", """
+        SELECT CAST(strftime('%s', max(forecast_datetime), 'utc') AS INTEGER)
+        FROM latest_run JOIN forecasts USING (run_id)""")),
+])
+
+Response = namedtuple('Response', ['etag', 'body', 'gzipped', 'versions'])
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class DataCache(object):
+    """Answers data queries, keeping the most recent responses
+
+    A cached response is used until the data_version of one of its databases changes, which
+    happens when any other connection commits to it.
+    """
+
+    # the number of responses to keep
+    max_entries = 200
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._connections = {}
+        self._entries = OrderedDict()
+
+    def get(self, source_names=None, start=None, end=None, max_points=None):
+        """Returns a Response for the query, from the cache if it's still current
+
+        Raises BadRequest for an unknown source or a bad max_points
+        """
+        source_names = tuple(source_names or sources.keys())
+        for name in source_names:
+            if name not in sources:
+                raise BadRequest("Unknown source: {}".format(name))
+        if max_points is None:
+            max_points = default_max_points
+        if not 3 <= max_points <= max_max_points:
+            raise BadRequest("max_points must be between 3 and {}".format(max_max_points))
+
+        key = (source_names, start, end, max_points)
+        versions = tuple(self._data_version(sources[name][0]) for name in source_names) + \
+            (self._data_version(store_file),)
+        response = self._entries.pop(key, None)
+        if response is None or response.versions != versions:
+            response = self._query(source_names, start, end, max_points, versions)
+        self._entries[key] = response
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return response
+
+    def _connection(self, filename):
+        """An open connection to a database in data_dir, or None if there isn't one yet"""
+        db = self._connections.get(filename)
+        if db is None:
+            path = os.path.join(self.data_dir, filename)
+            if not os.path.exists(path):
+                return None
+            db = self._connections[filename] = sqlite3.connect(path)
+        return db
+
+    def _data_version(self, filename):
+        db = self._connection(filename)
+        if db is None:
+            return None
+        return db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _query(self, source_names, start, end, max_points, versions):
+        lines = ["date\ttemp\tsource"]
+        store_db = self._connection(store_file)
+        for name in source_names:
+            db = self._connection(sources[name][0])
+            if name == 'room' and db is not None and rollup.has_rollups(db):
+                rows = self._room_rows(db, start, end, max_points)
+            elif store_db is not None and self._store_is_current(store_db, name, db):
+                rows = self._store_rows(store_db, name, start, end)
+            elif db is not None:
+                rows = db.execute(sources[name][1], {'start': start, 'end': end}).fetchall()
+            else:
+                continue
+            if not rows:
+                continue
+            x = np.array([row[0] for row in rows], dtype=float)
+            y = np.array([row[2] for row in rows], dtype=float)
+            for i in lttb(x, y, max_points):
+                lines.append("{}\t{}\t{}".format(rows[i][1], rows[i][2], name))
+        body = "\n".join(lines) + "\n"
+        self._logger.debug("Queried {} rows for {}".format(len(lines) - 1, source_names))
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as f:
+            f.write(body)
+        return Response('"{}"'.format(hashlib.md5(body).hexdigest()), body, compressed.getvalue(), versions)
+
+    @staticmethod
+    def _store_is_current(store_db, name, db):
+        """Whether the store has the source's data at least as recent as its database"""
+        store_latest = store.Store(store_db).latest_ts(name)
+        if store_latest is None:
+            return False
+        if db is None:
+            return True
+        try:
+            db_latest = db.execute(sources[name][2]).fetchone()[0]
+        except sqlite3.OperationalError:
+            # the collector hasn't created its tables yet
+            return True
+        return db_latest is None or store_latest >= db_latest
+
+    @staticmethod
+    def _store_rows(db, name, start, end):
+        """The source's rows from the store, the latest run of a forecast"""
+        start, end = db.execute("SELECT CAST(strftime('%s', ?, 'utc') AS INTEGER), "
+                                "CAST(strftime('%s', ?, 'utc') AS INTEGER)", (start, end)).fetchone()
+        return [(ts, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)), value)
+                for ts, source, value in store.Store(db).select([name], start, end)]
+
+    @staticmethod
+    def _room_rows(db, start, end, max_points):
+        """The room's rows from the finest table that has about max_points rows for the range"""
+        start, end = db.execute("SELECT CAST(strftime('%s', ?, 'utc') AS INTEGER), "
+                                "CAST(strftime('%s', ?, 'utc') AS INTEGER)", (start, end)).fetchone()
+        if start is None or end is None:
+            # the span of the history, for choosing the table
+            table, seconds = rollup.resolutions[-1]
+            first, last = db.execute("SELECT min(bucket), max(bucket) + ? FROM {}".format(table), (seconds,)).fetchone()
+            span_start = start if start is not None else first
+            span_end = end + 1 if end is not None else last
+        else:
+            span_start, span_end = start, end + 1
+        if span_start is None or span_end is None:
+            return []
+        table = rollup.resolution_for(span_start, span_end, max_points)
+        history = rollup.select_history(db, start, end + 1 if end is not None else None, finest=table)
+        return [(t, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), temperature) for t, temperature in history]
+
+
+class DataRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/data":
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+        query = urlparse.parse_qs(url.query)
+        try:
+            source_names = query['source'][0].split(",") if 'source' in query else None
+            try:
+                max_points = int(query['max_points'][0]) if 'max_points' in query else None
+            except ValueError:
+                raise BadRequest("max_points must be a number")
+            response = self.server.cache.get(source_names, query.get('from', [None])[0],
+                                             query.get('to', [None])[0], max_points)
+        except BadRequest as e:
+            return self.send_error(400, str(e))
+
+        if response.etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.end_headers()
+            return
+
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = response.gzipped if use_gzip else response.body
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", response.etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DataServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, server_address, data_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, DataRequestHandler)
+        self.cache = DataCache(data_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else "../../data"
+    server = DataServer(('', port), data_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,60 @@
+"""Downsampling of time series for charting
+
+A chart can't show more points than it has pixels, so there's no point in sending it every
+reading. Largest-Triangle-Three-Buckets (Steinarsson, 2013) picks a subset of the points that
+looks like the original line, keeping peaks and troughs that plain decimation or averaging
+would flatten.
+"""
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """Returns the indexes of the n_out points of (x, y) to keep, in increasing order
+
+    x must be increasing. The first and last points are always kept. If there are no more
+    than n_out points, all of them are kept.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # the points between the first and last are split into n_out - 2 buckets of equal count,
+    # and one point is picked from each
+    edges = (np.arange(n_out - 1) * (float(n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    edges = np.append(edges, n)
+
+    # the average of each bucket is the third corner of the triangle when picking from the
+    # bucket before it. the last bucket uses the last point.
+    sums_x = np.add.reduceat(x, edges[:-1])
+    sums_y = np.add.reduceat(y, edges[:-1])
+    counts = np.diff(edges)
+    averages_x = sums_x / counts
+    averages_y = sums_y / counts
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # twice the area of the triangle between the last selected point, each point in
+        # this bucket and the average of the next bucket
+        areas = np.abs((x[a] - averages_x[i + 1]) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (averages_y[i + 1] - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_frame(frame, n_out, x_column='date', y_column='temp'):
+    """Returns the rows of a pandas DataFrame picked by lttb()
+
+    The x column may be datetimes or numbers.
+    """
+    x = frame[x_column].values
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('datetime64[s]').astype(np.int64)
+    return frame.iloc[lttb(x, frame[y_column].values, n_out)]
@@ -1,37 +1,126 @@
 #!/usr/bin/env python
+"""Exports the room, weather and forecast temperatures for the web page
 
+Writes public_html/data.tsv with the whole history. Each source is downsampled to at most its
+point count, so the page loads a few thousand points however much history there is. Shorter
+windows are served by data_server.py, which downsamples the range the page asks for.
+"""
+import os
+import sys
 import sqlite3
+import datetime
 import pandas as pd
 
-# #########################
-# room data
-db_room = sqlite3.connect("../data/therm.db")
-room = pd.read_sql("SELECT read_time as date, temperature as temp FROM temp", db_room)
-room['source'] = 'room'
-# remove rows that don't differ by more than 0.5 degrees
-i_is_diff = (room.temp.diff().abs() > 0)
-i_is_diff.iloc[-1] = True # always keep the last record
-room = room[i_is_diff]
-print room.tail()
-#room.to_csv("public_html/room.tsv", sep="\t", index=False)
-
-# #########################
-# weather data
-db_weather = sqlite3.connect("../data/weather.db")
-weather = pd.read_sql("SELECT datetime as date, temperature_f as temp FROM readings ORDER BY datetime", db_weather)
-weather['source'] = 'weather'
-print weather.tail()
-#weather.to_csv("public_html/weather.tsv", sep="\t", index=False)
-
-# #########################
-# forecast data
-db_forecast = sqlite3.connect("../data/forecast.db")
-forecast = pd.read_sql("SELECT forecast_datetime as date, temperature as temp FROM forecasts WHERE is_latest=1 ORDER BY forecast_datetime", db_forecast)
-forecast['source'] = 'forecast'
-print forecast.tail()
-#forecast.to_csv("public_html/forecast.tsv", sep="\t", index=False)
-
-# #########################
-# consolidated data
-data = pd.concat([room,weather,forecast])
-data.to_csv("public_html/data.tsv", sep="\t", index=False)
\ No newline at end of file
+from downsample import downsample_frame
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "thermometer"))
+import store
+import rollup
+
+# the most points of each source to send to the page
+point_counts = {
+    'room': 2000,
+    'weather': 500,
+    'forecast': 200,
+}
+
+date_format = "%Y-%m-%d %H:%M:%S"
+
+
+def load_room(db):
+    if rollup.has_rollups(db):
+        # older raw rows may have been deleted, their rollups fill in the history
+        room = pd.DataFrame(rollup.select_history(db), columns=['ts', 'temp'])
+        room['date'] = [datetime.datetime.fromtimestamp(ts).strftime(date_format) for ts in room.ts]
+        room = room[['date', 'temp']]
+    else:
+        room = pd.read_sql("SELECT datetime(read_time, 'unixepoch', 'localtime') as date, temperature as temp FROM temp ORDER BY read_time", db)
+    room['source'] = 'room'
+    return drop_repeats(room)
+
+
+def drop_repeats(room):
+    """Removes rows that don't differ from the one before"""
+    i_is_diff = (room.temp.diff().abs() > 0)
+    if len(room):
+        i_is_diff.iloc[-1] = True # always keep the last record
+    return room[i_is_diff]
+
+
+def load_weather(db):
+    weather = pd.read_sql("SELECT datetime as date, temperature_f as temp FROM readings ORDER BY datetime", db)
+    weather['source'] = 'weather'
+    return weather
+
+
+def load_forecast(db):
+    forecast = pd.read_sql("SELECT forecast_datetime as date, temperature as temp FROM latest_run JOIN forecasts USING (run_id) ORDER BY forecast_datetime", db)
+    forecast['source'] = 'forecast'
+    return forecast
+
+
+def load_store(s):
+    """The room, weather and latest forecast temperatures from a store.Store
+
+    Returns a frame for each source, as load_room(), load_weather() and load_forecast() do.
+    """
+    rows = s.select(['room', 'weather', 'forecast'])
+    data = pd.DataFrame(rows, columns=['ts', 'source', 'temp'])
+    data['date'] = [datetime.datetime.fromtimestamp(ts).strftime(date_format) for ts in data.ts]
+    frames = [data[data.source == name][['date', 'temp', 'source']].reset_index(drop=True)
+              for name in ['room', 'weather', 'forecast']]
+    frames[0] = drop_repeats(frames[0])
+    return frames
+
+
+def combine(sources):
+    """Combines the sources into one frame
+
+    Each source is downsampled to its entry in point_counts, if it has one.
+    """
+    frames = []
+    for source in sources:
+        if len(source) and source.source.iloc[0] in point_counts:
+            source = downsample_frame(source, point_counts[source.source.iloc[0]])
+        frames.append(source)
+    return pd.concat(frames)
+
+
+def export(sources, directory="public_html"):
+    """Writes the data file"""
+    sources = [s.assign(date=pd.to_datetime(s.date)) for s in sources]
+    data = combine(sources)
+    path = "{}/data.tsv".format(directory)
+    data.to_csv(path, sep="\t", index=False, date_format=date_format)
+    print "Wrote {} rows to {}".format(len(data), path)
+
+
+if __name__ == '__main__':
+    if os.path.exists("../data/thermostat.db"):
+        # everything is in the store
+        room, weather, forecast = load_store(store.connect("../data/thermostat.db"))
+        print room.tail()
+        print weather.tail()
+        print forecast.tail()
+        export([room, weather, forecast])
+        sys.exit()
+
+    # #########################
+    # room data
+    room = load_room(sqlite3.connect("../data/therm.db"))
+    print room.tail()
+
+    # #########################
+    # weather data
+    weather = load_weather(sqlite3.connect("../data/weather.db"))
+    print weather.tail()
+
+    # #########################
+    # forecast data
+    forecast = load_forecast(sqlite3.connect("../data/forecast.db"))
+    print forecast.tail()
+
+    # #########################
+    # consolidated data
+    export([room, weather, forecast])
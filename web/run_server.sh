@@ -1 +1 @@
-python -m SimpleHTTPServer 80
+cd "$(dirname "$0")/public_html" && python ../data_server.py 80 ../../data
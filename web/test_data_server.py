@@ -0,0 +1,148 @@
+import os
+import gzip
+import datetime
+import shutil
+import sqlite3
+import urllib2
+import tempfile
+import time
+import threading
+from StringIO import StringIO
+from unittest import TestCase
+
+from data_server import DataServer
+import query_temp
+import store
+
+
+class TestDataServer(TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = sqlite3.connect(os.path.join(self.data_dir, "therm.db"))
+        self.db.execute("CREATE TABLE temp(id INTEGER PRIMARY KEY, read_time INTEGER, temperature FLOAT)")
+        self.db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+                            [(1455544800 + 60 * i, 60 + i % 10) for i in range(1000)])
+        self.db.commit()
+        weather = sqlite3.connect(os.path.join(self.data_dir, "weather.db"))
+        weather.execute("CREATE TABLE readings(datetime TIMESTAMP PRIMARY KEY, temperature_f FLOAT)")
+        weather.executemany("INSERT INTO readings VALUES(?, ?)",
+                            [("2016-02-15 10:00:00", 40), ("2016-02-15 11:00:00", 42)])
+        weather.commit()
+        weather.close()
+        forecast = sqlite3.connect(os.path.join(self.data_dir, "forecast.db"))
+        forecast.execute("CREATE TABLE forecasts(run_id INTEGER, forecast_datetime DATETIME, temperature NUMERIC)")
+        forecast.execute("CREATE TABLE latest_run(id INTEGER PRIMARY KEY, run_id INTEGER)")
+        forecast.executemany("INSERT INTO forecasts VALUES(?, ?, ?)",
+                             [(1, "2016-02-15 12:00:00", 45), (2, "2016-02-15 12:00:00", 47)])
+        forecast.execute("INSERT INTO latest_run VALUES(0, 2)")
+        forecast.commit()
+        forecast.close()
+
+        self.server = DataServer(('localhost', 0), self.data_dir)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://localhost:{}/data".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def get(self, query="", headers=None):
+        return urllib2.urlopen(urllib2.Request(self.url + query, headers=headers or {}))
+
+    def test_all_sources(self):
+        lines = self.get().read().splitlines()
+        self.assertEquals(lines[0], "date\ttemp\tsource")
+        self.assertEquals(len([l for l in lines if l.endswith("\troom")]), 1000)
+        self.assertIn("2016-02-15 10:00:00\t40.0\tweather", lines)
+        self.assertEquals([l for l in lines if l.endswith("\tforecast")], ["2016-02-15 12:00:00\t47\tforecast"])
+
+    def test_range_and_max_points(self):
+        lines = self.get("?source=weather&from=2016-02-15%2010:30:00").read().splitlines()
+        self.assertEquals(lines[1:], ["2016-02-15 11:00:00\t42.0\tweather"])
+        lines = self.get("?source=room&max_points=100").read().splitlines()
+        self.assertEquals(len(lines), 101)
+
+    def test_etag(self):
+        response = self.get("?source=room")
+        etag = response.info()['ETag']
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self.get("?source=room", {'If-None-Match': etag})
+        self.assertEquals(cm.exception.code, 304)
+
+        # new rows change the response
+        self.db.execute("INSERT INTO temp(read_time, temperature) VALUES(?, ?)", (1455700000, 99))
+        self.db.commit()
+        response = self.get("?source=room", {'If-None-Match': etag})
+        self.assertNotEqual(response.info()['ETag'], etag)
+        self.assertTrue(response.read().endswith("\t99.0\troom\n"))
+
+    def test_gzip(self):
+        plain = self.get("?source=room").read()
+        response = self.get("?source=room", {'Accept-Encoding': 'gzip'})
+        self.assertEquals(response.info()['Content-Encoding'], 'gzip')
+        compressed = response.read()
+        self.assertLess(len(compressed), len(plain))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(compressed)).read(), plain)
+
+    def test_bad_request(self):
+        for query in ["?source=attic", "?max_points=1", "?max_points=lots"]:
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                self.get(query)
+            self.assertEquals(cm.exception.code, 400)
+
+    def test_room_rollups(self):
+        os.remove(os.path.join(self.data_dir, "therm.db"))
+        db = query_temp.database_setup(os.path.join(self.data_dir, "therm.db"))
+        day = 24 * 60 * 60
+        start = 1455494400
+        with db:
+            db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+                           [(t, 60 + (t - start) // day) for t in range(start, start + 4 * day, 60)])
+        query_temp.rollup.apply_retention(db, {'temp': 2}, now=start + 4 * day)
+        db.close()
+
+        def room(first, last, max_points):
+            query = "?source=room&max_points={}&from={}&to={}".format(
+                max_points, *[urllib2.quote(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))) for t in (first, last)])
+            return [l for l in self.get(query).read().splitlines() if l.endswith("\troom")]
+        # too long a range for the raw rows, so the 5 minute rollups
+        self.assertEquals(len(room(start, start + 2 * day - 1, 600)), 576)
+        # the raw rows before the third day are gone, but their rollups are still there
+        self.assertEquals(len(room(start + 1.5 * day, start + 2.5 * day, 2000)), 144 + 721)
+
+    def test_store(self):
+        s = store.connect(os.path.join(self.data_dir, "thermostat.db"))
+        ts = store.local_epoch(datetime.datetime(2016, 2, 15, 10))
+        s.add('weather', [(ts, 30), (ts + 3600, 31)])
+        # a reading after the last one in therm.db
+        room_ts = 1455544800 + 60 * 1000
+        s.add('room', [(room_ts, 65)])
+        s.add_run('forecast', [(ts + 7200, 35)])
+        lines = self.get().read().splitlines()
+        # every source comes from the store when it is as up to date as the databases
+        self.assertEquals(lines[1:], [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(room_ts)) + "\t65.0\troom",
+                                      "2016-02-15 10:00:00\t30.0\tweather",
+                                      "2016-02-15 11:00:00\t31.0\tweather",
+                                      "2016-02-15 12:00:00\t35.0\tforecast"])
+        lines = self.get("?source=weather&from=2016-02-15%2010:30:00").read().splitlines()
+        self.assertEquals(lines[1:], ["2016-02-15 11:00:00\t31.0\tweather"])
+        s.db.close()
+
+    def test_store_with_some_sources(self):
+        # the daemon only records the heater in the store
+        s = store.connect(os.path.join(self.data_dir, "thermostat.db"))
+        s.add('heater', [(1455544800, 1)])
+        lines = self.get().read().splitlines()
+        self.assertEquals(len([l for l in lines if l.endswith("\troom")]), 1000)
+        self.assertEquals([l for l in lines if l.endswith("\tweather")],
+                          ["2016-02-15 10:00:00\t40.0\tweather", "2016-02-15 11:00:00\t42.0\tweather"])
+        # a store filled once by migrate_store.py falls behind the weather database
+        s.add('weather', [(store.local_epoch(datetime.datetime(2016, 2, 15, 10)), 30)])
+        lines = self.get("?source=weather").read().splitlines()
+        self.assertEquals(lines[1:], ["2016-02-15 10:00:00\t40.0\tweather", "2016-02-15 11:00:00\t42.0\tweather"])
+        s.db.close()
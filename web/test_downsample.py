@@ -0,0 +1,91 @@
+import os
+import datetime
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from downsample import lttb, downsample_frame
+import prep_web_data
+
+
+class TestLttb(TestCase):
+
+    def test_keeps_everything_when_short(self):
+        self.assertEquals(lttb([1, 2, 3], [5, 6, 7], 10).tolist(), [0, 1, 2])
+
+    def test_count_and_order(self):
+        x = np.arange(10000)
+        y = np.sin(x / 100.0)
+        selected = lttb(x, y, 500)
+        self.assertEquals(len(selected), 500)
+        self.assertEquals(selected[0], 0)
+        self.assertEquals(selected[-1], 9999)
+        self.assertTrue((np.diff(selected) > 0).all())
+
+    def test_keeps_peaks(self):
+        x = np.arange(1000)
+        y = np.zeros(1000)
+        y[333] = 10
+        y[666] = -10
+        selected = lttb(x, y, 20)
+        self.assertIn(333, selected)
+        self.assertIn(666, selected)
+
+    def test_frame_with_dates(self):
+        frame = pd.DataFrame({'date': pd.date_range("2016-02-15", periods=100, freq="min"),
+                              'temp': np.arange(100) % 7})
+        self.assertEquals(len(downsample_frame(frame, 10)), 10)
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        dates = pd.date_range("2016-01-01", "2016-02-15", freq="min")
+        room = pd.DataFrame({'date': dates.strftime(prep_web_data.date_format),
+                             'temp': 68 + np.sin(np.arange(len(dates)) / 50.0),
+                             'source': 'room'})
+        forecast = pd.DataFrame({'date': ["2016-02-15 01:00:00", "2016-02-15 02:00:00"],
+                                 'temp': [40, 41], 'source': 'forecast'})
+        prep_web_data.export([room, forecast], self.directory)
+
+        data = pd.read_csv(os.path.join(self.directory, "data.tsv"), sep="\t")
+        self.assertEquals(len(data), prep_web_data.point_counts['room'] + 2)
+        self.assertEquals(data.date.iloc[0], "2016-01-01 00:00:00")
+        self.assertEquals((data.source == 'forecast').sum(), 2)
+        self.assertEquals(os.listdir(self.directory), ["data.tsv"])
+
+    def test_load_store(self):
+        s = prep_web_data.store.connect(":memory:")
+        s.add('room', [(1455544800, 68), (1455544860, 68), (1455544920, 69)])
+        s.add('weather', [(1455544800, 40)])
+        s.add_run('forecast', [(1455548400, 45)], created_ts=1)
+        s.add_run('forecast', [(1455548400, 47)], created_ts=2)
+        room, weather, forecast = prep_web_data.load_store(s)
+        self.assertEquals(room.temp.tolist(), [69])
+        self.assertEquals(weather.date.tolist(),
+                          [datetime.datetime.fromtimestamp(1455544800).strftime(prep_web_data.date_format)])
+        self.assertEquals(forecast.temp.tolist(), [47])
+
+    def test_load_room_with_rollups(self):
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE temp(id INTEGER PRIMARY KEY, read_time INTEGER NOT NULL, temperature FLOAT)")
+        prep_web_data.rollup.setup(db)
+        day = 86400
+        db.executemany("INSERT INTO temp(read_time, temperature) VALUES(?, ?)",
+                       [(t, 60 + t // day) for t in range(day * 10, day * 13, 3600)])
+        prep_web_data.rollup.apply_retention(db, {'temp': 1}, now=day * 13)
+        room = prep_web_data.load_room(db)
+        # the first two days come from the 5 minute rollups, the raw rows of which are gone
+        self.assertEquals(room.temp.tolist(), [71, 72, 72])
+        self.assertEquals(room.date.iloc[0],
+                          datetime.datetime.fromtimestamp(day * 11).strftime(prep_web_data.date_format))